@@ -13,6 +13,82 @@ from PyQt5.QtWidgets import QMessageBox
 import subprocess
 import shutil
 import hashlib
+from collections import OrderedDict
+
+PIXMAP_CACHE_MB = 1024      # decoded images kept in memory (a 12 MP image is about 48 MB)
+PREFETCH_NEIGHBOURS = 2     # images on each side of the current one decoded ahead of time
+PYRAMID_CACHE_IMAGES = 8    # images whose downscaled copies are kept for zooming (about a third of the image size each, 16 MB for 12 MP)
+MIN_PYRAMID_WIDTH = 256     # smallest downscaled copy made
+SMOOTH_RENDER_DELAY_MS = 150  # smooth rescale this long after the last wheel step
+
+
+class PixmapCache:
+    """
+    Decoded images by file path, least recently used first, holding at most max_bytes of pixels.
+    Each entry remembers the file's modification time, so an image that was rewritten
+    (e.g. a regenerated _annotated.png) is never served from the cache.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()   # path -> (mtime, pixmap, nbytes)
+
+    @staticmethod
+    def modified(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def get(self, path):
+        entry = self.entries.get(path)
+        if entry is None or entry[0] != self.modified(path):
+            return None
+        self.entries.move_to_end(path)
+        return entry[1]
+
+    def __contains__(self, path):
+        entry = self.entries.get(path)
+        return entry is not None and entry[0] == self.modified(path)
+
+    def put(self, path, mtime, pixmap):
+        if pixmap.isNull() or mtime is None:
+            return
+        self.remove(path)
+        nbytes = pixmap.width() * pixmap.height() * pixmap.depth() // 8
+        self.entries[path] = (mtime, pixmap, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+
+
+class DecodeSignals(QtCore.QObject):
+    decoded = QtCore.pyqtSignal(str, float, QtGui.QImage)
+
+
+class DecodeTask(QtCore.QRunnable):
+    """
+    Decode one image file into a QImage on a QThreadPool thread. QPixmaps can only be made
+    on the GUI thread, so the QImage is sent back with the decoded signal and turned into a
+    QPixmap there.
+    """
+
+    def __init__(self, path, mtime):
+        super().__init__()
+        self.path = path
+        self.mtime = mtime
+        self.signals = DecodeSignals()
+
+    def run(self):
+        image = QtGui.QImage(self.path)
+        self.signals.decoded.emit(self.path, self.mtime, image)
+
 
 class ZoomLabel(QtWidgets.QLabel):
     """
@@ -20,8 +96,16 @@ class ZoomLabel(QtWidgets.QLabel):
     1) Fits the pixmap to its QScrollArea on load or when requested.
     2) Supports Ctrl+wheel for zooming in/out (after fit).
     3) Supports click-and-drag panning by adjusting scrollbars in its QScrollArea.
+
+    Every image gets a pyramid of downscaled copies (each half the size of the one before),
+    built as they are needed and shared by all ZoomLabels. The image on screen is scaled
+    from the smallest level that is still at least as large as it, not from the full
+    12 MP image, and while the wheel is turning a fast rescale is shown and the smooth one
+    is only done once it stops.
     """
 
+    pyramids = OrderedDict()   # pixmap cacheKey -> [1/2, 1/4, ...] (the full size is base_pixmap), shared by all labels
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setAlignment(QtCore.Qt.AlignCenter)
@@ -30,6 +114,10 @@ class ZoomLabel(QtWidgets.QLabel):
         self._drag_start = None
         self.setSizePolicy(QtWidgets.QSizePolicy.Ignored, QtWidgets.QSizePolicy.Ignored)
         self.setScaledContents(False)
+        self._smooth_timer = QtCore.QTimer(self)
+        self._smooth_timer.setSingleShot(True)
+        self._smooth_timer.setInterval(SMOOTH_RENDER_DELAY_MS)
+        self._smooth_timer.timeout.connect(lambda: self.render(smooth=True))
 
     def setPixmap(self, pixmap: QtGui.QPixmap):
         """
@@ -39,6 +127,56 @@ class ZoomLabel(QtWidgets.QLabel):
         self.scale_factor = 1.0
         self.fit_to_viewport()
 
+    def pyramid_level(self, width):
+        """
+        The smallest pyramid level of base_pixmap that is at least width pixels wide
+        (base_pixmap itself when zoomed in past 1:1). Missing levels are made here. Only the
+        downscaled levels are kept, so full size images are not held here after PixmapCache
+        has let them go.
+        """
+        key = self.base_pixmap.cacheKey()
+        smaller = ZoomLabel.pyramids.get(key)
+        if smaller is None:
+            smaller = []
+            ZoomLabel.pyramids[key] = smaller
+            while len(ZoomLabel.pyramids) > PYRAMID_CACHE_IMAGES:
+                ZoomLabel.pyramids.popitem(last=False)
+        ZoomLabel.pyramids.move_to_end(key)
+
+        levels = [self.base_pixmap] + smaller
+        while levels[-1].width() // 2 >= max(width, MIN_PYRAMID_WIDTH):
+            level = levels[-1].scaled(
+                levels[-1].size() / 2, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation
+            )
+            smaller.append(level)
+            levels.append(level)
+        for level in reversed(levels):
+            if level.width() >= width:
+                return level
+        return self.base_pixmap
+
+    def render(self, smooth=True):
+        """
+        Show base_pixmap at self.scale_factor, scaled from the nearest pyramid level above it.
+        With smooth=False the fast (nearest pixel) scaling is used, for while the zoom is changing.
+        """
+        self._smooth_timer.stop()
+        if self.base_pixmap is None:
+            return
+        if self.base_pixmap.isNull():
+            super().setPixmap(self.base_pixmap)
+            self.adjustSize()
+            return
+        target = self.base_pixmap.size() * self.scale_factor
+        source = self.pyramid_level(target.width())
+        if source.size() == target:
+            scaled = source
+        else:
+            mode = QtCore.Qt.SmoothTransformation if smooth else QtCore.Qt.FastTransformation
+            scaled = source.scaled(target, QtCore.Qt.KeepAspectRatio, mode)
+        super().setPixmap(scaled)
+        self.adjustSize()
+
     def fit_to_viewport(self):
         """
         Scale base_pixmap to exactly fill its QScrollArea viewport (keep aspect ratio),
@@ -50,13 +188,11 @@ class ZoomLabel(QtWidgets.QLabel):
         scroll = self._find_scroll_area()
         if scroll is not None:
             avail = scroll.viewport().size()
-            if avail.width() > 0 and avail.height() > 0:
-                fitted = self.base_pixmap.scaled(
-                    avail, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation
+            if avail.width() > 0 and avail.height() > 0 and not self.base_pixmap.isNull():
+                self.scale_factor = min(
+                    avail.width() / self.base_pixmap.width(), avail.height() / self.base_pixmap.height()
                 )
-                super().setPixmap(fitted)
-                self.scale_factor = fitted.width() / self.base_pixmap.width()
-                self.adjustSize()
+                self.render(smooth=True)
                 return
         else:
             print("In fit to viewport function: scroll is None")
@@ -70,15 +206,7 @@ class ZoomLabel(QtWidgets.QLabel):
         Re‐render base_pixmap at whatever self.scale_factor currently is.
         (Used when swapping in a new base_pixmap but wanting to keep the previous zoom.)
         """
-        if self.base_pixmap is None:
-            return
-        # Compute new size and re‐scale from the full‐res base_pixmap
-        new_size = self.base_pixmap.size() * self.scale_factor
-        scaled = self.base_pixmap.scaled(
-            new_size, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation
-        )
-        super().setPixmap(scaled)
-        self.adjustSize()
+        self.render(smooth=True)
 
 
     def wheelEvent(self, event: QtGui.QWheelEvent):
@@ -95,12 +223,9 @@ class ZoomLabel(QtWidgets.QLabel):
             if self.scale_factor < 0.1:
                 self.scale_factor = 0.1
 
-            new_size = self.base_pixmap.size() * self.scale_factor
-            scaled = self.base_pixmap.scaled(
-                new_size, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation
-            )
-            super().setPixmap(scaled)
-            self.adjustSize()
+            # fast rescale while the wheel turns, smooth once it has stopped for a moment
+            self.render(smooth=False)
+            self._smooth_timer.start()
         else:
             super().wheelEvent(event)
 
@@ -176,6 +301,13 @@ class LabelNestsApp(QtWidgets.QWidget):
         self.labelme_initial_json_data = None
         self.labelme_post_json_data = None
 
+        # ------------- Decoded Image Cache -------------
+        # Neighbours of the current image are decoded in the background, so navigating is a cache hit
+        self.pixmap_cache = PixmapCache(PIXMAP_CACHE_MB * 2**20)
+        self.decode_pool = QtCore.QThreadPool()
+        self.decode_pool.setMaxThreadCount(2)
+        self.pending_decodes = set()
+
         # ------------- Top Status Bar -------------
         self.message_label = QtWidgets.QLabel(alignment=QtCore.Qt.AlignCenter)
         self.message_label.setFixedHeight(60) # was 30
@@ -427,7 +559,7 @@ class LabelNestsApp(QtWidgets.QWidget):
         if self.viewing_annotated_current and os.path.exists(annotated_path):
             # If the user has toggled annotations on, and an _annotated.png exists,
             # load that instead of the raw image.
-            pixmap = QtGui.QPixmap(annotated_path)
+            pixmap = self.load_pixmap(annotated_path)
             #super(ZoomLabel, self.main_label).setPixmap(pixmap)
             self.main_label.setPixmap(pixmap)
             self.main_label.scale_factor = old_scale
@@ -440,7 +572,7 @@ class LabelNestsApp(QtWidgets.QWidget):
             #self.message_label.setText(f"👁 Current: {base_name}_annotated.png")
         else:
             # Otherwise, load the raw image and reset the flag if no annotation file is found
-            pixmap = QtGui.QPixmap(image_path)
+            pixmap = self.load_pixmap(image_path)
             #self.main_label.setPixmap(pixmap)
             self.main_label.base_pixmap = pixmap
             self.main_label.scale_factor = old_scale
@@ -479,6 +611,51 @@ class LabelNestsApp(QtWidgets.QWidget):
         self.next_scroll_area.setVisible(self.next_compare_visible)
         self.update_splitter_sizes()
 
+        # --- Decode the images around the new position before they are needed ---
+        self.prefetch_neighbours()
+
+    def load_pixmap(self, path):
+        """
+        Return the decoded image at path from the cache, decoding it here (on the GUI thread)
+        only if the background loader has not got to it yet.
+        """
+        pixmap = self.pixmap_cache.get(path)
+        if pixmap is None:
+            mtime = PixmapCache.modified(path)
+            pixmap = QtGui.QPixmap(path)
+            self.pixmap_cache.put(path, mtime, pixmap)
+        return pixmap
+
+    def prefetch_neighbours(self):
+        """
+        Queue background decodes of the images within PREFETCH_NEIGHBOURS of the current one
+        (closest first), and of their annotated versions if they exist. Decodes queued for the
+        previous position that have not started yet are dropped.
+        """
+        self.decode_pool.clear()
+        self.pending_decodes.clear()
+        for distance in range(PREFETCH_NEIGHBOURS + 1):
+            for index in sorted({self.current_index + distance, self.current_index - distance}, reverse=True):
+                if index < 0 or index >= len(self.image_list):
+                    continue
+                base_name, _ = os.path.splitext(self.image_list[index])
+                for path in (os.path.join(self.folder_path, self.image_list[index]),
+                             os.path.join(self.folder_path, f"{base_name}_annotated.png")):
+                    mtime = PixmapCache.modified(path)
+                    if mtime is None or path in self.pixmap_cache or path in self.pending_decodes:
+                        continue
+                    task = DecodeTask(path, mtime)
+                    task.signals.decoded.connect(self.on_image_decoded)
+                    self.pending_decodes.add(path)
+                    self.decode_pool.start(task)
+
+    def on_image_decoded(self, path, mtime, image):
+        """Turn a QImage decoded in the background into a cached QPixmap (runs on the GUI thread)."""
+        self.pending_decodes.discard(path)
+        if image.isNull() or mtime != PixmapCache.modified(path):
+            return
+        self.pixmap_cache.put(path, mtime, QtGui.QPixmap.fromImage(image))
+
 
 
     #Note to self: Need to update this to check the time stamps of the json file vs. the annotated image path, to check whether one is newer than the other
@@ -507,13 +684,13 @@ class LabelNestsApp(QtWidgets.QWidget):
                 if json_modification_time > annotated_image_modification_time:
                     print("json file has been modified, generating new annotated image")
                     self.generate_annotated_image(image_path, json_path, annotated_path)
-                pixmap = QtGui.QPixmap(annotated_path)
+                pixmap = self.load_pixmap(annotated_path)
                 btn_text = f"Toggle Previous Image:{base_name[10:23]} annotated"
             else:
-                pixmap = QtGui.QPixmap(image_path)
+                pixmap = self.load_pixmap(image_path)
                 btn_text = f"Toggle Previous Image: {target_name[10:23]} - no annotations found"
         else:
-            pixmap = QtGui.QPixmap(image_path)
+            pixmap = self.load_pixmap(image_path)
             btn_text = f"Toggle Previous Image: {target_name[10:23]}"
 
         self.toggle_prev_btn.setText(btn_text)
@@ -550,13 +727,13 @@ class LabelNestsApp(QtWidgets.QWidget):
                 if json_modification_time > annotated_image_modification_time:
                     print("json file has been modified, generating new annotated image")
                     self.generate_annotated_image(image_path, json_path, annotated_path)
-                pixmap = QtGui.QPixmap(annotated_path)
+                pixmap = self.load_pixmap(annotated_path)
                 btn_text = f"Toggle Next Image: {base_name[10:23]} annotated"
             else:
-                pixmap = QtGui.QPixmap(image_path)
+                pixmap = self.load_pixmap(image_path)
                 btn_text = f"Toggle Next Image: {target_name[10:23]} - no annotations found"
         else:
-            pixmap = QtGui.QPixmap(image_path)
+            pixmap = self.load_pixmap(image_path)
             btn_text = f"Toggle Next Image: {target_name[10:23]}"
 
         self.toggle_next_btn.setText(btn_text)
@@ -745,7 +922,7 @@ class LabelNestsApp(QtWidgets.QWidget):
             if not os.path.exists(annotated_path) and os.path.exists(json_path):
                 self.generate_annotated_image(image_path, json_path, annotated_path)
             if os.path.exists(annotated_path):
-                new_pixmap = QtGui.QPixmap(annotated_path)
+                new_pixmap = self.load_pixmap(annotated_path)
                 self.main_label.base_pixmap = new_pixmap
                 self.main_label.scale_factor = old_scale
                 if old_scale == 1.0:
@@ -757,7 +934,7 @@ class LabelNestsApp(QtWidgets.QWidget):
                 #self.message_label.setText(f"👁 Viewing annotated: {image_name}")
             else:
                 self.viewing_annotated_current = False
-                new_pixmap = QtGui.QPixmap(image_path)
+                new_pixmap = self.load_pixmap(image_path)
                 self.main_label.base_pixmap = new_pixmap
                 self.main_label.scale_factor = old_scale
                 if old_scale == 1.0:
@@ -769,7 +946,7 @@ class LabelNestsApp(QtWidgets.QWidget):
                 #self.message_label.setText(f"⚠ No annotated image found; showing original.")
         else:
             # turn annotations off: display raw image but keep zoom+pan
-            new_pixmap = QtGui.QPixmap(image_path)
+            new_pixmap = self.load_pixmap(image_path)
             self.main_label.base_pixmap = new_pixmap
             self.main_label.scale_factor = old_scale
             if old_scale == 1.0:
@@ -1026,14 +1203,9 @@ class LabelNestsApp(QtWidgets.QWidget):
             new_sf = 0.05
         zoom_label.scale_factor = new_sf
 
-        # Build a new scaled pixmap and display it
-        new_size = zoom_label.base_pixmap.size() * zoom_label.scale_factor
-        scaled = zoom_label.base_pixmap.scaled(
-            new_size, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation
-        )
+        # Display it scaled from the nearest pyramid level
         zoom_label._drag_start = None
-        super(ZoomLabel, zoom_label).setPixmap(scaled)
-        zoom_label.adjustSize()
+        zoom_label.render(smooth=True)
 
 
     def convert_json_to_csv(self):
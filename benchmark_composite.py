@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+'''
+Benchmark the nest composite backends without a BumbleBox. A set of synthetic snapshots is rendered (a smooth nest
+texture with dark bee shaped blobs at random places in every image, and noise) and saved as PNGs, then the composite
+of the set is made with each backend of nest_composite.median_composite. For every backend this reports the run time,
+images per second, the peak memory of the processes that ran it, the largest difference from the numpy median and the
+mean difference from the nest texture without bees, so the backends can be compared for a given image size and count.
+
+Backends:
+    numpy            every image in one (images, height, width) array, np.median
+    dask             the same array in bands of rows, da.median (skipped if dask is not installed)
+    histogram        streaming per pixel histogram, two passes over the files, one process
+    histogram-tiled  decoded once into a stack file, bands of rows in --workers processes
+
+The bands of histogram-tiled are computed in pool processes, whose memory the main process does not see, so
+peak_memory_mb is the main process plus --workers times the largest worker (an upper bound, since the workers share
+the pages of the memory mapped stack). main_memory_mb and worker_memory_mb are the two parts.
+'''
+
+import argparse
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from benchmark_tracking import make_background
+from nest_composite import ImageLoader, median_composite
+from pipeline_stats import peak_memory_mb
+
+MODES = ['numpy', 'dask', 'histogram', 'histogram-tiled']
+
+
+def render_snapshot(background, bees, bee_size, noise, rng):
+    '''the background with bees (dark ellipses) at random places and angles, and gaussian noise'''
+    image = background.copy()
+    height, width = image.shape
+    for _ in range(bees):
+        center = (int(rng.uniform(0, width)), int(rng.uniform(0, height)))
+        axes = (bee_size // 2, bee_size // 3)
+        cv2.ellipse(image, center, axes, float(rng.uniform(0, 180)), 0, 360, float(rng.uniform(10, 50)), -1)
+    if noise > 0:
+        image += rng.normal(0, noise, size=image.shape).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def write_snapshots(folder, args):
+    '''save args.images synthetic snapshots as PNGs in folder and return their paths and the clean background'''
+    background = make_background(args.width, args.height, args.seed)
+    rng = np.random.default_rng(args.seed + 1)
+    paths = []
+    for i in range(args.images):
+        path = os.path.join(folder, f"snapshot_{i:04d}.png")
+        cv2.imwrite(path, render_snapshot(background, args.bees, args.bee_size, args.noise, rng))
+        paths.append(path)
+    return paths, np.rint(np.clip(background, 0, 255)).astype(np.uint8)
+
+
+def run_mode(mode, paths, scratch, args):
+    '''
+    make the composite with one backend in this (fresh) process and return it, its run time and the peak memory of
+    this process and of its largest worker process (0 if there were none)
+    '''
+    cv2.setNumThreads(1)
+    backend = 'histogram' if mode.startswith('histogram') else mode
+    workers = args.workers if mode == 'histogram-tiled' else 1
+    start = time.time()
+    images = ImageLoader(paths, threads=args.threads)
+    composite, used = median_composite(images, max_images=len(paths), bits=args.bits, workers=workers, scratch=scratch, backend=backend)
+    seconds = time.time() - start
+    return composite, used, seconds, peak_memory_mb(), peak_memory_mb(children=True)
+
+
+def dask_installed():
+    return importlib.util.find_spec('dask') is not None
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Benchmark nest composite backends on synthetic snapshots')
+    parser.add_argument('-m', '--modes', type=str, default=','.join(MODES), help='comma separated list of backends to run, from: ' + ', '.join(MODES))
+    parser.add_argument('-n', '--images', type=int, default=50, help='number of snapshots to render')
+    parser.add_argument('-w', '--width', type=int, default=2028, help='snapshot width in pixels')
+    parser.add_argument('-ht', '--height', type=int, default=1520, help='snapshot height in pixels')
+    parser.add_argument('-bs', '--bees', type=int, default=40, help='number of bees in every snapshot')
+    parser.add_argument('-s', '--bee_size', type=int, default=60, help='length of a bee in pixels')
+    parser.add_argument('-no', '--noise', type=float, default=4.0, help='standard deviation of the gaussian noise added to each snapshot')
+    parser.add_argument('-b', '--bits', type=int, default=4, help='bits of the first pass histogram of the histogram backends (8 for a single pass)')
+    parser.add_argument('-j', '--workers', type=int, default=max(os.cpu_count() or 1, 2), help='number of processes of histogram-tiled')
+    parser.add_argument('-t', '--threads', type=int, default=4, help='number of threads reading and decoding images')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the background, the bees and the noise')
+    parser.add_argument('-o', '--output', type=str, default=None, help='also save the results to this csv file')
+    args = parser.parse_args()
+
+    modes = [m.strip() for m in args.modes.split(',') if m.strip()]
+    unknown = [m for m in modes if m not in MODES]
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(unknown)}")
+    if 'dask' in modes and not dask_installed():
+        print("dask is not installed, skipping the dask backend")
+        modes.remove('dask')
+
+    results = []
+    composites = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print(f"rendering {args.images} snapshots of {args.width}x{args.height} to {tmpdir}")
+        paths, background = write_snapshots(tmpdir, args)
+
+        for mode in modes:
+            '''each backend runs in its own fresh process so its peak memory is measured on its own'''
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                composite, used, seconds, main_peak, worker_peak = pool.submit(run_mode, mode, paths, tmpdir, args).result()
+            workers = args.workers if mode == 'histogram-tiled' else 0
+            peak = main_peak + workers * worker_peak
+            composites[mode] = composite
+            results.append({'mode': mode, 'images': used, 'seconds': round(seconds, 3), 'images_per_sec': round(used / seconds, 2), 'peak_memory_mb': round(peak, 1),
+                            'main_memory_mb': round(main_peak, 1), 'worker_memory_mb': round(worker_peak, 1),
+                            'background_error': round(float(np.abs(composite.astype(np.int16) - background).mean()), 3)})
+            print(f"{mode}: {results[-1]['images_per_sec']} images/sec, peak memory {results[-1]['peak_memory_mb']} MB")
+
+    '''the numpy median is the reference, every backend should match it exactly'''
+    reference = composites.get('numpy')
+    for row in results:
+        row['max_diff_from_numpy'] = None if reference is None else int(np.abs(composites[row['mode']].astype(np.int16) - reference).max())
+
+    results = pd.DataFrame(results)
+    print()
+    print(results.to_string(index=False))
+    if args.output:
+        results.to_csv(args.output, index=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
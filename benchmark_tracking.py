@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+'''
+Benchmark tag tracking without a camera. Synthetic nest frames are rendered with 4X4_50 ArUco markers moving along
+known trajectories (with rotation, blur and noise), then tracked with each tracking mode. For every mode this reports
+frames per second, detection recall (fraction of rendered tags found with the right ID), mean centroid error in pixels
+and the peak memory of the process that ran it, so changes to tracking can be compared offline.
+
+Modes:
+    mp4         YUV420 frames held in memory, tracked like trackTagsFromVid_MP4
+    mp4-luma    luma planes in a LumaRingBuffer (capture_luma_only = True)
+    mjpeg       an mjpeg file tracked through cv2.VideoCapture
+    mjpeg-gray  an mjpeg file decoded straight to grayscale (trackTagsFromVid_MJPEG)
+    mjpeg-gray2 / mjpeg-gray4   the same, decoded at 1/2 or 1/4 size
+    mjpeg-gated like mjpeg-gray, with a MotionGatedDetector (use --still to make some bees sit still)
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from frame_buffer import LumaRingBuffer
+from motion_gate import MotionGatedDetector
+from pipeline_stats import peak_memory_mb
+from tag_tracking import create_detector, get_tag_dictionary, track_frames, track_mjpeg, track_video
+
+MODES = ['mp4', 'mp4-luma', 'mjpeg', 'mjpeg-gray', 'mjpeg-gray2', 'mjpeg-gray4', 'mjpeg-gated']
+
+
+def make_trajectories(n_frames, n_markers, width, height, marker_size, seed=0, still=0.0):
+    '''
+    random walks of n_markers tags that bounce off the edges of the frame, returned as a DataFrame with the frame, ID,
+    true centroid and rotation angle (degrees) of every tag in every frame. The first still fraction of the tags don't move
+    '''
+    rng = np.random.default_rng(seed)
+    margin = marker_size * 1.5
+    pos = rng.uniform([margin, margin], [width - margin, height - margin], size=(n_markers, 2))
+    vel = rng.normal(0, marker_size / 10, size=(n_markers, 2))
+    angle = rng.uniform(0, 360, size=n_markers)
+    spin = rng.normal(0, 5, size=n_markers)
+    vel[:int(still * n_markers)] = 0
+    spin[:int(still * n_markers)] = 0
+
+    rows = []
+    for frame in range(n_frames):
+        for tag in range(n_markers):
+            rows.append((frame, tag, pos[tag, 0], pos[tag, 1], angle[tag]))
+        pos += vel
+        for axis, limit in ((0, width), (1, height)):
+            out = (pos[:, axis] < margin) | (pos[:, axis] > limit - margin)
+            vel[out, axis] *= -1
+            pos[:, axis] = np.clip(pos[:, axis], margin, limit - margin)
+        angle = (angle + spin) % 360
+    return pd.DataFrame(rows, columns=['frame', 'ID', 'centroidX', 'centroidY', 'angle'])
+
+
+def make_background(width, height, seed=0):
+    '''smooth random texture, a stand-in for the nest and brood'''
+    rng = np.random.default_rng(seed)
+    small = rng.uniform(60, 190, size=(height // 64 + 1, width // 64 + 1)).astype(np.float32)
+    return cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+
+
+def render_frame(background, tags, marker_images, blur=0.0, noise=0.0, rng=None):
+    '''draw every tag of one frame onto the background at its sub-pixel position and rotation'''
+    frame = background.copy()
+    height, width = frame.shape
+    for tag in tags.itertuples():
+        marker = marker_images[tag.ID]
+        m = marker.shape[0]
+        patch_size = int(np.ceil(m * np.sqrt(2))) + 4
+        x0 = int(np.floor(tag.centroidX)) - patch_size // 2
+        y0 = int(np.floor(tag.centroidY)) - patch_size // 2
+        M = cv2.getRotationMatrix2D(((m - 1) / 2, (m - 1) / 2), tag.angle, 1.0)
+        M[0, 2] += tag.centroidX - x0 - (m - 1) / 2
+        M[1, 2] += tag.centroidY - y0 - (m - 1) / 2
+        patch = cv2.warpAffine(marker, M, (patch_size, patch_size), flags=cv2.INTER_LINEAR)
+        mask = cv2.warpAffine(np.ones_like(marker), M, (patch_size, patch_size), flags=cv2.INTER_LINEAR)
+
+        xs, ys = max(x0, 0), max(y0, 0)
+        xe, ye = min(x0 + patch_size, width), min(y0 + patch_size, height)
+        region = frame[ys:ye, xs:xe]
+        p = patch[ys - y0:ye - y0, xs - x0:xe - x0]
+        a = mask[ys - y0:ye - y0, xs - x0:xe - x0]
+        region[:] = region * (1 - a) + p * a
+
+    if blur > 0:
+        frame = cv2.GaussianBlur(frame, (0, 0), blur)
+    if noise > 0:
+        frame += rng.normal(0, noise, size=frame.shape).astype(np.float32)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def render_frames(truth, args):
+    '''yield the rendered grayscale frames of the benchmark in order'''
+    dictionary = get_tag_dictionary(args.dictionary)
+    quiet_zone = max(args.marker_size // 6, 2)
+    marker_images = {}
+    for tag in truth['ID'].unique():
+        marker = cv2.aruco.generateImageMarker(dictionary, int(tag), args.marker_size)
+        marker_images[tag] = cv2.copyMakeBorder(marker, quiet_zone, quiet_zone, quiet_zone, quiet_zone, cv2.BORDER_CONSTANT, value=255).astype(np.float32)
+
+    background = make_background(args.width, args.height, args.seed)
+    rng = np.random.default_rng(args.seed + 1)
+    for frame, tags in truth.groupby('frame'):
+        yield render_frame(background, tags, marker_images, args.blur, args.noise, rng)
+
+
+def to_yuv420(gray):
+    '''a YUV420 (I420) frame with the given luma and neutral chroma, like picamera2 captures'''
+    height, width = gray.shape
+    chroma = np.full((height // 2, width), 128, dtype=np.uint8)
+    return np.vstack([gray, chroma])
+
+
+def write_mjpeg(path, truth, args):
+    '''encode the rendered frames as an mjpeg file, one jpeg after another like picamera2's JpegEncoder'''
+    with open(path, 'wb') as f:
+        for gray in render_frames(truth, args):
+            f.write(cv2.imencode('.jpg', gray, [cv2.IMWRITE_JPEG_QUALITY, args.quality])[1].tobytes())
+
+
+def run_mode(mode, truth, mjpeg_path, args):
+    '''run one tracking mode in this (fresh) process and return its detections, frame count, run time and peak memory'''
+    codec = 'mp4' if mode.startswith('mp4') else 'mjpeg'
+    detector = create_detector(args.dictionary, args.box_type, codec)
+
+    if mode == 'mp4':
+        frames_list = [[to_yuv420(gray)] for gray in render_frames(truth, args)]
+    elif mode == 'mp4-luma':
+        frames_list = LumaRingBuffer(truth['frame'].nunique(), args.height, args.width)
+        for gray in render_frames(truth, args):
+            frames_list.append(to_yuv420(gray))
+
+    start = time.time()
+    if codec == 'mp4':
+        raw, noID, frame_num = track_frames(frames_list, 'benchmark', '00', '_benchmark', detector, verbose=False)
+    elif mode == 'mjpeg':
+        raw, noID, frame_num = track_video(mjpeg_path, 'benchmark', '00', '_benchmark', detector, verbose=False)
+    elif mode == 'mjpeg-gated':
+        gated = MotionGatedDetector(detector, padding=args.marker_size * 2)
+        raw, noID, frame_num = track_mjpeg(mjpeg_path, 'benchmark', '00', '_benchmark', gated, verbose=False)
+        print(f"{mode}: skipped {round(gated.skipped_fraction * 100, 1)}% of pixels")
+    else:
+        reduction = int(mode[len('mjpeg-gray'):] or 1)
+        raw, noID, frame_num = track_mjpeg(mjpeg_path, 'benchmark', '00', '_benchmark', detector, reduction, verbose=False)
+    seconds = time.time() - start
+
+    return raw.to_dataframe(), frame_num, seconds, peak_memory_mb()
+
+
+def score(truth, detections, max_error):
+    '''recall and mean centroid error of the detections against the rendered tag positions'''
+    matched = truth.merge(detections[['frame', 'ID', 'centroidX', 'centroidY']], on=['frame', 'ID'], how='left', suffixes=('', '_found'))
+    error = np.hypot(matched['centroidX'] - matched['centroidX_found'], matched['centroidY'] - matched['centroidY_found'])
+    found = error <= max_error
+    recall = found.sum() / len(truth)
+    wrong = len(detections) - found.sum()
+    return recall, error[found].mean(), wrong
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Benchmark tag tracking speed and accuracy on synthetic nest frames')
+    parser.add_argument('-m', '--modes', type=str, default=','.join(MODES), help='comma separated list of tracking modes to run, from: ' + ', '.join(MODES))
+    parser.add_argument('-f', '--frames', type=int, default=20, help='number of frames to render')
+    parser.add_argument('-n', '--markers', type=int, default=30, help='number of tagged bees')
+    parser.add_argument('-s', '--marker_size', type=int, default=60, help='side length of the tags in pixels')
+    parser.add_argument('-bl', '--blur', type=float, default=1.0, help='sigma of the gaussian blur applied to each frame, in pixels')
+    parser.add_argument('-no', '--noise', type=float, default=4.0, help='standard deviation of the gaussian noise added to each frame')
+    parser.add_argument('-w', '--width', type=int, default=4056, help='frame width in pixels')
+    parser.add_argument('-ht', '--height', type=int, default=3040, help='frame height in pixels')
+    parser.add_argument('-q', '--quality', type=int, default=95, help='jpeg quality of the mjpeg video')
+    parser.add_argument('-d', '--dictionary', type=str, default='4X4_50', help='aruco tag dictionary')
+    parser.add_argument('-b', '--box_type', type=str, default='custom', choices=['custom', 'koppert'], help='preset tracking parameters to use')
+    parser.add_argument('-st', '--still', type=float, default=0.0, help='fraction of the bees that do not move')
+    parser.add_argument('-e', '--max_error', type=float, default=5.0, help='a detection more than this many pixels from the true centroid does not count as found')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the trajectories and the noise')
+    parser.add_argument('-o', '--output', type=str, default=None, help='also save the results to this csv file')
+    args = parser.parse_args()
+
+    modes = [m.strip() for m in args.modes.split(',') if m.strip()]
+    unknown = [m for m in modes if m not in MODES]
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(unknown)}")
+
+    truth = make_trajectories(args.frames, args.markers, args.width, args.height, args.marker_size, args.seed, args.still)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mjpeg_path = os.path.join(tmpdir, 'benchmark.mjpeg')
+        if any(m.startswith('mjpeg') for m in modes):
+            print(f"rendering {args.frames} frames to {mjpeg_path}")
+            write_mjpeg(mjpeg_path, truth, args)
+
+        for mode in modes:
+            '''each mode runs in its own fresh process so its peak memory is measured on its own'''
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                detections, frame_num, seconds, peak = pool.submit(run_mode, mode, truth, mjpeg_path, args).result()
+            recall, error, wrong = score(truth, detections, args.max_error)
+            results.append({'mode': mode, 'frames': frame_num, 'seconds': round(seconds, 3), 'frames_per_sec': round(frame_num / seconds, 2), 'recall': round(recall, 4), 'centroid_error_px': round(error, 3), 'wrong_detections': int(wrong), 'peak_memory_mb': round(peak, 1)})
+            print(f"{mode}: {results[-1]['frames_per_sec']} frames/sec, recall {results[-1]['recall']}, centroid error {results[-1]['centroid_error_px']} px, peak memory {results[-1]['peak_memory_mb']} MB")
+
+    results = pd.DataFrame(results)
+    print()
+    print(results.to_string(index=False))
+    if args.output:
+        results.to_csv(args.output, index=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
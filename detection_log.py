@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+'''
+Compact binary log of tag detections, one file per colony per day, in place of a _raw.csv and a _noID.csv file for
+every recording. Each recording (clip) is appended as a json header with its filename, colony number and datetime,
+followed by fixed size records (frame, ID, centroid and front point) for all of its detections. Rejected candidates
+(the _noID rows) have an ID of -1. The filename, colony number and datetime are only stored once per clip.
+
+Reading the log gives the same DataFrames as the csv files, for one clip or all clips in a time range, and
+export_csvs writes the legacy _raw.csv and _noID.csv files from it:
+
+    python3 detection_log.py -s /mnt/bumblebox/data/2024-06-20/bumblebox-01_2024-06-20.detections -o csv_folder
+'''
+
+import argparse
+import glob
+import json
+import os
+import struct
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from tag_tracking import TRACKING_COLUMNS, write_tracking_csvs
+
+MAGIC = b'BBDL'
+VERSION = 1
+'''one detection, 24 bytes'''
+RECORD_DTYPE = np.dtype([('frame', '<i4'), ('ID', '<i4'), ('centroidX', '<f4'), ('centroidY', '<f4'), ('frontX', '<f4'), ('frontY', '<f4')])
+NO_ID = -1
+DATETIME_FORMAT = '_%Y-%m-%d_%H_%M_%S'
+
+
+def log_path(folder, filename):
+    '''the log a recording is appended to: <hostname>_<date>.detections in folder, for a filename like bumblebox-01_2024-06-20_18_25_30'''
+    hostname, _, timestamp = filename.partition('_')
+    return os.path.join(folder, hostname + '_' + timestamp[:10] + '.detections')
+
+
+def records_from_detections(raw, noID):
+    '''one record array from the identified and rejected DetectionRecords (see tag_tracking.py) of a clip'''
+    records = np.empty(len(raw) + len(noID), dtype=RECORD_DTYPE)
+    for start, detections, identified in ((0, raw, True), (len(raw), noID, False)):
+        end = start + len(detections)
+        records['frame'][start:end] = detections.frame[:len(detections)]
+        records['ID'][start:end] = detections.ids[:len(detections)] if identified else NO_ID
+        for i, column in enumerate(('centroidX', 'centroidY', 'frontX', 'frontY')):
+            records[column][start:end] = detections.coords[:len(detections), i]
+    return records
+
+
+def append_clip(path, filename, colony_number, now, records, frames=None):
+    '''
+    append one clip to the log at path, creating it if needed. records is a RECORD_DTYPE array (see
+    records_from_detections), now the datetime string of the recording like _2024-06-20_18_25_30. The clip is written
+    with a single write and synced to disk, so a power cut can at worst leave a truncated last clip, which readers skip
+    '''
+    header = json.dumps({
+        'version': VERSION,
+        'filename': filename,
+        'colony number': colony_number,
+        'datetime': now,
+        'frames': frames,
+        'records': len(records),
+    }).encode()
+    data = MAGIC + struct.pack('<I', len(header)) + header + np.ascontiguousarray(records, dtype=RECORD_DTYPE).tobytes()
+    if os.path.exists(path):
+        end = valid_length(path)
+        if end < os.path.getsize(path):
+            '''cut off a clip that was only partly written, otherwise the clips after it could not be read'''
+            os.truncate(path, end)
+    with open(path, 'ab') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return path
+
+
+def valid_length(path):
+    '''the number of bytes at the start of the log that hold complete clips'''
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        offset = 0
+        while offset < size:
+            f.seek(offset)
+            start = f.read(8)
+            if len(start) < 8 or start[:4] != MAGIC:
+                break
+            header_length = struct.unpack('<I', start[4:])[0]
+            try:
+                header = json.loads(f.read(header_length))
+            except ValueError:
+                break
+            end = offset + 8 + header_length + header['records'] * RECORD_DTYPE.itemsize
+            if end > size:
+                break
+            offset = end
+    return offset
+
+
+def write_detections(folder, filename, colony_number, now, raw, noID, frames=None):
+    '''append the DetectionRecords of one recording to the colony's log for the day, returns the log path'''
+    return append_clip(log_path(folder, filename), filename, colony_number, now, records_from_detections(raw, noID), frames)
+
+
+def iter_clips(path, read_records=True, end=None):
+    '''
+    yield (header, records) for every clip in the log, in the order they were written. The records are read with a
+    memory map, so skipping clips is cheap; with read_records=False only the headers are read and records is None.
+    With end, only the first end bytes are read (see valid_length)
+    '''
+    size = os.path.getsize(path) if end is None else end
+    data = np.memmap(path, dtype=np.uint8, mode='r') if read_records and size > 0 else None
+    with open(path, 'rb') as f:
+        offset = 0
+        while offset < size:
+            f.seek(offset)
+            start = f.read(8)
+            if len(start) < 8 or start[:4] != MAGIC:
+                print(f"{path}: stopped reading at byte {offset}, the rest of the file is not a valid clip")
+                return
+            header_length = struct.unpack('<I', start[4:])[0]
+            try:
+                header = json.loads(f.read(header_length))
+            except ValueError:
+                print(f"{path}: the last clip is cut off in its header, skipping it")
+                return
+            records_start = offset + 8 + header_length
+            records_end = records_start + header['records'] * RECORD_DTYPE.itemsize
+            if records_end > size:
+                print(f"{path}: the last clip ({header['filename']}) is incomplete, skipping it")
+                return
+            records = data[records_start:records_end].view(RECORD_DTYPE) if read_records else None
+            yield header, records
+            offset = records_end
+
+
+def has_clip(path, filename):
+    '''
+    True if the log at path already holds the clip called filename. Only complete clips are read, so a clip left half
+    written by a crash or a stopped tracking job (which append_clip cuts off on the next write) is never looked at
+    '''
+    if not os.path.exists(path):
+        return False
+    return any(header['filename'] == filename for header, _ in iter_clips(path, read_records=False, end=valid_length(path)))
+
+
+def clip_dataframes(header, records):
+    '''the (_raw, _noID) DataFrames of one clip, with the same columns as the csv files'''
+    dataframes = []
+    for identified in (True, False):
+        selected = records[(records['ID'] != NO_ID) == identified]
+        n = len(selected)
+        dataframes.append(pd.DataFrame({
+            'filename': np.full(n, header['filename'], dtype=object),
+            'colony number': np.full(n, header['colony number'], dtype=object),
+            'datetime': np.full(n, header['datetime'], dtype=object),
+            'frame': selected['frame'].astype(np.int32),
+            'ID': selected['ID'].astype(np.int32) if identified else np.full(n, 'X', dtype=object),
+            'centroidX': selected['centroidX'].astype(np.float64),
+            'centroidY': selected['centroidY'].astype(np.float64),
+            'frontX': selected['frontX'].astype(np.float64),
+            'frontY': selected['frontY'].astype(np.float64),
+        }, columns=TRACKING_COLUMNS))
+    return dataframes[0], dataframes[1]
+
+
+def read_clip(path, filename):
+    '''the (_raw, _noID) DataFrames of the clip called filename in the log at path'''
+    for header, records in iter_clips(path):
+        if header['filename'] == filename:
+            return clip_dataframes(header, records)
+    raise KeyError(f"{filename} is not in {path}")
+
+
+def clip_time(header):
+    return datetime.strptime(header['datetime'], DATETIME_FORMAT)
+
+
+def read_range(paths, start=None, end=None, identified=True):
+    '''
+    yield the DataFrame of every clip recorded between start and end (datetimes, None for no limit) in the given logs.
+    paths is a log file, a folder (searched recursively for .detections files) or a list of either. identified=False
+    gives the rejected (_noID) detections instead
+    '''
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '**', '*.detections'), recursive=True)))
+        else:
+            files.append(path)
+
+    for path in files:
+        for header, records in iter_clips(path):
+            recorded = clip_time(header)
+            if (start is not None and recorded < start) or (end is not None and recorded > end):
+                continue
+            yield clip_dataframes(header, records)[0 if identified else 1]
+
+
+def export_csvs(path, folder, filenames=None):
+    '''write the legacy _raw.csv and _noID.csv files of every clip in the log (or only those in filenames) to folder'''
+    os.makedirs(folder, exist_ok=True)
+    written = []
+    for header, records in iter_clips(path):
+        if filenames is not None and header['filename'] not in filenames:
+            continue
+        df, df2 = clip_dataframes(header, records)
+        written.extend(write_tracking_csvs(df, df2, folder, header['filename']))
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='List the clips in a detection log or export them to _raw.csv and _noID.csv files')
+    parser.add_argument('-s', '--source', type=str, required=True, help='.detections log file')
+    parser.add_argument('-o', '--output', type=str, default=None, help='folder to write the csv files to. If not given, the clips in the log are listed')
+    parser.add_argument('-c', '--clips', type=str, nargs='+', default=None, help='only export these clips (recording filenames without extension)')
+    args = parser.parse_args()
+
+    if args.output is None:
+        for header, records in iter_clips(args.source):
+            tagged = int((records['ID'] != NO_ID).sum())
+            print(f"{header['filename']}: {header['frames']} frames, {tagged} tag detections, {len(records) - tagged} rejected candidates")
+        return 0
+
+    written = export_csvs(args.source, args.output, args.clips)
+    print(f"wrote {len(written)} csv files to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
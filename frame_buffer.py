@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+'''
+Preallocated storage for frames captured by picam2_record_mp4. Tag tracking only needs the luma (Y) plane of each
+YUV420 frame, which is 2/3 of its size, so LumaRingBuffer copies just that plane into one array allocated before the
+capture starts, instead of keeping a new full YUV420 array per frame.
+'''
+
+import os
+import numpy as np
+
+
+class LumaRingBuffer:
+    '''
+    Fixed size buffer of capacity grayscale frames of height x width pixels. When more than capacity frames are
+    appended the oldest are overwritten. If path is given, the buffer is a memory-mapped file at that path instead of
+    RAM, which is useful for long clips; the file is deleted by close().
+    '''
+
+    def __init__(self, capacity, height, width, path=None):
+        self.capacity = capacity
+        self.height = height
+        self.width = width
+        self.path = path
+        self.count = 0 #total number of frames appended, including overwritten ones
+        if path is None:
+            self.frames = np.empty((capacity, height, width), dtype=np.uint8)
+        else:
+            self.frames = np.memmap(path, dtype=np.uint8, mode='w+', shape=(capacity, height, width))
+
+    def append(self, yuv420):
+        '''copy the Y plane of a YUV420 frame (the first height rows, cropped to width) into the next slot'''
+        np.copyto(self.frames[self.count % self.capacity], yuv420[:self.height, :self.width])
+        self.count += 1
+
+    @property
+    def overwritten(self):
+        '''number of frames that were lost because the buffer was full'''
+        return max(self.count - self.capacity, 0)
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def __getitem__(self, index):
+        '''frame number index counting from the oldest frame still in the buffer'''
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("frame %s is not in the buffer" % index)
+        return self.frames[(self.overwritten + index) % self.capacity]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def close(self):
+        '''release the buffer, deleting the memory-mapped file if there is one'''
+        if self.path is not None:
+            self.frames._mmap.close()
+            os.remove(self.path)
+        self.frames = None
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+'''
+Fill short gaps in tag trajectories. Used by runMe.restructure_tracking_data (gaps of up to 2 frames) and by
+record_video.py and tracking_queue.py (gaps of up to max_seconds_gap seconds, see setup.py), so both fill gaps the
+same way.
+
+Trajectories are dense arrays with one row per frame and one column per tag (and coordinate), with NaN where a tag
+was not found. The length of every run of NaNs is found with run-length encoding, and only runs no longer than the
+limit are filled, either linearly between the positions on each side or with the nearest of the two.
+'''
+
+import numpy as np
+import pandas as pd
+
+METHODS = ('linear', 'nearest')
+
+
+def gap_lengths(missing):
+    '''
+    for a boolean (frames, columns) array, the length of the run of True values each element is part of (0 where
+    False). Runs are found for all columns at once from where the padded array changes value
+    '''
+    frames, columns = missing.shape
+    padded = np.zeros((columns, frames + 2), dtype=np.int8)
+    padded[:, 1:-1] = missing.T
+    change = np.diff(padded, axis=1)
+    start_col, start = np.nonzero(change == 1)
+    end_col, end = np.nonzero(change == -1) #both in row-major order, so the nth start and nth end belong to the same run
+    length = end - start
+
+    '''spread each run's length over its frames with a cumulative sum of +length at the start and -length at the end (runs never touch, so no two of these land on the same element)'''
+    spread = np.zeros((columns, frames + 1), dtype=np.int64)
+    spread[start_col, start] = length
+    spread[end_col, end] = -length
+    return np.cumsum(spread, axis=1)[:, :frames].T
+
+
+def max_gap_frames(max_seconds_gap, fps):
+    '''the longest gap in frames that is no longer than max_seconds_gap at fps frames per second'''
+    return int(np.floor(max_seconds_gap * fps))
+
+
+def fill_gaps(values, max_gap, method='linear', fill_edges=False, partial=False):
+    '''
+    return a copy of values (an array with frames along the first axis) with runs of up to max_gap NaN frames filled.
+    Gaps at the start or end of a track have only one side, so they are left alone unless fill_edges is True, in which
+    case those up to max_gap frames long are filled with the first or last position. With partial=True, longer gaps
+    also get the max_gap frames next to each side filled, which is what pandas interpolate(limit=max_gap,
+    limit_direction='both') does
+    '''
+    if method not in METHODS:
+        raise ValueError(f"method must be one of {METHODS}, not {method}")
+    values = np.asarray(values, dtype=np.float64)
+    shape = values.shape
+    values = values.reshape(shape[0], -1)
+    frames = shape[0]
+    if frames == 0:
+        return values.reshape(shape).copy()
+
+    missing = np.isnan(values)
+    index = np.arange(frames)[:, None]
+    previous = np.maximum.accumulate(np.where(missing, -1, index), axis=0)
+    following = np.minimum.accumulate(np.where(missing, frames, index)[::-1], axis=0)[::-1]
+
+    has_previous = previous >= 0
+    has_following = following < frames
+    fill = missing & (gap_lengths(missing) <= max_gap)
+    if partial:
+        fill |= missing & ((has_previous & (index - previous <= max_gap)) | (has_following & (following - index <= max_gap)))
+    inside = fill & has_previous & has_following
+    edge = fill & (has_previous != has_following) if fill_edges else np.zeros_like(fill)
+
+    before = np.take_along_axis(values, np.clip(previous, 0, frames - 1), axis=0)
+    after = np.take_along_axis(values, np.clip(following, 0, frames - 1), axis=0)
+    if method == 'linear':
+        weight = (index - previous) / np.maximum(following - previous, 1)
+        filled = before + (after - before) * weight
+    else:
+        filled = np.where(index - previous <= following - index, before, after)
+
+    result = values.copy()
+    result[inside] = filled[inside]
+    result[edge] = np.where(has_previous, before, after)[edge]
+    return result.reshape(shape)
+
+
+def interpolate_tracks(df, max_seconds_gap, fps, method='linear', columns=('centroidX', 'centroidY', 'frontX', 'frontY')):
+    '''
+    fill gaps of up to max_seconds_gap seconds in the tracks of a _raw.csv style DataFrame (one row per tag per frame).
+    Returns the DataFrame with a row added for every filled frame, sorted by frame and ID, and an "interpolated"
+    column that is True for the added rows
+    '''
+    df = df.drop_duplicates(subset=['ID', 'frame'])
+    if df.empty:
+        return df.assign(interpolated=pd.Series(dtype=bool))
+    first = df['frame'].min()
+    frames = df['frame'].max() - first + 1
+    ids, tag = np.unique(df['ID'].to_numpy(), return_inverse=True)
+    row = df['frame'].to_numpy() - first
+
+    tracks = np.full((frames, len(ids), len(columns)), np.nan)
+    tracks[row, tag] = df[list(columns)].to_numpy(dtype=np.float64)
+    filled = fill_gaps(tracks, max_gap_frames(max_seconds_gap, fps), method)
+
+    added_row, added_tag = np.nonzero(np.isnan(tracks[:, :, 0]) & ~np.isnan(filled[:, :, 0]))
+    added = pd.DataFrame(filled[added_row, added_tag], columns=list(columns))
+    added['frame'] = added_row + first
+    added['ID'] = ids[added_tag]
+    for column in df.columns.difference(added.columns):
+        added[column] = df[column].iloc[0] #filename, colony number and datetime are the same for the whole video
+    added['interpolated'] = True
+
+    df = df.assign(interpolated=False)
+    return pd.concat([df, added[df.columns]], ignore_index=True).sort_values(['frame', 'ID'], kind='stable', ignore_index=True)
@@ -1,8 +1,5 @@
-import cv2
 import os
-import dask.array as da
 import glob
-import random
 import datetime
 import socket
 import argparse
@@ -10,6 +7,9 @@ import sys
 import logging
 import time
 
+import nest_composite
+from nest_composite import BACKENDS
+
 # --- Configuration ---
 DEFAULT_BASE_IMAGE_PATH = "/Volumes/googledrive_bombus2/ggm_fanning_2025/round1"
 DEFAULT_NUM_IMAGES = 10
@@ -27,46 +27,9 @@ def create_folder_if_needed(path):
         os.makedirs(path, exist_ok=True)
     return path
 
-def generate_nest_image(image_folder, number_of_images, hostname, date_str, output_folder, shuffle=True):
-    image_paths = glob.glob(os.path.join(image_folder, '*.png'))
-    if len(image_paths) == 0:
-        logger.warning(f"No PNG images found in {image_folder}")
-        return 0
-
-    if shuffle:
-        random.shuffle(image_paths)
-
-    total_frames = min(len(image_paths), number_of_images)
-    image_paths = image_paths[:total_frames]
-
-    print(f"Generating composite image for {image_folder} using {total_frames} images")
-
-    imgdata = cv2.imread(image_paths[0])
-gray_img = cv2.cvtColor(imgdata, cv2.COLOR_RGB2GRAY)
-h, w = gray_img.shape
-x = da.zeros((total_frames, h, w), dtype='uint8')
-
-for idx, img_path in enumerate(image_paths):
-    img = cv2.imread(img_path)
-    if img is None:
-        print(f"Warning: Could not load image {img_path}, skipping.")
-        continue
-    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-    if gray.shape != (h, w):
-        gray = cv2.resize(gray, (w, h))
-    x[idx] = gray
-
-median_img = da.median(x, axis=0).compute()
-
-create_folder_if_needed(output_folder)
-
-    filename = f"{hostname}-{date_str}-nest_image.png"
-    output_path = os.path.join(output_folder, filename)
-    cv2.imwrite(output_path, median_img)
-
-    print(f"Saved composite image to: {output_path}")
-    logger.info(f"Composite image created at {output_path} using {total_frames} images.")
-    return total_frames
+def generate_nest_image(image_folder, number_of_images, hostname, date_str, output_folder, shuffle=True, backend='histogram', workers=1, threads=4, mask_radius=0, scratch=None):
+    output_path = os.path.join(output_folder, f"{hostname}-{date_str}-nest_image.png")
+    return nest_composite.generate_nest_image(image_folder, [output_path], number_of_images, shuffle, backend, workers, threads, mask_radius, scratch=scratch)
 
 def main():
     start_time = time.time()
@@ -77,6 +40,15 @@ def main():
     parser.add_argument('-n', '--number_of_images', type=int, default=DEFAULT_NUM_IMAGES,
                         help='Number of images to use per composite image.')
     parser.add_argument('--shuffle', type=bool, default=True, help='Shuffle images before processing.')
+    parser.add_argument('--backend', type=str, default='histogram', choices=BACKENDS,
+                        help='How the median is computed: a streaming histogram (constant memory), or all images in memory with numpy or dask.')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of processes computing the composite, each working on a band of rows.')
+    parser.add_argument('--scratch', type=str, default=None,
+                        help='Folder for the temporary stack of decoded images when -w is more than 1 (number of images x image size on disk). Defaults to the system temp folder.')
+    parser.add_argument('-t', '--threads', type=int, default=4, help='Number of threads reading and decoding images.')
+    parser.add_argument('-r', '--mask_radius', type=int, default=0,
+                        help='Leave out the pixels within this many pixels of every tag found in each image (from its _raw.csv). 0 uses whole images.')
 
     args = parser.parse_args()
     base_path = args.base_path
@@ -116,7 +88,7 @@ def main():
             output_folder = os.path.join(nest_images_root, date_str)
             create_folder_if_needed(output_folder)
 
-            images_used = generate_nest_image(date_folder, num_images, hostname, date_str, output_folder, shuffle)
+            images_used = generate_nest_image(date_folder, num_images, hostname, date_str, output_folder, shuffle, args.backend, args.workers, args.threads, args.mask_radius, args.scratch)
             if images_used > 0:
                 total_images_processed += images_used
                 total_composites += 1
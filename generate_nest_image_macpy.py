@@ -1,8 +1,5 @@
-import cv2
 import os
-import dask.array as da
 import glob
-import random
 import datetime
 import socket
 import argparse
@@ -10,6 +7,9 @@ import sys
 import logging
 import time
 
+import nest_composite
+from nest_composite import BACKENDS
+
 # --- Configuration ---
 DEFAULT_BASE_IMAGE_PATH = "/Volumes/googledrive_bombus2/ggm_fanning_2025/round1"
 DEFAULT_NUM_IMAGES = 10
@@ -23,12 +23,20 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 # --- Utility functions ---
+def is_date_format(folder_name):
+    try:
+        datetime.datetime.strptime(folder_name, "%Y-%m-%d")
+        return True
+    except ValueError:
+        return False
+
 def find_latest_image_folder(base_path):
     all_subdirs = glob.glob(os.path.join(base_path, '*', '*'))  # e.g., round1/mc1_2/2025-07-03
     candidate_folders = []
 
     for path in all_subdirs:
-        if glob.glob(os.path.join(path, '*.png')):
+        # only date folders, not "Nest Images" where the composites are saved
+        if is_date_format(os.path.basename(path)) and glob.glob(os.path.join(path, '*.png')):
             candidate_folders.append(path)
 
     if not candidate_folders:
@@ -48,63 +56,9 @@ def create_nest_images_folder(mc_folder):
     os.makedirs(nest_folder, exist_ok=True)
     return nest_folder
 
-def generate_nest_image(image_folder, number_of_images, hostname, date_str, output_folder, shuffle=True):
-    image_paths = glob.glob(os.path.join(image_folder, '*.png'))
-    if len(image_paths) == 0:
-        logger.warning(f"No PNG images found in {image_folder}")
-        return 0
-
-    if shuffle:
-        random.shuffle(image_paths)
-
-    total_frames = min(len(image_paths), number_of_images)
-    image_paths = image_paths[:total_frames]
-
-    print(f"Generating composite image for {image_folder} using {total_frames} images")
-
-    # Load first valid image to get dimensions
-    first_img = None
-    for p in image_paths:
-        img = cv2.imread(p)
-        if img is not None:
-            first_img = img
-            break
-
-    if first_img is None:
-        print(f"Error: None of the images in {image_folder} could be loaded.")
-        return 0
-
-    gray_img = cv2.cvtColor(first_img, cv2.COLOR_RGB2GRAY)
-    h, w = gray_img.shape
-    x = da.zeros((total_frames, h, w), dtype='uint8')
-
-    valid_img_count = 0
-    for idx, img_path in enumerate(image_paths):
-        img = cv2.imread(img_path)
-        if img is None:
-            print(f"Warning: Could not load image {img_path}, skipping.")
-            continue
-        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-        if gray.shape != (h, w):
-            gray = cv2.resize(gray, (w, h))
-        x[valid_img_count] = gray
-        valid_img_count += 1
-
-    if valid_img_count == 0:
-        print(f"No valid images found to create composite in {image_folder}")
-        return 0
-
-    median_img = da.median(x[:valid_img_count], axis=0).compute()
-
-    create_folder_if_needed(output_folder)
-
-    filename = f"{hostname}-{date_str}-nest_image.png"
-    output_path = os.path.join(output_folder, filename)
-    cv2.imwrite(output_path, median_img)
-
-    print(f"Saved composite image to: {output_path}")
-    logger.info(f"Composite image created at {output_path} using {valid_img_count} images.")
-    return valid_img_count
+def generate_nest_image(image_folder, number_of_images, hostname, date_str, output_folder, shuffle=True, backend='histogram', workers=1, threads=4, mask_radius=0, scratch=None):
+    output_path = os.path.join(output_folder, f"{hostname}-{date_str}-nest_image.png")
+    return nest_composite.generate_nest_image(image_folder, [output_path], number_of_images, shuffle, backend, workers, threads, mask_radius, scratch=scratch)
 
 
 # --- Main ---
@@ -117,6 +71,15 @@ def main():
     parser.add_argument('-n', '--number_of_images', type=int, default=DEFAULT_NUM_IMAGES,
                         help='Number of images to use in the composite.')
     parser.add_argument('--shuffle', type=bool, default=True, help='Shuffle images before processing.')
+    parser.add_argument('--backend', type=str, default='histogram', choices=BACKENDS,
+                        help='How the median is computed: a streaming histogram (constant memory), or all images in memory with numpy or dask.')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of processes computing the composite, each working on a band of rows.')
+    parser.add_argument('--scratch', type=str, default=None,
+                        help='Folder for the temporary stack of decoded images when -w is more than 1 (number of images x image size on disk). Defaults to the system temp folder.')
+    parser.add_argument('-t', '--threads', type=int, default=4, help='Number of threads reading and decoding images.')
+    parser.add_argument('-r', '--mask_radius', type=int, default=0,
+                        help='Leave out the pixels within this many pixels of every tag found in each image (from its _raw.csv). 0 uses whole images.')
 
     args = parser.parse_args()
 
@@ -129,7 +92,10 @@ def main():
         logger.error(f"Failed to find image folder: {e}")
         sys.exit(1)
 
-    total_frames = generate_nest_image(image_folder, args.number_of_images, hostname, shuffle=args.shuffle)
+    date_str = os.path.basename(image_folder)
+    output_folder = create_nest_images_folder(extract_mc_folder(image_folder))
+    total_frames = generate_nest_image(image_folder, args.number_of_images, hostname, date_str, output_folder, shuffle=args.shuffle,
+                                       backend=args.backend, workers=args.workers, threads=args.threads, mask_radius=args.mask_radius, scratch=args.scratch)
 
     duration = round(time.time() - start_time, 2)
     print(f"Finished. Processed {total_frames} images in {duration} seconds.")
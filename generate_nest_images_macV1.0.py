@@ -1,14 +1,15 @@
-import cv2
 import os
-import dask.array as da
-import glob
-import random
 import datetime
 import socket
 import argparse
+import csv
 import sys
 import logging
 import time
+from multiprocessing import Pool
+
+import nest_composite
+from nest_composite import BACKENDS, composite_memory, find_inputs, image_shape
 
 # ---- CONFIG ----
 DEFAULT_DATA_FOLDER_PATH = os.path.expanduser("~/bumblebox_data")
@@ -50,44 +51,92 @@ def make_nest_images_dir(base_path):
         print(f"Failed to make nest image directory: {e}")
         return 1, nest_dir
 
-def generate_nest_image(todays_folder_path, today, number_of_images, hostname, shuffle=True):
+def generate_nest_image(todays_folder_path, today, number_of_images, hostname, shuffle=True, workers=1, threads=4, mask_radius=0, from_videos=False, backend='histogram', scratch=None):
+    # the composite itself is made by nest_composite.generate_nest_image, this script only decides where it is saved
     ret, nestpath = make_nest_images_dir(os.path.dirname(todays_folder_path))
-    files = glob.glob(f"{todays_folder_path}/*.png")
-    if shuffle:
-        random.shuffle(files)
-    
-    files = files[:number_of_images]
-    if not files:
-        print("No PNG files found.")
-        return 0
-
-    print(f"Using {len(files)} images for composite.")
-
-    imgdata = cv2.imread(files[0])
-    gray_img = cv2.cvtColor(imgdata, cv2.COLOR_BGR2GRAY)
-
-    h, w = gray_img.shape
-    x = da.zeros((len(files), h, w), dtype='uint8')
-
-    for index, file in enumerate(files):
-        try:
-            imgdata = cv2.imread(file)
-            gray_img = cv2.cvtColor(imgdata, cv2.COLOR_BGR2GRAY)
-            gray_img = cv2.resize(gray_img, (w, h))  # Ensure uniform size
-            x[index] = gray_img
-        except Exception as e:
-            print(f"Error reading {file}: {e}")
-
-    composite = da.median(x, axis=0).compute()
     out_path_1 = os.path.join(todays_folder_path, f"{hostname}-{today}_nest_image.png")
     out_path_2 = os.path.join(nestpath, f"{hostname}-{today}_nest_image.png")
+    return nest_composite.generate_nest_image(todays_folder_path, [out_path_1, out_path_2], number_of_images, shuffle, backend, workers, threads, mask_radius, from_videos, scratch)
+
+def composite_is_current(full_path, date_folder, hostname, pngs):
+    # the composite is up to date if it was written after the newest image of the day
+    composite = os.path.join(full_path, f"{hostname}-{date_folder}_nest_image.png")
+    return os.path.exists(composite) and os.path.getmtime(composite) > max(os.path.getmtime(f) for f in pngs)
+
+def composite_day(job):
+    # make the composite of one date folder and return a row of the season summary. Runs in a pool worker in batch mode
+    full_path, date_folder, number_of_images, shuffle, workers, threads, mask_radius, from_videos, backend, scratch, force = job
+    row = {'date': date_folder, 'hostname': '', 'images_found': 0, 'images_used': 0, 'seconds': 0.0, 'status': ''}
+    start = time.time()
+
+    pngs = find_inputs(full_path, from_videos)
+    row['images_found'] = len(pngs)
+    if not pngs:
+        print(f"⚠️ No PNG files in {full_path}, skipping.")
+        row['status'] = 'no images'
+        return row
+
+    first_filename = os.path.basename(pngs[0])
+    extracted_hostname = first_filename.split("_")[0]
+    row['hostname'] = extracted_hostname
+
+    if not force and composite_is_current(full_path, date_folder, extracted_hostname, pngs):
+        print(f"⏭️ {date_folder}: composite is newer than all its images, skipping.")
+        row['status'] = 'up to date'
+        return row
+
+    try:
+        row['images_used'] = generate_nest_image(
+            todays_folder_path=full_path,
+            today=date_folder,
+            number_of_images=number_of_images,
+            hostname=extracted_hostname,
+            shuffle=shuffle,
+            workers=workers,
+            threads=threads,
+            mask_radius=mask_radius,
+            from_videos=from_videos,
+            backend=backend,
+            scratch=scratch
+        )
+        row['status'] = 'made' if row['images_used'] > 0 else 'unreadable images'
+        print(f"✅ Done: {row['images_used']} frames used for {date_folder}")
+    except Exception as e:
+        print(f"❌ Error processing {date_folder}: {e}")
+        logger.error(f"Nest image for {date_folder} failed: {e}")
+        row['status'] = f"failed: {e}"
+    row['seconds'] = round(time.time() - start, 2)
+    return row
+
+def days_at_once(jobs, number_of_images, threads, memory_budget):
+    # how many date folders fit in the memory budget (in MB) at the same time, from the size of each day's first image
+    largest = 0
+    for job in jobs:
+        pngs = [f for f in find_inputs(job[0]) if f.endswith('.png')]
+        shape = image_shape(pngs[0]) if pngs else None
+        if shape is not None:
+            largest = max(largest, composite_memory(shape, number_of_images, threads=threads))
+    if largest == 0:
+        return 1
+    return max(1, int(memory_budget * 2**20 // largest))
 
-    cv2.imwrite(out_path_1, composite)
-    cv2.imwrite(out_path_2, composite)
+def keep_previous_results(rows, path):
+    # days skipped as up to date were not remade this run, so keep the images used and time from the summary of the run that made them
+    if not os.path.exists(path):
+        return rows
+    with open(path, newline='') as f:
+        previous = {row['date']: row for row in csv.DictReader(f)}
+    for row in rows:
+        if row['status'] == 'up to date' and row['date'] in previous:
+            row['images_used'] = previous[row['date']]['images_used']
+            row['seconds'] = previous[row['date']]['seconds']
+    return rows
 
-    print(f"Composite image saved to:\n{out_path_1}\n{out_path_2}")
-    logger.debug(f"Composite image written using {len(files)} images.")
-    return len(files)
+def write_summary(rows, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['date', 'hostname', 'images_found', 'images_used', 'seconds', 'status'])
+        writer.writeheader()
+        writer.writerows(sorted(rows, key=lambda row: row['date']))
 
 # ---- Main ----
 def main():
@@ -114,6 +163,59 @@ def main():
         default=True,
         help='Shuffle images before selection'
     )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of processes computing the composite, each working on a band of rows'
+    )
+    parser.add_argument(
+        '--scratch',
+        type=str,
+        default=None,
+        help='Folder for the temporary stack of decoded images when -w is more than 1 (number of images x image size on disk). Defaults to the system temp folder.'
+    )
+    parser.add_argument(
+        '-t', '--threads',
+        type=int,
+        default=4,
+        help='Number of threads reading and decoding images'
+    )
+    parser.add_argument(
+        '-r', '--mask_radius',
+        type=int,
+        default=0,
+        help='Leave out the pixels within this many pixels of every tag found in each image (from its _raw.csv), so bees are not part of the composite. About the length of a bee works well, 0 to use whole images'
+    )
+    parser.add_argument(
+        '-v', '--from_videos',
+        action='store_true',
+        help='When a date folder has fewer PNG snapshots than --number_of_images, add frames sampled from its .mjpeg and .mp4 videos'
+    )
+    parser.add_argument(
+        '--backend',
+        type=str,
+        default='histogram',
+        choices=BACKENDS,
+        help='How the median is computed: a streaming histogram (constant memory), or all images in memory with numpy or dask'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of date folders to make composites for at the same time (batch mode for a whole season). Each one uses a single process, so -w is ignored when this is more than 1'
+    )
+    parser.add_argument(
+        '-m', '--memory_budget',
+        type=float,
+        default=2048,
+        help='Memory in MB all date folders being processed at once may use together, which can lower --jobs'
+    )
+    parser.add_argument(
+        '-f', '--force',
+        action='store_true',
+        help='Remake composites even if they are newer than all the images of their day'
+    )
     args = parser.parse_args()
 
     parent_folder = os.path.expanduser(args.data_folder_path)
@@ -134,33 +236,25 @@ def main():
         print("No valid date folders found. Exiting.")
         return
 
-    for date_folder in date_folders:
-        full_path = os.path.join(parent_folder, date_folder)
-        print(f"\n🔧 Processing: {full_path}")
-
-        pngs = glob.glob(os.path.join(full_path, "*.png"))
-        if not pngs:
-            print(f"⚠️ No PNG files in {full_path}, skipping.")
-            continue
-
-        first_filename = os.path.basename(pngs[0])
-        try:
-            extracted_hostname = first_filename.split("_")[0]
-        except:
-            print(f"⚠️ Could not extract hostname from filename: {first_filename}, skipping.")
-            continue
-
-        try:
-            total_frames = generate_nest_image(
-                todays_folder_path=full_path,
-                today=date_folder,
-                number_of_images=args.number_of_images,
-                hostname=extracted_hostname,
-                shuffle=args.shuffle
-            )
-            print(f"✅ Done: {total_frames} frames used for {date_folder}")
-        except Exception as e:
-            print(f"❌ Error processing {date_folder}: {e}")
+    workers = 1 if args.jobs > 1 else args.workers  # pool workers can't start pools of their own
+    jobs = [(os.path.join(parent_folder, date_folder), date_folder, args.number_of_images, args.shuffle, workers, args.threads, args.mask_radius, args.from_videos, args.backend, args.scratch, args.force) for date_folder in date_folders]
+    rows = []
+    if args.jobs > 1:
+        processes = min(args.jobs, len(jobs), days_at_once(jobs, args.number_of_images, args.threads, args.memory_budget))
+        print(f"Making composites for {processes} date folders at a time")
+        with Pool(processes) as pool:
+            for row in pool.imap_unordered(composite_day, jobs):
+                rows.append(row)
+                print(f"{row['date']}: {row['status']}, {row['images_used']} images in {row['seconds']} seconds")
+    else:
+        for job in jobs:
+            print(f"\n🔧 Processing: {job[0]}")
+            rows.append(composite_day(job))
+
+    ret, nestpath = make_nest_images_dir(parent_folder)
+    summary_path = os.path.join(nestpath, "composite_summary.csv")
+    write_summary(keep_previous_results(rows, summary_path), summary_path)
+    print(f"Summary of {len(rows)} date folders written to {summary_path}")
 
     end = time.time()
     print(f"\n🎉 All done! Total time: {round(end - start, 2)} seconds.")
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+'''
+Reads the .mjpeg files written by picam2_record_mjpeg without cv2.VideoCapture. An mjpeg file is just jpeg images
+written back to back, so the stream is split on the jpeg start (FFD8) and end (FFD9) markers and each frame is decoded
+straight to grayscale, optionally at 1/2, 1/4 or 1/8 size using libjpeg's reduced decoding.
+
+A one-time scan can also save the byte offset of every frame (with the timestamps from the _pts.txt file the encoder
+writes) in a .idx sidecar next to the video (a csv file named like video.mjpeg.idx, so it is not mistaken for tracking
+data), so frames can be read in any order, sampled, or decoded in chunks by parallel workers.
+'''
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+import pandas as pd
+
+SOI = b'\xff\xd8'
+EOI = b'\xff\xd9'
+
+'''imread flags for each supported size reduction'''
+GRAYSCALE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def iter_jpeg_frames(filepath, chunk_size=1 << 20, offsets=False):
+    '''yield the encoded bytes of each jpeg frame in an mjpeg file, in order. If offsets is True, yield (byte offset, bytes) instead'''
+    buffer = bytearray()
+    buffer_offset = 0 #position of buffer[0] in the file
+    with open(filepath, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            buffer += chunk
+
+            while True:
+                start = buffer.find(SOI)
+                if start == -1:
+                    keep = min(len(buffer), 1) #keep a trailing FF in case the marker is split between chunks
+                    buffer_offset += len(buffer) - keep
+                    del buffer[:len(buffer) - keep]
+                    break
+                end = buffer.find(EOI, start + 2)
+                if end == -1:
+                    buffer_offset += start
+                    del buffer[:start]
+                    break
+                frame = bytes(buffer[start:end + 2])
+                yield (buffer_offset + start, frame) if offsets else frame
+                buffer_offset += end + 2
+                del buffer[:end + 2]
+
+
+def decode_gray(jpeg_bytes, reduction=1):
+    '''decode one jpeg frame directly to a single channel image, reduction can be 1, 2, 4 or 8'''
+    if reduction not in GRAYSCALE_FLAGS:
+        raise ValueError("reduction must be one of %s, not %s" % (list(GRAYSCALE_FLAGS), reduction))
+    return cv2.imdecode(np.frombuffer(jpeg_bytes, dtype=np.uint8), GRAYSCALE_FLAGS[reduction])
+
+
+def iter_gray_frames(filepath, reduction=1):
+    '''yield each frame of an mjpeg file as a grayscale array, skipping frames that cannot be decoded'''
+    for jpeg_bytes in iter_jpeg_frames(filepath):
+        gray = decode_gray(jpeg_bytes, reduction)
+        if gray is None:
+            print('could not decode a frame, skipping it...')
+            continue
+        yield gray
+
+
+def index_path(filepath):
+    '''path of the frame index sidecar of a video'''
+    return filepath + '.idx'
+
+
+def find_pts_file(filepath):
+    '''
+    return the _pts.txt timestamp file written next to an mjpeg video, or None. Older recordings saved it one folder
+    up with the date folder name glued to the front of the filename, so that location is checked too
+    '''
+    folder, name = os.path.split(os.path.splitext(filepath)[0])
+    for candidate in (os.path.join(folder, name + '_pts.txt'), folder + name + '_pts.txt'):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def read_pts(pts_path):
+    '''read the frame timestamps (in milliseconds) from a picamera2 pts file'''
+    with open(pts_path) as f:
+        return [float(line) for line in f if line.strip() and not line.startswith('#')]
+
+
+def build_frame_index(filepath, pts_path=None, save=True):
+    '''
+    scan an mjpeg file once and return a DataFrame with the frame number, byte offset, byte length and timestamp (ms,
+    from the pts file if there is one with a timestamp for every frame) of every jpeg in it. Saved next to the video
+    as a .idx file unless save is False
+    '''
+    offsets = []
+    lengths = []
+    for offset, frame in iter_jpeg_frames(filepath, offsets=True):
+        offsets.append(offset)
+        lengths.append(len(frame))
+
+    index = pd.DataFrame({'frame': np.arange(len(offsets)), 'offset': np.array(offsets, dtype=np.int64), 'length': np.array(lengths, dtype=np.int64)})
+    index['timestamp'] = np.nan
+
+    pts_path = pts_path or find_pts_file(filepath)
+    if pts_path is not None:
+        pts = read_pts(pts_path)
+        if len(pts) >= len(index):
+            index['timestamp'] = pts[:len(index)]
+        else:
+            print(f"{pts_path} has {len(pts)} timestamps for {len(index)} frames, leaving timestamps empty")
+
+    if save:
+        index.to_csv(index_path(filepath), index=False)
+    return index
+
+
+def load_frame_index(filepath):
+    '''load the frame index of an mjpeg file, building it first if it is missing or older than the video'''
+    path = index_path(filepath)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(filepath):
+        return pd.read_csv(path)
+    return build_frame_index(filepath)
+
+
+def read_frames(filepath, frames, reduction=1, index=None):
+    '''yield (frame number, grayscale image) for the given frame numbers, seeking straight to each one using the frame index'''
+    if index is None:
+        index = load_frame_index(filepath)
+    offsets = index['offset'].to_numpy()
+    lengths = index['length'].to_numpy()
+    with open(filepath, 'rb') as f:
+        for frame in frames:
+            f.seek(offsets[frame])
+            yield frame, decode_gray(f.read(lengths[frame]), reduction)
+
+
+def decode_frame_range(filepath, start, stop, reduction=1, index=None):
+    '''decode frames start to stop-1 of an mjpeg file and return them as a list of grayscale images'''
+    if index is None:
+        index = load_frame_index(filepath)
+    stop = min(stop, len(index))
+    return [gray for _, gray in read_frames(filepath, range(start, stop), reduction, index)]
+
+
+def decode_frames_parallel(filepath, reduction=1, workers=None, chunk_size=32, start=0, stop=None):
+    '''
+    decode a range of frames of an mjpeg file (the whole video by default) in chunks of chunk_size frames spread over a
+    pool of worker processes, yielding (frame number, grayscale image) in order
+    '''
+    index = load_frame_index(filepath)
+    stop = len(index) if stop is None else min(stop, len(index))
+    chunks = [(c, min(c + chunk_size, stop)) for c in range(start, stop, chunk_size)]
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(decode_frame_range, filepath, c_start, c_stop, reduction, index) for c_start, c_stop in chunks]
+        for (c_start, _), future in zip(chunks, futures):
+            for i, gray in enumerate(future.result()):
+                yield c_start + i, gray
+
+
+def sample_frames(filepath, number_of_frames, reduction=1):
+    '''return number_of_frames grayscale images evenly spaced through an mjpeg video (or every frame if it is shorter)'''
+    index = load_frame_index(filepath)
+    if len(index) == 0:
+        return []
+    frames = np.unique(np.linspace(0, len(index) - 1, min(number_of_frames, len(index))).round().astype(int))
+    return [gray for _, gray in read_frames(filepath, frames, reduction, index)]
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Build .idx frame index files for every mjpeg video in a folder')
+    parser.add_argument('-s', '--source', type=str, required=True, help='folder to search (including subfolders) for .mjpeg videos')
+    parser.add_argument('-f', '--force', action='store_true', help='rebuild indexes that already exist')
+    args = parser.parse_args()
+
+    for dirpath, _, files in os.walk(os.path.expanduser(args.source)):
+        for f in sorted(files):
+            if not f.endswith('.mjpeg'):
+                continue
+            filepath = os.path.join(dirpath, f)
+            if not args.force and os.path.exists(index_path(filepath)):
+                continue
+            index = build_frame_index(filepath)
+            print(f"indexed {len(index)} frames in {filepath}")
+
+
+if __name__ == '__main__':
+    main()
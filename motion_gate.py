@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+'''
+Motion-gated tag detection. Bees often sit still on the brood for long stretches, so most of a frame is usually the
+same as the last time it was searched. MotionGatedDetector compares each frame with a small copy of the last searched
+frame, runs detectMarkers only on the regions that changed (padded by about a tag's width), and reuses the previous
+detections everywhere else. Every full_every frames the whole frame is searched again, so nothing is missed for long.
+'''
+
+import cv2
+import numpy as np
+
+
+def merge_boxes(boxes):
+    '''merge overlapping (x0, y0, x1, y1) boxes until none overlap, so no part of the frame is searched twice'''
+    boxes = [list(b) for b in boxes]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+class MotionGatedDetector:
+    '''
+    Wraps an ArucoDetector and has the same detectMarkers(gray) method, so it can be passed to the tracking functions
+    in tag_tracking.py in place of the detector.
+
+    detector: the ArucoDetector that does the searching
+    full_every: search the whole frame at least every this many frames
+    threshold: mean gray level change of a block (of block x block pixels) that counts as motion
+    padding: pixels added around each changed region, should be at least the width of a tag
+    block: size in pixels of the blocks frames are compared in, bigger is faster but coarser
+    max_changed: if more than this fraction of the frame changed, search the whole frame instead of the regions
+    '''
+
+    def __init__(self, detector, full_every=10, threshold=12, padding=100, block=8, max_changed=0.5):
+        self.detector = detector
+        self.full_every = full_every
+        self.threshold = threshold
+        self.padding = padding
+        self.block = block
+        self.max_changed = max_changed
+        parameters = detector.getDetectorParameters()
+        self.perimeter_rates = (parameters.minMarkerPerimeterRate, parameters.maxMarkerPerimeterRate)
+        self.reference = None #block averages of the frame as it was when each region was last searched
+        self.corners = []
+        self.ids = []
+        self.rejected = []
+        self.frames = 0
+        self.full_searches = 0
+        self.pixels_total = 0
+        self.pixels_searched = 0
+
+    @property
+    def skipped_fraction(self):
+        '''fraction of all pixels seen so far that were not searched for tags'''
+        if self.pixels_total == 0:
+            return 0.0
+        return 1 - self.pixels_searched / self.pixels_total
+
+    def _small(self, gray):
+        height, width = gray.shape
+        return cv2.resize(gray, (max(width // self.block, 1), max(height // self.block, 1)), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    def _changed_boxes(self, small, shape):
+        '''full resolution (x0, y0, x1, y1) boxes around the blocks that changed, or None if too much changed'''
+        moved = (np.abs(small - self.reference) > self.threshold).astype(np.uint8)
+        if moved.mean() > self.max_changed:
+            return None
+        pad = int(np.ceil(self.padding / self.block))
+        moved = cv2.dilate(moved, np.ones((2 * pad + 1, 2 * pad + 1), np.uint8))
+        count, _, boxes, _ = cv2.connectedComponentsWithStats(moved, connectivity=8)
+        height, width = shape
+        regions = []
+        for x, y, w, h, area in boxes[1:]:
+            regions.append((x * self.block, y * self.block, min((x + w) * self.block, width), min((y + h) * self.block, height)))
+        for region in merge_boxes(regions):
+            region[2] = width if region[2] >= (width // self.block) * self.block else region[2] #blocks don't cover the last few pixels of the frame
+            region[3] = height if region[3] >= (height // self.block) * self.block else region[3]
+            yield region
+
+    def _detect(self, image, full_size):
+        '''
+        detectMarkers on the whole frame or a region of it. The marker perimeter limits are relative to the size of
+        the image searched, so they are scaled to keep the same limits in pixels as for the whole frame
+        '''
+        scale = full_size / max(image.shape)
+        parameters = self.detector.getDetectorParameters()
+        if parameters.minMarkerPerimeterRate != self.perimeter_rates[0] * scale:
+            parameters.minMarkerPerimeterRate = self.perimeter_rates[0] * scale
+            parameters.maxMarkerPerimeterRate = self.perimeter_rates[1] * scale
+            self.detector.setDetectorParameters(parameters)
+        return self.detector.detectMarkers(image)
+
+    def _full_search(self, gray, small):
+        corners, ids, rejected = self._detect(gray, max(gray.shape))
+        self.corners = list(corners)
+        self.ids = list(ids.reshape(-1)) if ids is not None else []
+        self.rejected = list(rejected)
+        self.reference = small
+        self.full_searches += 1
+        self.pixels_searched += gray.size
+
+    def detectMarkers(self, gray):
+        self.frames += 1
+        self.pixels_total += gray.size
+        small = self._small(gray)
+
+        boxes = None
+        if self.reference is not None and self.reference.shape == small.shape and (self.frames - 1) % self.full_every != 0:
+            boxes = self._changed_boxes(small, gray.shape)
+            if boxes is not None:
+                boxes = list(boxes)
+        if boxes is None:
+            self._full_search(gray, small)
+        elif boxes:
+            self._search_regions(gray, small, boxes)
+
+        ids = np.array(self.ids, dtype=np.int32).reshape(-1, 1) if self.ids else None
+        return tuple(self.corners), ids, tuple(self.rejected)
+
+    def _search_regions(self, gray, small, boxes):
+        '''drop the old detections centred inside the changed regions and search those regions again'''
+        height, width = gray.shape
+        grown = True
+        while grown:
+            '''grow the regions to fully hold the old tags centred inside them, so the tags are not cut in half'''
+            grown = False
+            for c in self.corners + self.rejected:
+                c = c.reshape(4, 2)
+                x, y = c.mean(axis=0)
+                margin = int(np.hypot(*(c[0] - c[1]))) // 2 + 1 #half a tag width of background around the tag
+                for box in boxes:
+                    if box[0] <= x < box[2] and box[1] <= y < box[3]:
+                        bigger = [max(min(box[0], int(c[:, 0].min()) - margin), 0), max(min(box[1], int(c[:, 1].min()) - margin), 0),
+                                  min(max(box[2], int(c[:, 0].max()) + margin + 1), width), min(max(box[3], int(c[:, 1].max()) + margin + 1), height)]
+                        if bigger != box:
+                            box[:] = bigger
+                            grown = True
+                        break
+            boxes = merge_boxes(boxes)
+
+        def outside(c):
+            x, y = c.reshape(4, 2).mean(axis=0)
+            return not any(x0 <= x < x1 and y0 <= y < y1 for x0, y0, x1, y1 in boxes)
+
+        keep = [i for i, c in enumerate(self.corners) if outside(c)]
+        self.corners = [self.corners[i] for i in keep]
+        self.ids = [self.ids[i] for i in keep]
+        self.rejected = [c for c in self.rejected if outside(c)]
+
+        for x0, y0, x1, y1 in boxes:
+            corners, ids, rejected = self._detect(gray[y0:y1, x0:x1], max(height, width))
+            offset = np.array([x0, y0], dtype=np.float32)
+            if ids is not None:
+                found = set(ids.reshape(-1))
+                keep = [i for i, tag in enumerate(self.ids) if tag not in found] #a tag found again replaces its old position
+                self.corners = [self.corners[i] for i in keep] + [c + offset for c in corners]
+                self.ids = [self.ids[i] for i in keep] + list(ids.reshape(-1))
+            self.rejected.extend(c + offset for c in rejected)
+            self.pixels_searched += (y1 - y0) * (x1 - x0)
+            b = self.block
+            self.reference[y0 // b:-(-y1 // b), x0 // b:-(-x1 // b)] = small[y0 // b:-(-y1 // b), x0 // b:-(-x1 // b)]
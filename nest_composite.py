@@ -0,0 +1,776 @@
+#!/usr/bin/env python
+
+'''
+Median composites of nest images in constant memory. The median of a stack of grayscale images was found by loading
+every image into one (images, height, width) array, so memory grew with the number of images. Here each pixel keeps a
+histogram of the values it has seen instead, updated one image at a time, and the median is read off the histogram.
+
+A full 256 bin histogram per pixel is large for 12 MP images, so by default the histogram has 16 coarse bins (16
+values each) and the images are read twice: the first pass finds which coarse bin holds the median of each pixel,
+the second keeps a 16 bin histogram of the values inside that bin only. Memory is the same for 5 or 500 images. With
+bits=8 the histogram has all 256 values, and one pass is enough.
+
+The result is the same as np.median over the stack rounded to uint8 like cv2.imwrite does (halves to the nearest even
+number), which is what the old composites saved.
+
+    composite = HistogramMedian((height, width), max_images=len(files))
+    for image in images(): composite.add(image)
+    if composite.needs_refine:
+        composite.start_refine()
+        for image in images(): composite.refine(image)
+    nest_image = composite.median()
+
+or median_composite(images) to do all of that.
+
+With workers > 1, median_composite decodes each image once into a stack file on disk (scratch folder) and splits the
+composite into bands of rows, one HistogramMedian per band, computed in a pool of processes that each read only their
+rows of every image from the memory mapped stack. The bands are stitched together at the end.
+
+DayComposite keeps the first pass histogram of a day's snapshots on disk, so record_video.py can add each snapshot as it
+is saved and the day's composite is ready at any time:
+
+    python3 nest_composite.py -d /mnt/bumblebox/data/2024-06-20 -o nest_image.png
+
+ImageLoader reads the images for either: it decodes PNGs straight to grayscale in a pool of threads (OpenCV lets go of
+the GIL while decoding, so reading files and decoding overlap) and hands them over in the order they finish. With a
+mask radius it also leaves out the pixels around every tag found in each snapshot (from the recording's _raw.csv), so
+bees sitting on the brood don't end up in the composite and far fewer snapshots give a clean nest image. When a day
+has few or no snapshots, sample_video_frames picks frames from its .mjpeg and .mp4 videos for the loader to decode
+instead, seeking straight to them (with the .idx frame index for mjpeg videos).
+
+generate_nest_image picks a day's images and saves its composite; it is shared by generate_nest_images_macV1.0.py,
+generate_nest_image_mac.py and generate_nest_image_macpy.py. The old in-memory stack medians are still available as
+backends (numpy, or dask if it is installed), and benchmark_composite.py compares them with the histogram.
+'''
+
+import argparse
+import glob
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from mjpeg_reader import load_frame_index, read_frames
+
+'''how the median is computed: a streaming per-pixel histogram, or the whole stack in memory with numpy or dask'''
+BACKENDS = ('histogram', 'numpy', 'dask')
+
+logger = logging.getLogger(__name__)
+
+
+def count_dtype(max_images):
+    '''the smallest unsigned integer type that can count max_images'''
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_images <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def find_rank(counts, rank):
+    '''
+    for each pixel, the first bin of counts (bins, height, width) at which the cumulative count passes rank, and the
+    number of values below that bin
+    '''
+    dtype = np.int64 if counts.dtype == np.uint64 else np.int32
+    total = np.zeros(counts.shape[1:], dtype=dtype)
+    found = np.full(counts.shape[1:], -1, dtype=np.int16)
+    below = np.zeros(counts.shape[1:], dtype=dtype)
+    for b in range(len(counts)):
+        after = total + counts[b]
+        hit = (found < 0) & (after > rank)
+        found[hit] = b
+        below[hit] = total[hit]
+        total = after
+    return found, below
+
+
+def round_half_even(total):
+    '''total / 2 rounded to the nearest integer, halves to the even one (how cv2.imwrite rounded the float medians)'''
+    half = total >> 1
+    return half + (total & 1 & half)
+
+
+class HistogramMedian:
+    '''
+    running per-pixel median of uint8 grayscale images of one shape. max_images is the most images (per pixel) that
+    will be added, which sets the size of the counters. bits is the number of bits of each value the first pass
+    histogram resolves: 4 gives 16 bins and needs a second pass over the same images, 8 gives 256 bins and does not
+    '''
+
+    def __init__(self, shape, max_images=255, bits=4, counts=None, images=0):
+        if not 1 <= bits <= 8:
+            raise ValueError(f"bits must be between 1 and 8, not {bits}")
+        self.shape = tuple(shape)
+        self.shift = 8 - bits
+        if counts is None:
+            counts = np.zeros((1 << bits,) + self.shape, dtype=count_dtype(max_images))
+        elif counts.shape != (1 << bits,) + self.shape:
+            raise ValueError(f"counts of shape {counts.shape} don't match {bits} bits and images of shape {self.shape}")
+        '''counts can be a memory map, so the histogram can be kept on disk and added to later (see DayComposite)'''
+        self.counts = counts
+        self.dtype = counts.dtype
+        self.images = images
+        self.refined = 0
+        self.fine = None
+
+    @property
+    def needs_refine(self):
+        return self.shift > 0
+
+    @property
+    def nbytes(self):
+        '''memory used by the histograms'''
+        return sum(a.nbytes for a in (self.counts, self.fine) if a is not None)
+
+    def check(self, image):
+        image = np.asarray(image)
+        if image.shape != self.shape or image.dtype != np.uint8:
+            raise ValueError(f"expected a uint8 image of shape {self.shape}, got {image.dtype} {image.shape}")
+        return image
+
+    def count(self, counts, values, selected):
+        '''add one to counts[value] of every selected pixel, one comparison per bin rather than a scattered add'''
+        for b in range(len(counts)):
+            hit = values == b
+            if selected is not None:
+                hit &= selected
+            counts[b] += hit
+
+    def add(self, image, valid=None):
+        '''first pass: add one image to the histograms. valid is an optional boolean image, only pixels where it is True are added'''
+        if self.fine is not None:
+            raise RuntimeError("images can't be added after start_refine()")
+        image = self.check(image)
+        self.count(self.counts, image >> self.shift, valid)
+        self.images += 1
+
+    def start_refine(self):
+        '''
+        after the first pass, find the coarse bins holding the lower and upper middle value of each pixel and replace
+        the coarse histogram with an empty fine one for the second pass
+        '''
+        total = self.counts.sum(axis=0, dtype=np.int64)
+        self.empty = total == 0
+        low_rank, high_rank = (total - 1) // 2, total // 2
+        self.low_bin, low_below = find_rank(self.counts, low_rank)
+        self.high_bin, high_below = find_rank(self.counts, high_rank)
+        '''ranks within the bin are smaller than the bin's count, so they fit the count type (empty pixels are set to 0 at the end)'''
+        self.low_rank = np.maximum(low_rank - low_below, 0).astype(self.dtype)
+        self.high_rank = np.maximum(high_rank - high_below, 0).astype(self.dtype)
+
+        '''
+        the upper middle value is either in the same bin, or it is the smallest value of a later bin (the values before
+        it are all in the lower bin or below), which only needs a running minimum
+        '''
+        self.high_same = self.high_bin == self.low_bin
+        self.smallest = np.full(self.shape, 255, dtype=np.uint8)
+        self.counts = None
+        self.fine = np.zeros((1 << self.shift,) + self.shape, dtype=self.dtype)
+
+    def refine(self, image, valid=None):
+        '''second pass: add the same images (with the same valid masks) again, in any order, to the fine histograms'''
+        if self.fine is None:
+            self.start_refine()
+        image = self.check(image)
+        coarse = image >> self.shift
+        selected = coarse == self.low_bin
+        later = coarse == self.high_bin
+        later &= ~self.high_same
+        if valid is not None:
+            selected &= valid
+            later &= valid
+        self.count(self.fine, image & ((1 << self.shift) - 1), selected)
+        np.copyto(self.smallest, np.minimum(self.smallest, image), where=later)
+        self.refined += 1
+
+    def estimate(self):
+        '''
+        the median image from the first pass alone. Each middle value is placed inside its coarse bin as if the values
+        in the bin were spread evenly over it, so it can be off by up to half a bin (exact with bits=8)
+        '''
+        total = self.counts.sum(axis=0, dtype=np.int64)
+        self.empty = total == 0
+        width = 1 << self.shift
+        middle = []
+        for rank in ((total - 1) // 2, total // 2):
+            found, below = find_rank(self.counts, rank)
+            found = np.maximum(found, 0)
+            inside = np.take_along_axis(self.counts, found[None].astype(np.intp), axis=0)[0].astype(np.int64)
+            position = ((rank - below + 0.5) * width / np.maximum(inside, 1)).astype(np.int16)
+            middle.append((found << self.shift) + np.clip(position, 0, width - 1))
+        median = round_half_even(middle[0] + middle[1])
+        median[self.empty] = 0
+        return median.astype(np.uint8)
+
+    def median(self):
+        '''the median image (uint8). Pixels that no image was added to (see empty) are 0'''
+        if not self.needs_refine:
+            return self.estimate()
+
+        if self.fine is None or self.refined != self.images:
+            raise RuntimeError(f"the {self.images} images of the first pass must all be added again with refine() ({self.refined} so far)")
+        offset = self.low_bin.astype(np.int16) << self.shift
+        low = offset + find_rank(self.fine, self.low_rank)[0]
+        high = np.where(self.high_same, offset + find_rank(self.fine, self.high_rank)[0], self.smallest)
+        median = round_half_even(low + high.astype(np.int16))
+        median[self.empty] = 0
+        return median.astype(np.uint8)
+
+
+class DayComposite:
+    '''
+    a nest composite kept up to date as snapshots arrive. The histogram of the day's images is a memory mapped file in
+    the day folder (nest_histogram.npy, next to nest_histogram.json with the settings and the images added so far), so
+    adding an image touches each pixel once and the current composite can be read at any time without the images.
+    It is one pass only, so with fewer than 8 bits the composite is HistogramMedian.estimate(): 4 bits keeps the
+    file at 16 counters per pixel and is within half a bin (8 gray levels) of the exact median.
+
+    Before an image is added to the histogram it is saved in the json as pending, and it is only moved to the list of
+    images once the histogram is on disk. If the process stops in between, the next DayComposite of the folder finds
+    the pixels the pending image was not counted in yet (their counts add up to one less than the others') and adds
+    the image to those, so no image is ever left half counted or counted twice
+    '''
+
+    def __init__(self, folder, max_images=255, bits=4):
+        self.histogram_path = os.path.join(folder, 'nest_histogram.npy')
+        self.info_path = os.path.join(folder, 'nest_histogram.json')
+        self.max_images = max_images
+        self.bits = bits
+        self.info = None
+        self.composite = None
+        if os.path.exists(self.info_path) and os.path.exists(self.histogram_path):
+            with open(self.info_path) as f:
+                self.info = json.load(f)
+            counts = np.load(self.histogram_path, mmap_mode='r+')
+            self.composite = HistogramMedian(self.info['shape'], bits=self.info['bits'], counts=counts, images=len(self.info['images']))
+            if self.info.get('pending'):
+                self.recover()
+
+    @property
+    def images(self):
+        return [] if self.info is None else self.info['images']
+
+    def save_info(self):
+        tmp = self.info_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.info, f, indent=4)
+        os.replace(tmp, self.info_path)
+
+    def recover(self):
+        '''finish adding the image that was being added when the process stopped (see the class docstring)'''
+        path = self.info['pending']
+        name = os.path.basename(path)
+        missing = self.composite.counts.sum(axis=0, dtype=np.int64) == len(self.images)
+        if missing.any():
+            image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+            if image is None:
+                if missing.all():
+                    print(f"{name} was being added to {self.histogram_path} when it stopped and can no longer be read, leaving it out")
+                    self.info['pending'] = None
+                    self.save_info()
+                    return
+                raise ValueError(f"{self.histogram_path} is missing {name} in some pixels and it can't be read from {path}")
+            if image.shape != self.composite.shape:
+                image = cv2.resize(image, (self.composite.shape[1], self.composite.shape[0]))
+            self.composite.count(self.composite.counts, image >> self.composite.shift, missing)
+            self.composite.counts.flush()
+        print(f"finished adding {name} to {self.histogram_path}, it was being added when the process stopped")
+        logger.warning(f"nest composite: recovered {name} in {self.histogram_path}")
+        self.composite.images += 1
+        self.info['images'].append(name)
+        self.info['pending'] = None
+        self.save_info()
+
+    def add(self, path, image=None):
+        '''
+        add the snapshot at path (or image, its uint8 grayscale pixels, if already in memory) to the composite. A
+        snapshot that was already added is skipped. Returns True if it was added
+        '''
+        name = os.path.basename(path)
+        if name in self.images:
+            return False
+        if image is None:
+            image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+            if image is None:
+                raise ValueError(f"could not read {path}")
+        if self.composite is None:
+            counts = np.lib.format.open_memmap(self.histogram_path, mode='w+', dtype=count_dtype(self.max_images), shape=(1 << self.bits,) + image.shape)
+            self.composite = HistogramMedian(image.shape, bits=self.bits, counts=counts)
+            self.info = {'shape': list(image.shape), 'bits': self.bits, 'max_images': self.max_images, 'images': [], 'pending': None}
+        elif image.shape != self.composite.shape:
+            image = cv2.resize(image, (self.composite.shape[1], self.composite.shape[0]))
+
+        if len(self.images) >= np.iinfo(self.composite.dtype).max:
+            print(f"{self.histogram_path} already holds {len(self.images)} images, its counters are full, not adding {name}")
+            return False
+        self.info['pending'] = os.path.abspath(path)
+        self.save_info()
+        self.composite.add(image)
+        self.composite.counts.flush()
+        self.info['images'].append(name)
+        self.info['pending'] = None
+        self.save_info()
+        return True
+
+    def median(self):
+        '''the current composite, or None if no images were added yet'''
+        return None if self.composite is None else self.composite.estimate()
+
+
+def composite_memory(shape, max_images=255, bits=4, threads=4):
+    '''
+    rough peak memory in bytes of a single process median_composite of images of shape (height, width): the histogram,
+    the temporary arrays used to find each pixel's median bin, and the images the loader keeps in flight
+    '''
+    pixels = int(np.prod(shape))
+    return pixels * ((1 << bits) * np.dtype(count_dtype(max_images)).itemsize + 48 + 2 * threads)
+
+
+def image_shape(path):
+    '''(height, width) of an image, from the header alone for PNGs'''
+    with open(path, 'rb') as f:
+        header = f.read(24)
+    if header[:8] == b'\x89PNG\r\n\x1a\n' and header[12:16] == b'IHDR':
+        return int.from_bytes(header[20:24], 'big'), int.from_bytes(header[16:20], 'big')
+    image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    return None if image is None else image.shape
+
+
+def snapshot_detections(path, window=2, frame=None):
+    '''
+    (x, y) centroids of the tags detected around the frame saved as the snapshot png at path, from the _raw.csv of the
+    same recording, or None if there is no _raw.csv. The snapshot is the middle frame of the recording, so tags found
+    within window frames of the middle frame are used. For a frame read from a video, path is the video and frame its
+    frame number
+    '''
+    stem = os.path.splitext(path)[0]
+    if not os.path.exists(stem + '_raw.csv'):
+        return None
+    raw = pd.read_csv(stem + '_raw.csv', usecols=['frame', 'centroidX', 'centroidY'])
+    if frame is None:
+        last = raw['frame'].max() if not raw.empty else -1
+        if os.path.exists(stem + '_noID.csv'):
+            '''rejected candidates are found in nearly every frame, so they tell how long the recording was better'''
+            noID = pd.read_csv(stem + '_noID.csv', usecols=['frame'])
+            if not noID.empty:
+                last = max(last, noID['frame'].max())
+        frame = int((last + 1) / 2)
+    near = raw[(raw['frame'] - frame).abs() <= window]
+    return near[['centroidX', 'centroidY']].to_numpy(dtype=np.float64)
+
+
+def bee_mask(path, shape, radius, window=2, frame=None):
+    '''
+    boolean image of shape (height, width), False within radius pixels of every tag detected in the snapshot at path
+    (or frame of the video at path, see snapshot_detections) and True elsewhere. None if the recording has no _raw.csv
+    '''
+    centroids = snapshot_detections(path, window, frame)
+    if centroids is None:
+        return None
+    valid = np.full(shape, 255, dtype=np.uint8)
+    for x, y in centroids[~np.isnan(centroids).any(axis=1)]:
+        cv2.circle(valid, (int(round(x)), int(round(y))), int(radius), 0, -1)
+    return valid.astype(bool)
+
+
+def fill_empty(median, empty):
+    '''fill the pixels of a composite that were left out of every image from the pixels around them'''
+    if not empty.any() or empty.all():
+        return median
+    return cv2.inpaint(median, empty.astype(np.uint8), 5, cv2.INPAINT_TELEA)
+
+
+def video_frame_count(video):
+    '''number of frames in an .mjpeg (from its frame index, built if needed) or .mp4 video'''
+    if video.endswith('.mjpeg'):
+        return len(load_frame_index(video))
+    capture = cv2.VideoCapture(video)
+    frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    capture.release()
+    return max(frames, 0)
+
+
+def sample_video_frames(videos, number_of_frames):
+    '''
+    (video, frame number) pairs of number_of_frames frames spread evenly over the videos and evenly through each one,
+    to be read by ImageLoader in place of snapshots
+    '''
+    counts = {video: video_frame_count(video) for video in videos}
+    videos = [video for video in videos if counts[video] > 0]
+    if not videos or number_of_frames <= 0:
+        return []
+    per_video = -(-number_of_frames // len(videos))
+    samples = []
+    for video in videos:
+        '''the middle of each of per_video equal parts of the video, so the first and last frames (camera starting, lights) are avoided'''
+        frames = np.unique(((np.arange(per_video) + 0.5) * counts[video] / per_video).astype(int))
+        samples.extend((video, int(frame)) for frame in frames)
+    return samples[:number_of_frames] if len(samples) > number_of_frames else samples
+
+
+def read_video_frame(video, frame, index=None):
+    '''one frame of a video as a grayscale image, or None. mjpeg frames are read straight from their offset in the frame index'''
+    if video.endswith('.mjpeg'):
+        for _, gray in read_frames(video, [frame], 1, index):
+            return gray
+        return None
+    capture = cv2.VideoCapture(video)
+    try:
+        capture.set(cv2.CAP_PROP_POS_FRAMES, frame)
+        ok, image = capture.read()
+    finally:
+        capture.release()
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if ok else None
+
+
+def describe(source):
+    return f"frame {source[1]} of {source[0]}" if isinstance(source, tuple) else source
+
+
+class ImageLoader:
+    '''
+    reads the images at paths as uint8 grayscale, threads at a time, for median_composite (call it to get an iterator
+    of images; it can be called again for a second pass). Images are resized to shape (height, width), or to the shape
+    of the first image read if shape is None. Unreadable images are skipped and listed in failed.
+
+The sources read on a call are kept in decoded, and a later call reads only those, so every pass sees the same images
+(an image that can no longer be read on a later pass is still skipped, and left out of decoded from then on).
+
+    paths can also hold (video, frame number) pairs (see sample_video_frames), so frames are decoded straight from
+    recorded videos, only the sampled ones, in the same threads.
+
+    With mask_radius, each snapshot comes with a mask of the pixels more than mask_radius pixels away from every tag
+    found in it (see bee_mask), as an (image, valid) pair, so bees sitting on the nest are left out of the median
+    '''
+
+    def __init__(self, paths, shape=None, threads=4, mask_radius=0):
+        self.paths = list(paths)
+        '''load the frame index of each mjpeg video here, once, rather than in every thread'''
+        self.indexes = {source[0]: load_frame_index(source[0]) for source in self.paths if isinstance(source, tuple) and source[0].endswith('.mjpeg')}
+        self.shape = None if shape is None else tuple(shape)
+        self.threads = threads
+        self.mask_radius = mask_radius
+        self.failed = set()
+        self.decoded = None
+        self.unmasked = set()
+        self.loaded = 0
+        self.seconds = 0.0
+        self.pixels = 0
+        self.masked_pixels = 0
+
+    def resize(self, image, valid):
+        size = (self.shape[1], self.shape[0])
+        if valid is not None:
+            valid = cv2.resize(valid.view(np.uint8), size, interpolation=cv2.INTER_NEAREST).astype(bool)
+        return cv2.resize(image, size), valid
+
+    def read(self, source):
+        if isinstance(source, tuple):
+            video, frame = source
+            image = read_video_frame(video, frame, self.indexes.get(video))
+        else:
+            video, frame = source, None
+            image = cv2.imread(source, cv2.IMREAD_GRAYSCALE)
+        valid = None
+        if image is not None and self.mask_radius > 0:
+            valid = bee_mask(video, image.shape, self.mask_radius, frame=frame)
+        if image is not None and self.shape is not None and image.shape != self.shape:
+            image, valid = self.resize(image, valid)
+        return source, image, valid
+
+    @property
+    def masked_fraction(self):
+        return self.masked_pixels / self.pixels if self.pixels > 0 else 0.0
+
+    @property
+    def images_per_second(self):
+        return self.loaded / self.seconds if self.seconds > 0 else 0.0
+
+    def __call__(self):
+        start = time.time()
+        decoded = []
+        paths = iter(self.paths if self.decoded is None else self.decoded)
+        try:
+            yield from self.read_all(paths, decoded)
+        finally:
+            '''also when the caller stops early, so the next pass reads the images this one gave it'''
+            self.decoded = decoded
+        loaded = len(decoded)
+        seconds = time.time() - start
+        self.loaded += loaded
+        self.seconds += seconds
+        print(f"read {loaded} images in {round(seconds, 2)} seconds ({round(loaded / seconds, 2) if seconds > 0 else 0} images/sec)")
+        if self.mask_radius > 0:
+            print(f"left out {round(self.masked_fraction * 100, 1)}% of pixels around tagged bees")
+
+    def read_all(self, paths, decoded):
+        '''the images of paths, read in threads, adding each source given out to decoded'''
+        with ThreadPoolExecutor(self.threads) as pool:
+            '''keep a couple of images per thread in flight, so memory stays bounded if the composite is slower'''
+            pending = {pool.submit(self.read, path) for _, path in zip(range(2 * self.threads), paths)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, image, valid = future.result()
+                    following = next(paths, None)
+                    if following is not None:
+                        pending.add(pool.submit(self.read, following))
+                    if image is None:
+                        if path not in self.failed:
+                            print(f"Warning: could not read {describe(path)}, skipping it")
+                            self.failed.add(path)
+                        continue
+                    if self.shape is None:
+                        self.shape = image.shape
+                    elif image.shape != self.shape:
+                        image, valid = self.resize(image, valid)
+                    decoded.append(path)
+                    if self.mask_radius <= 0:
+                        yield image
+                        continue
+                    if valid is None and path not in self.unmasked:
+                        print(f"no _raw.csv for {describe(path)}, using the whole image")
+                        self.unmasked.add(path)
+                    self.pixels += image.size
+                    self.masked_pixels += 0 if valid is None else image.size - np.count_nonzero(valid)
+                    yield image, valid
+
+
+def split(item):
+    '''(image, valid mask or None) of an item given by an images() function, which is an image or an (image, valid) pair'''
+    return item if isinstance(item, tuple) else (item, None)
+
+
+def stack_to_disk(images, folder, max_images):
+    '''
+    write the images given by images() to stack.npy in folder (memory mapped, so only one image is in memory at a
+    time), and their masks, if they have any, to valid.npy. Returns the number of images and their shape
+    '''
+    stack = None
+    masks = None
+    count = 0
+    for item in images():
+        image, valid = split(item)
+        if stack is None:
+            stack = np.lib.format.open_memmap(os.path.join(folder, 'stack.npy'), mode='w+', dtype=np.uint8, shape=(max_images,) + image.shape)
+        if valid is not None and masks is None:
+            masks = np.lib.format.open_memmap(os.path.join(folder, 'valid.npy'), mode='w+', dtype=bool, shape=(max_images,) + image.shape)
+            masks[:count] = True
+        stack[count] = image
+        if masks is not None:
+            masks[count] = True if valid is None else valid
+        count += 1
+    if stack is None:
+        return 0, None
+    stack.flush()
+    if masks is not None:
+        masks.flush()
+    return count, stack.shape[1:]
+
+
+def median_of_rows(job):
+    '''median and empty pixels of rows start:stop of the first count images of a stack folder. Runs in a pool worker'''
+    folder, count, start, stop, max_images, bits = job
+    stack = np.load(os.path.join(folder, 'stack.npy'), mmap_mode='r')
+    if os.path.exists(os.path.join(folder, 'valid.npy')):
+        masks = np.load(os.path.join(folder, 'valid.npy'), mmap_mode='r')
+        rows = lambda: ((stack[i, start:stop], masks[i, start:stop]) for i in range(count))
+    else:
+        rows = lambda: (stack[i, start:stop] for i in range(count))
+    median, empty, _ = histogram_median(rows, max_images, bits)
+    return start, median, empty
+
+
+def tiled_median(folder, count, shape, workers, max_images=255, bits=4, tiles=None):
+    '''
+    median of the first count images of the stack in folder (see stack_to_disk), computed in horizontal bands by a
+    pool of workers. There are a few more bands than workers (tiles), so a slow band does not hold up the rest.
+    Returns the median and the pixels that were left out of every image
+    '''
+    tiles = min(tiles or workers * 4, shape[0])
+    edges = np.linspace(0, shape[0], tiles + 1).astype(int)
+    jobs = [(folder, count, start, stop, max_images, bits) for start, stop in zip(edges[:-1], edges[1:])]
+    median = np.empty(shape, dtype=np.uint8)
+    empty = np.empty(shape, dtype=bool)
+    with Pool(workers) as pool:
+        for start, band, band_empty in pool.imap_unordered(median_of_rows, jobs):
+            median[start:start + len(band)] = band
+            empty[start:start + len(band)] = band_empty
+    return median, empty
+
+
+def histogram_median(images, max_images=255, bits=4):
+    '''
+    (median, empty pixels, number of images) of the images given by images(), in this process. If the second pass
+    does not give the same number of images as the first (an image could not be read again), both passes are made
+    again, with the images images() now gives (ImageLoader then leaves out the ones that failed)
+    '''
+    first = None
+    while True:
+        composite = None
+        for item in images():
+            image, valid = split(item)
+            if composite is None:
+                composite = HistogramMedian(image.shape, max_images, bits)
+            composite.add(image, valid)
+        if composite is None:
+            return None, None, 0
+        if not composite.needs_refine:
+            break
+        composite.start_refine()
+        for item in images():
+            composite.refine(*split(item))
+        if composite.refined == composite.images:
+            break
+        if first is not None and composite.images >= first:
+            '''images() gave as many images as last time, so the passes would never agree'''
+            break
+        print(f"Warning: the second pass read {composite.refined} of the {composite.images} images, starting again without the missing ones")
+        first = composite.images
+    median = composite.median()
+    return median, composite.empty, composite.images
+
+
+def stack_median(images, use_dask=False, chunk_rows=256):
+    '''
+    (median, empty pixels, number of images) of the images given by images(), all held in memory as one (images,
+    height, width) stack like the old scripts did: np.median, or a dask median over bands of chunk_rows rows. Masked
+    pixels are NaN in a float32 stack. For comparison with the histogram (see benchmark_composite.py)
+    '''
+    items = [split(item) for item in images()]
+    if not items:
+        return None, None, 0
+    stack = np.stack([image for image, _ in items])
+    if any(valid is not None for _, valid in items):
+        stack = stack.astype(np.float32)
+        for i, (_, valid) in enumerate(items):
+            if valid is not None:
+                stack[i][~valid] = np.nan
+    masked = stack.dtype == np.float32
+
+    if use_dask:
+        try:
+            import dask.array as da
+        except ImportError:
+            raise ImportError("the dask backend needs dask, install it with pip install dask[array]")
+        chunked = da.from_array(stack, chunks=(len(stack), chunk_rows, stack.shape[2]))
+        median = (da.nanmedian if masked else da.median)(chunked, axis=0).compute()
+    else:
+        median = (np.nanmedian if masked else np.median)(stack, axis=0)
+    empty = np.isnan(median)
+    '''np.rint rounds halves to even, like cv2.imwrite did when the float median was saved'''
+    return np.rint(np.nan_to_num(median)).astype(np.uint8), empty, len(items)
+
+
+def median_composite(images, max_images=255, bits=4, workers=1, scratch=None, backend='histogram'):
+    '''
+    median of the uint8 grayscale images given by images(), a function returning an iterable of images of one shape,
+    or of (image, valid) pairs to leave out the pixels where valid is False (see ImageLoader). Pixels left out of
+    every image are filled in from the pixels around them.
+
+    backend is one of BACKENDS: the streaming histogram (the default), or the whole stack in memory with numpy or
+    dask. With the histogram and one worker images() is called once for the first pass and again for the second.
+    With more, it is called once and the images are stacked in a temporary folder in scratch (the system temp folder
+    if None), which needs max_images times the size of one image on disk (twice that with masks). Returns (median
+    image, number of images), or (None, 0) if there were none
+    '''
+    if backend not in BACKENDS:
+        raise ValueError(f"backend must be one of {BACKENDS}, not {backend}")
+    if backend != 'histogram':
+        median, empty, count = stack_median(images, use_dask=backend == 'dask')
+        if count == 0:
+            return None, 0
+    elif workers > 1:
+        if scratch is not None:
+            os.makedirs(scratch, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=scratch, prefix='.nest_composite_') as folder:
+            count, shape = stack_to_disk(images, folder, max_images)
+            if count == 0:
+                return None, 0
+            median, empty = tiled_median(folder, count, shape, workers, max_images, bits)
+    else:
+        median, empty, count = histogram_median(images, max_images, bits)
+        if count == 0:
+            return None, 0
+    return fill_empty(median, empty), count
+
+
+def find_inputs(folder, from_videos=False):
+    '''the png snapshots in folder (not composites saved there earlier), and its .mjpeg and .mp4 videos if from_videos'''
+    inputs = [f for f in glob.glob(os.path.join(folder, '*.png')) if not f.endswith('nest_image.png')]
+    if from_videos:
+        inputs += glob.glob(os.path.join(folder, '*.mjpeg')) + glob.glob(os.path.join(folder, '*.mp4'))
+    return inputs
+
+
+def generate_nest_image(folder, output_paths, number_of_images, shuffle=True, backend='histogram', workers=1, threads=4, mask_radius=0, from_videos=False, scratch=None):
+    '''
+    make the nest composite of up to number_of_images snapshots in folder (picked at random if shuffle) and save it to
+    each of output_paths. With from_videos, days with fewer snapshots are topped up with frames sampled from the
+    folder's videos. This is the composite step of all the generate_nest_image* scripts, which only differ in where
+    they look for images and how they name the composites. With workers > 1 the decoded images are stacked in a
+    temporary folder in scratch, the system temp folder if None (not the image folder, which may be a synced drive).
+    Returns the number of images used
+    '''
+    files = [f for f in find_inputs(folder) if f.endswith('.png')]
+    if shuffle:
+        random.shuffle(files)
+    files = files[:number_of_images]
+    if from_videos and len(files) < number_of_images:
+        videos = sorted(f for f in find_inputs(folder, True) if not f.endswith('.png'))
+        frames = sample_video_frames(videos, number_of_images - len(files))
+        print(f"Found {len(files)} PNG files, adding {len(frames)} frames from {len(videos)} videos.")
+        files = files + frames
+    if not files:
+        print(f"No PNG files found in {folder}")
+        logger.warning(f"No PNG images found in {folder}")
+        return 0
+
+    print(f"Generating composite image for {folder} using {len(files)} images")
+    images = ImageLoader(files, threads=threads, mask_radius=mask_radius)
+    composite, used = median_composite(images, max_images=len(files), workers=workers, scratch=scratch, backend=backend)
+    if composite is None:
+        print(f"None of the images in {folder} could be read")
+        return 0
+
+    for path in output_paths:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        cv2.imwrite(path, composite)
+        print(f"Saved composite image to: {path}")
+    logger.info(f"Composite image {os.path.basename(output_paths[0])} made with the {backend} backend from {used} images, read at {round(images.images_per_second, 2)} images/sec")
+    return used
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Add snapshots to a day folder\'s running nest composite, or save the composite')
+    parser.add_argument('-d', '--day_folder', type=str, required=True, help='day folder holding the nest_histogram.npy file')
+    parser.add_argument('-a', '--add', type=str, nargs='+', default=[], help='png snapshots to add to the composite')
+    parser.add_argument('-o', '--output', type=str, default=None, help='png file to save the current composite to')
+    parser.add_argument('-b', '--bits', type=int, default=4, help='bits per value of a new histogram (16 bins for 4, exact for 8)')
+    parser.add_argument('-m', '--max_images', type=int, default=255, help='the most snapshots a new histogram will hold, sets the size of its counters')
+    args = parser.parse_args()
+
+    day = DayComposite(args.day_folder, args.max_images, args.bits)
+    added = sum(day.add(path) for path in args.add)
+    print(f"added {added} snapshots, the composite of {args.day_folder} now holds {len(day.images)}")
+    if args.output is not None:
+        median = day.median()
+        if median is None:
+            print("no snapshots have been added to this day's composite yet")
+            return 1
+        cv2.imwrite(args.output, median)
+        print(f"saved the composite to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+'''
+Timing and memory instrumentation for the recording and tracking pipeline. A PipelineStats object adds up the time
+spent in each named stage (capture, color conversion, clahe, detection, ...), prints a short progress summary every
+few seconds instead of a line per frame, and at the end of a recording is written to the log as one json line.
+'''
+
+import json
+import resource
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+def peak_memory_mb(children=False):
+    '''
+    peak resident memory of this process in MB (ru_maxrss is in KB on linux and bytes on macOS). With children=True,
+    that of the largest of its child processes that have finished instead
+    '''
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+class PipelineStats:
+    '''
+    Per-stage timers for one recording. Use "with stats.stage('detection'):" around each step, call frame_done()
+    after each frame, and summary() or to_json() at the end. progress_interval is how often (in seconds) a progress
+    line is printed, None for never.
+    '''
+
+    def __init__(self, filename=None, progress_interval=10.0):
+        self.filename = filename
+        self.progress_interval = progress_interval
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.frames = 0
+        self.start = time.perf_counter()
+        self.last_progress = self.start
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - started
+            self.calls[name] += 1
+
+    def add(self, name, seconds, calls=1):
+        '''add time measured somewhere else, for example in a background thread'''
+        self.seconds[name] += seconds
+        self.calls[name] += calls
+
+    def frame_done(self, stage='tracking'):
+        '''count a processed frame and print a progress line if progress_interval seconds have passed since the last one'''
+        self.frames += 1
+        if self.progress_interval is None:
+            return
+        now = time.perf_counter()
+        if now - self.last_progress >= self.progress_interval:
+            print(f"{stage}: processed {self.frames} frames, {round(self.frames / (now - self.start), 2)} frames per second")
+            self.last_progress = now
+
+    def summary(self):
+        total = time.perf_counter() - self.start
+        return {
+            'filename': self.filename,
+            'total_seconds': round(total, 3),
+            'frames': self.frames,
+            'peak_rss_mb': round(peak_memory_mb(), 1),
+            'stages': {name: {'seconds': round(self.seconds[name], 3), 'calls': self.calls[name]} for name in self.seconds},
+        }
+
+    def to_json(self):
+        return json.dumps(self.summary())
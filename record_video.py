@@ -12,6 +12,7 @@ import argparse
 import os
 import subprocess
 import sys
+import threading
 from sys import getsizeof
 import cv2
 from cv2 import aruco
@@ -19,7 +20,15 @@ from libcamera import controls
 import behavioral_metrics
 import setup
 from setup import colony_number
-from data_cleaning import interpolate
+from gap_filling import interpolate_tracks
+from tag_tracking import create_detector, frame_to_gray, track_frames, track_mjpeg, write_tracking_csvs
+from mjpeg_reader import build_frame_index
+from frame_buffer import LumaRingBuffer
+from pipeline_stats import PipelineStats
+from motion_gate import MotionGatedDetector
+from detection_log import write_detections
+from tracking_queue import enqueue, recording_interval
+from nest_composite import DayComposite
 import logging
 import pwd
 import pandas as pd
@@ -29,7 +38,7 @@ logging.basicConfig(filename=f'/home/{username}/Desktop/BumbleBox/logs/log.log',
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-def picam2_record_mp4(filename, outdir, recording_time, fps, shutter_speed, width, height, tuning_file, noise_reduction_mode, digital_zoom): #imformat="yuv" #have excluded imformat input because right now only functions by grabbing YUV frames, then converts them to RGB video. Maybe have a grayscale vs color option if possible?
+def picam2_record_mp4(filename, outdir, recording_time, fps, shutter_speed, width, height, tuning_file, noise_reduction_mode, digital_zoom, stats=None): #imformat="yuv" #have excluded imformat input because right now only functions by grabbing YUV frames, then converts them to RGB video. Maybe have a grayscale vs color option if possible?
     
     tuning = Picamera2.load_tuning_file(tuning_file)
     picam2 = Picamera2(tuning=tuning)
@@ -72,7 +81,13 @@ def picam2_record_mp4(filename, outdir, recording_time, fps, shutter_speed, widt
     time.sleep(2)
     start_time = time.time()
     
-    frames_list = []
+    if setup.capture_luma_only == True:
+        '''only keep the Y plane of each frame, in a buffer big enough for the whole recording at up to fps+1 frames per second'''
+        capture_width, capture_height = preview["main"]["size"]
+        capacity = int(recording_time * (fps + 1)) + 2
+        frames_list = LumaRingBuffer(capacity, capture_height, capture_width, setup.luma_buffer_path)
+    else:
+        frames_list = []
     i = 0
     
     print("beginning video capture")
@@ -80,39 +95,77 @@ def picam2_record_mp4(filename, outdir, recording_time, fps, shutter_speed, widt
         timestamp = time.time() - start_time
         
         yuv420 = picam2.capture_array()
-        frames_list.append([yuv420])
+        if setup.capture_luma_only == True:
+            frames_list.append(yuv420)
+        else:
+            frames_list.append([yuv420])
         #yuv420 = yuv420[0:3040, :]
         #frames_dict[f"frame_{i:03d}"] = [yuv420, timestamp]
         time.sleep(1/(fps+1))
         i += 1
         
     finished = time.time()-start_time
+    if stats is not None:
+        stats.add('capture', finished, i)
     print(f'finished capturing frames to arrays, captured {i} frames in {finished} seconds')
     rate = i / finished
     print(f'thats {rate} frames per second!\nMake sure this corresponds well to your desired framerate. FPS is a bit experimental for tag tracking and mp4 recording at the moment... Thats the tradeoff for allowing a higher framerate.')
     
     output = outdir+'/'+filename+'.mp4'
     print(output)
-    vid_fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(output,vid_fourcc,10,(4032,3040))
-    
-    for i, im_array in enumerate(frames_list):
-        frame = im_array[0]
-        rgb_im = cv2.cvtColor(frame, cv2.COLOR_YUV420p2RGB)
-        out.write(rgb_im)
-        print("wrote another frame!")
-    
-    out.release()
-    cv2.destroyAllWindows()
-    return output, frames_list
-    
+
+    '''encode the video in the background so tag tracking can start right away'''
+    writer = AsyncVideoWriter(output, frames_list, rate)
+    writer.start()
+    return output, frames_list, writer
+
+
+
+class AsyncVideoWriter(threading.Thread):
+    '''
+    Encodes captured YUV420 frames (or luma planes) to an mp4 file in a background thread, so the video is written while the
+    same frames are being tracked instead of before. The video size is taken from the frames themselves and
+    fps should be the measured capture rate. Call join() before the script exits.
+    '''
+
+    def __init__(self, output, frames_list, fps):
+        super().__init__(name='mp4 writer')
+        self.output = output
+        self.frames_list = frames_list
+        self.fps = fps
+        self.frames_written = 0
+        self.seconds = 0
+
+    def run(self):
+        start = time.time()
+        out = None
+        try:
+            for im_array in self.frames_list:
+                if isinstance(im_array, list):
+                    im = cv2.cvtColor(im_array[0], cv2.COLOR_YUV2BGR_I420)
+                else:
+                    im = im_array #luma only frames are written as a grayscale video
+                if out is None:
+                    height, width = im.shape[:2]
+                    vid_fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+                    out = cv2.VideoWriter(self.output, vid_fourcc, self.fps, (width, height), isColor=(im.ndim == 3))
+                out.write(im)
+                self.frames_written += 1
+        except Exception as e:
+            logger.exception("Exception occurred while writing %s: %s", self.output, str(e))
+        finally:
+            if out is not None:
+                out.release()
+        self.seconds = time.time() - start
+        print(f"wrote {self.frames_written} frames to {self.output} in {round(self.seconds, 2)} seconds")
 
 
 
 
 
 
-def picam2_record_mjpeg(filename, outdir, recording_time, quality, fps, shutter_speed, width, height, tuning_file, noise_reduction_mode, digital_zoom, imformat="RGB888", buffer_count=2):
+
+def picam2_record_mjpeg(filename, outdir, recording_time, quality, fps, shutter_speed, width, height, tuning_file, noise_reduction_mode, digital_zoom, imformat="RGB888", buffer_count=2, stats=None):
     
     print("Initializing recording...")
     print("Recording parameters:\n")
@@ -143,12 +196,21 @@ def picam2_record_mjpeg(filename, outdir, recording_time, quality, fps, shutter_
 
     picam2.start()
     time.sleep(2)
-    picam2.start_encoder(encoder,output,pts=outdir+filename+"_pts.txt")
+    capture_start = time.time()
+    picam2.start_encoder(encoder,output,pts=outdir+'/'+filename+"_pts.txt")
 
     time.sleep(recording_time)
     
     picam2.stop()
     picam2.stop_encoder()
+    if stats is not None:
+        stats.add('capture', time.time() - capture_start)
+    
+    if setup.index_mjpeg_videos == True:
+        index_start = time.time()
+        build_frame_index(output)
+        if stats is not None:
+            stats.add('frame index', time.time() - index_start)
     return output
     
     
@@ -181,133 +243,76 @@ def create_todays_folder(dirpath):
     else:
         return 0, todays_folder_path
     
-def trackTagsFromVid_MP4(frames_list, todays_folder_path, filename, tag_dictionary, box_type, now):
+def save_snapshot(frames_list, todays_folder_path, filename, stats):
+    '''save the middle frame as the recording's png snapshot, like track_frames does, for mp4 videos that are not tracked right away'''
+    snapshot_path = todays_folder_path + "/" + filename + '.png'
+    try:
+        with stats.stage('snapshot'):
+            cv2.imwrite(snapshot_path, frame_to_gray(frames_list[int(len(frames_list) / 2)]))
+        print(f'saved snapshot to {snapshot_path}')
+    except Exception as e:
+        logger.exception("Exception occurred: %s", str(e))
+    
+def add_to_nest_composite(todays_folder_path, filename, stats):
+    '''add the recording's snapshot to today's running nest composite, if incremental_nest_composite is on'''
+    if setup.incremental_nest_composite == True:
+        try:
+            with stats.stage('nest composite'):
+                snapshots_per_day = 24 * 60 // recording_interval() + 1
+                DayComposite(todays_folder_path, snapshots_per_day, setup.incremental_composite_bits).add(todays_folder_path + "/" + filename + '.png')
+            print("added the snapshot to today's nest composite")
+        except Exception as e:
+            logger.exception("Exception occurred: %s", str(e))
+    
+def trackTagsFromVid_MP4(frames_list, todays_folder_path, filename, tag_dictionary, box_type, now, stats=None):
     
     print('got here')
     print(tag_dictionary)
-    if tag_dictionary is None:
-        tag_dictionary = '4X4_50'
-        if isinstance(tag_dictionary, str):
-            if 'DICT' not in tag_dictionary:
-                tag_dictionary = "DICT_%s" % tag_dictionary
-            tag_dictionary = tag_dictionary.upper()
-            if not hasattr(cv2.aruco, tag_dictionary):
-                raise ValueError("Unknown tag dictionary: %s" % tag_dictionary)
-            tag_dictionary = getattr(cv2.aruco, tag_dictionary)
-    else:
-        if 'DICT' not in tag_dictionary:
-            tag_dictionary = "DICT_%s" % tag_dictionary
-        tag_dictionary = tag_dictionary.upper()
-        if not hasattr(cv2.aruco, tag_dictionary):
-            raise ValueError("Unknown tag dictionary: %s" % tag_dictionary)
-        tag_dictionary = getattr(cv2.aruco, tag_dictionary)
-    tag_dictionary = aruco.getPredefinedDictionary(tag_dictionary) 
-    parameters = aruco.DetectorParameters()
-    detector = aruco.ArucoDetector(tag_dictionary, parameters)
-    
-    if box_type=='custom':
-        #change these!
-        parameters.minMarkerPerimeterRate=0.02
-        parameters.adaptiveThreshWinSizeMin=5
-        parameters.adaptiveThreshWinSizeMax=29
-        parameters.adaptiveThreshWinSizeStep=3
-        parameters.polygonalApproxAccuracyRate=0.06
-        
-    elif box_type=='koppert':
-        #change these!
-        parameters.minMarkerPerimeterRate=0.03
-        parameters.adaptiveThreshWinSizeMin=5
-        parameters.adaptiveThreshWinSizeStep=6
-        parameters.polygonalApproxAccuracyRate=0.06
-        
-    elif box_type==None:
-        #change these!
-        parameters.minMarkerPerimeterRate=0.03
-        parameters.adaptiveThreshWinSizeMin=5
-        parameters.adaptiveThreshWinSizeStep=6
-        parameters.polygonalApproxAccuracyRate=0.06
-        
-    frame_num = 0
-    noID = []
-    raw = []
-    augs_csv = []
+    detector = create_detector(tag_dictionary, box_type, 'mp4', setup.detector_preset_file)
+    if setup.motion_gated_detection == True:
+        detector = MotionGatedDetector(detector, setup.full_detection_every, setup.motion_threshold, setup.motion_padding)
     
     start = time.time()
-
-    for index, frame in enumerate(frames_list):
-        
-        frame = frame[0]
-        
-        if index == int(len(frames_list) / 2 ):
-            #logging.debug(f"{todays_folder_path}{filename}.png'")
-            print(f"{todays_folder_path}/{filename}.png'")
-            frame_to_write = frame.copy()
-            gray = cv2.cvtColor(frame_to_write, cv2.COLOR_YUV2GRAY_I420)
-            #clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-            #cl1 = clahe.apply(gray)
-            #gray = cv2.cvtColor(cl1,cv2.COLOR_GRAY2RGB) #needlessly converts to 3d array from 2d array, less data when sticking with the 2d array
-            cv2.imwrite(todays_folder_path + "/" + filename + '.png', gray)
-        
-        try:
-            gray = cv2.cvtColor(frame, cv2.COLOR_YUV2GRAY_I420)
-            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-            cl1 = clahe.apply(gray)
-            gray = cv2.cvtColor(cl1,cv2.COLOR_GRAY2RGB)
-            
-        except:
-            print('converting to grayscale didnt work...')
-            continue
-        
-        corners, ids, rejectedImgPoints = detector.detectMarkers(gray)
-        
-        #for troubleshooting
-        #frame_markers = aruco.drawDetectedMarkers(gray.copy(), corners, ids)
-        #resized = cv2.resize(frame_markers, (1352,1013), interpolation = cv2.INTER_AREA)
-        #cv2.imshow("frame",resized)
-        #cv2.waitKey(5000)
-
-        for i in range(len(rejectedImgPoints)):
-            c = rejectedImgPoints[i][0]
-            xmean = c[:,0].mean() #for calculating the centroid
-            ymean = c[:,1].mean() #for calculating the centroid
-            xmean_top_point = (c[0,0] + c[1,0]) / 2 #for calculating the top point of the tag
-            ymean_top_point = (c[0,1] + c[1,1]) / 2 #for calculating the top point of the tag
-            noID.append( [filename, colony_number, now, frame_num, "X", float(xmean), float(ymean), float(xmean_top_point), float(ymean_top_point)] )
-            
-        if ids is not None:
-            for i in range(len(ids)):
-                c = corners[i][0]
-                xmean = c[:,0].mean() #for calculating the centroid
-                ymean = c[:,1].mean() #for calculating the centroid
-                xmean_top_point = (c[0,0] + c[1,0]) / 2 #for calculating the top point of the tag
-                ymean_top_point = (c[0,1] + c[1,1]) / 2 #for calculating the top point of the tag
-                raw.append( [filename, colony_number, now, frame_num, int(ids[i]), float(xmean), float(ymean), float(xmean_top_point), float(ymean_top_point)] )
-        frame_num += 1
-        print(f"processed frame {index}")  
+    if stats is None:
+        stats = PipelineStats(filename)
+    raw, noID, frame_num = track_frames(frames_list, filename, colony_number, now, detector, snapshot_path=todays_folder_path + "/" + filename + '.png', stats=stats)
     
+    add_to_nest_composite(todays_folder_path, filename, stats)
     
-    try:
-        df = pd.DataFrame(raw)
-        df = df.rename(columns = {0:'filename', 1:'colony number', 2:'datetime', 3:'frame', 4:'ID', 5:'centroidX', 6:'centroidY', 7:'frontX', 8:'frontY'})
-        df.to_csv(todays_folder_path + "/" + filename + '_raw.csv', index=False)
-        print(f'saved raw csv to {todays_folder_path}{filename}_raw.csv')
+    df = raw.to_dataframe()
+    df2 = noID.to_dataframe()
+    if setup.detection_output in ('log', 'both'):
+        try:
+            with stats.stage('detection log writing'):
+                log = write_detections(todays_folder_path, filename, colony_number, now, raw, noID, frame_num)
+            print(f'added detections to {log}')
+        except Exception as e:
+            logger.exception("Exception occurred: %s", str(e))
+    
+    if setup.detection_output in ('csv', 'both'):
+        try:
+            with stats.stage('csv writing'):
+                df.to_csv(todays_folder_path + "/" + filename + '_raw.csv', index=False)
+            print(f'saved raw csv to {todays_folder_path}{filename}_raw.csv')
 
-    except Exception as e:
-        logger.exception("Exception occurred: %s", str(e))
-        
-    try:
-        df2 = pd.DataFrame(noID)
-        df2 = df2.rename(columns = {0:'filename', 1:'colony number', 2:'datetime', 3:'frame', 4:'ID', 5:'centroidX', 6:'centroidY', 7:'frontX', 8:'frontY'})
-        df2.to_csv(todays_folder_path + "/" + filename + '_noID.csv', index=False)
-        print(f'saved noID csv to {todays_folder_path}{filename}_noID.csv')
-    except Exception as e:
-        logger.exception("Exception occurred: %s", str(e))
+        except Exception as e:
+            logger.exception("Exception occurred: %s", str(e))
+            
+        try:
+            with stats.stage('csv writing'):
+                df2.to_csv(todays_folder_path + "/" + filename + '_noID.csv', index=False)
+            print(f'saved noID csv to {todays_folder_path}{filename}_noID.csv')
+        except Exception as e:
+            logger.exception("Exception occurred: %s", str(e))
         
     
 
     print("Average number of tags found: " + str(len(df.index)/frame_num))
     tracking_time = time.time() - start
     print(f"Tag tracking took {round(tracking_time,2)} seconds, an average of {round(tracking_time / frame_num,2)} seconds per frame") 
+    if setup.motion_gated_detection == True:
+        print(f"motion gating skipped {round(detector.skipped_fraction * 100, 1)}% of pixels, {detector.full_searches} of {detector.frames} frames were searched in full")
+        logger.info(f"{filename}: motion gating skipped {round(detector.skipped_fraction * 100, 1)}% of pixels")
     
     if df.empty == True:
         logger.warning("df is empty")
@@ -321,109 +326,37 @@ def trackTagsFromVid_MP4(frames_list, todays_folder_path, filename, tag_dictiona
     
     
 #add my csv tracking alternative in for now, along with in the ram_capture script - this so I can add functions quickly 
-def trackTagsFromVid_MJPEG(filepath, todays_folder_path, filename, tag_dictionary, box_type, now):
+def trackTagsFromVid_MJPEG(filepath, todays_folder_path, filename, tag_dictionary, box_type, now, stats=None):
     print('got here')
     print(tag_dictionary)
-    if tag_dictionary is None:
-        tag_dictionary = '4X4_50'
-        if isinstance(tag_dictionary, str):
-            if 'DICT' not in tag_dictionary:
-                tag_dictionary = "DICT_%s" % tag_dictionary
-            tag_dictionary = tag_dictionary.upper()
-            if not hasattr(cv2.aruco, tag_dictionary):
-                raise ValueError("Unknown tag dictionary: %s" % tag_dictionary)
-            tag_dictionary = getattr(cv2.aruco, tag_dictionary)
-    else:
-        if 'DICT' not in tag_dictionary:
-            tag_dictionary = "DICT_%s" % tag_dictionary
-        tag_dictionary = tag_dictionary.upper()
-        if not hasattr(cv2.aruco, tag_dictionary):
-            raise ValueError("Unknown tag dictionary: %s" % tag_dictionary)
-        tag_dictionary = getattr(cv2.aruco, tag_dictionary)
-    tag_dictionary = aruco.getPredefinedDictionary(tag_dictionary) 
-    parameters = aruco.DetectorParameters()
-    detector = aruco.ArucoDetector(tag_dictionary, parameters)
-    
-    if box_type=='custom':
-        #change these!
-        parameters.minMarkerPerimeterRate=0.03
-        parameters.adaptiveThreshWinSizeMin=5
-        parameters.adaptiveThreshWinSizeStep=6
-        parameters.polygonalApproxAccuracyRate=0.06
-        
-    elif box_type=='koppert':
-        #change these!
-        parameters.minMarkerPerimeterRate=0.03
-        parameters.adaptiveThreshWinSizeMin=5
-        parameters.adaptiveThreshWinSizeStep=6
-        parameters.polygonalApproxAccuracyRate=0.06
-        
-    elif box_type==None:
-        #change these!
-        parameters.minMarkerPerimeterRate=0.03
-        parameters.adaptiveThreshWinSizeMin=5
-        parameters.adaptiveThreshWinSizeStep=6
-        parameters.polygonalApproxAccuracyRate=0.06
-
-    vid = cv2.VideoCapture(filepath)
-    
-    frame_num = 0
-    noID = []
-    raw = []
-    augs_csv = []
+    detector = create_detector(tag_dictionary, box_type, 'mjpeg', setup.detector_preset_file)
+    if setup.motion_gated_detection == True:
+        detector = MotionGatedDetector(detector, setup.full_detection_every, setup.motion_threshold, setup.motion_padding // setup.mjpeg_decode_reduction)
     
     start = time.time()
-
-    while(vid.isOpened()):
-
-        ret,frame = vid.read()
-        if ret == True:
-            print(frame.shape)
-            try:
-                gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-                clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-                cl1 = clahe.apply(gray)
-                gray = cv2.cvtColor(cl1,cv2.COLOR_GRAY2RGB)
-                
-            except:
-                print('converting to grayscale didnt work...')
-                continue
-                
-            corners, ids, rejectedImgPoints = detector.detectMarkers(gray)
-
-            for i in range(len(rejectedImgPoints)):
-                c = rejectedImgPoints[i][0]
-                xmean = c[:,0].mean() #for calculating the centroid
-                ymean = c[:,1].mean() #for calculating the centroid
-                xmean_top_point = (c[0,0] + c[1,0]) / 2 #for calculating the top point of the tag
-                ymean_top_point = (c[0,1] + c[1,1]) / 2 #for calculating the top point of the tag
-                noID.append( [filename, setup.colony_number, now, frame_num, "X", float(xmean), float(ymean), float(xmean_top_point), float(ymean_top_point)] )
-            
-            if ids is not None:
-                for i in range(len(ids)):
-                    c = corners[i][0]
-                    xmean = c[:,0].mean() #for calculating the centroid
-                    ymean = c[:,1].mean() #for calculating the centroid
-                    xmean_top_point = (c[0,0] + c[1,0]) / 2 #for calculating the top point of the tag
-                    ymean_top_point = (c[0,1] + c[1,1]) / 2 #for calculating the top point of the tag
-                    raw.append( [filename, setup.colony_number, now, frame_num, int(ids[i]), float(xmean), float(ymean), float(xmean_top_point), float(ymean_top_point)] )
-
-            frame_num += 1
-            print(f"processed frame {frame_num}")  
+    if stats is None:
+        stats = PipelineStats(filename)
+    raw, noID, frame_num = track_mjpeg(filepath, filename, setup.colony_number, now, detector, setup.mjpeg_decode_reduction, stats=stats)
         
-    df = pd.DataFrame(raw)
-    df = df.rename(columns = {0:'filename', 1:'colony number', 2:'datetime', 3:'frame', 4:'ID', 5:'centroidX', 6:'centroidY', 7:'frontX', 8:'frontY'})
-    df.to_csv(todays_folder_path + "/" + filename + '_raw.csv')
-    print('saved raw csv')
-    
-    df2 = pd.DataFrame(noID)
-    df2 = df2.rename(columns = {0:'filename', 1:'colony number', 2:'datetime', 3:'frame', 4:'ID', 5:'centroidX', 6:'centroidY', 7:'frontX', 8:'frontY'})
-    df2.to_csv(todays_folder_path + "/" + filename + '_noID.csv')
-    print('saved noID csv')
+    df = raw.to_dataframe()
+    df2 = noID.to_dataframe()
+    if setup.detection_output in ('log', 'both'):
+        with stats.stage('detection log writing'):
+            log = write_detections(todays_folder_path, filename, setup.colony_number, now, raw, noID, frame_num)
+        print(f'added detections to {log}')
+    
+    if setup.detection_output in ('csv', 'both'):
+        with stats.stage('csv writing'):
+            raw_path, noID_path = write_tracking_csvs(df, df2, todays_folder_path, filename)
+        print(f'saved raw csv to {raw_path}')
+        print(f'saved noID csv to {noID_path}')
 
     print("Average number of tags found: " + str(len(df.index)/frame_num))
     tracking_time = time.time() - start
     print(f"Tag tracking took {tracking_time} seconds, an average of {tracking_time / frame_num} seconds per frame") 
+    if setup.motion_gated_detection == True:
+        print(f"motion gating skipped {round(detector.skipped_fraction * 100, 1)}% of pixels, {detector.full_searches} of {detector.frames} frames were searched in full")
+        logger.info(f"{filename}: motion gating skipped {round(detector.skipped_fraction * 100, 1)}% of pixels")
     return df, df2, frame_num
 
 
@@ -479,31 +412,57 @@ def main():
     print(args.quality)
     print(args.frames_per_second)
     
+    '''times each step of the recording, written to the log as one json line at the end'''
+    stats = PipelineStats(filename)
+    
     if args.codec == 'mp4':
-        filepath, frames_list = picam2_record_mp4(filename,todays_folder_path, args.recording_time, args.frames_per_second, args.shutter, args.width, args.height, args.tuning_file, args.noise_reduction, args.digital_zoom)
-        if setup.track_recorded_videos == True:
-            print('starting to track tags from the saved video!')
-            df, df2, frame_num = trackTagsFromVid_MP4(frames_list, todays_folder_path, filename, args.dictionary, args.box_type, now)
+        filepath, frames_list, writer = picam2_record_mp4(filename,todays_folder_path, args.recording_time, args.frames_per_second, args.shutter, args.width, args.height, args.tuning_file, args.noise_reduction, args.digital_zoom, stats=stats)
+        if setup.track_recorded_videos == True and setup.defer_tracking == False:
+            print('starting to track tags from the captured frames while the video is saved!')
+            df, df2, frame_num = trackTagsFromVid_MP4(frames_list, todays_folder_path, filename, args.dictionary, args.box_type, now, stats=stats)
             
             if setup.interpolate_data == True and df.empty == False:
-                df = interpolate(df, setup.max_seconds_gap, setup.actual_frames_per_second)
+                with stats.stage('interpolate'):
+                    df = interpolate_tracks(df, setup.max_seconds_gap, setup.actual_frames_per_second, setup.interpolation_method)
                 
             if df.empty == False and setup.calculate_behavior_metrics == True:
-                behavioral_metrics.calculate_behavior_metrics(df, setup.actual_frames_per_second, setup.moving_threshold, todays_folder_path, filename)
                 print("Calculating behavior metrics")
+                with stats.stage('behavior metrics'):
+                    behavioral_metrics.calculate_behavior_metrics(df, setup.actual_frames_per_second, setup.moving_threshold, todays_folder_path, filename)
+        
+        if setup.track_recorded_videos == True and setup.defer_tracking == True:
+            '''the snapshot is taken from the frames in memory, before they are freed, since the queued job only has the video'''
+            save_snapshot(frames_list, todays_folder_path, filename, stats)
+            add_to_nest_composite(todays_folder_path, filename, stats)
+        
+        with stats.stage('waiting for mp4 writer'):
+            writer.join()
+        stats.add('mp4 encoding (background)', writer.seconds, writer.frames_written)
+        if setup.capture_luma_only == True:
+            frames_list.close()
+        if setup.track_recorded_videos == True and setup.defer_tracking == True:
+            job = enqueue(setup.tracking_queue_path, filepath, todays_folder_path, filename, now, args.codec, args.dictionary, args.box_type)
+            print(f'added {filepath} to the tracking queue: {job}')
     
     if args.codec == 'mjpeg':
-        filepath = picam2_record_mjpeg(filename,todays_folder_path, args.recording_time, args.quality, args.frames_per_second, args.width, args.height, args.tuning_file, args.noise_reduction, args.digital_zoom)
-        if setup.track_recorded_videos == True:
+        filepath = picam2_record_mjpeg(filename,todays_folder_path, args.recording_time, args.quality, args.frames_per_second, args.width, args.height, args.tuning_file, args.noise_reduction, args.digital_zoom, stats=stats)
+        if setup.track_recorded_videos == True and setup.defer_tracking == True:
+            job = enqueue(setup.tracking_queue_path, filepath, todays_folder_path, filename, now, args.codec, args.dictionary, args.box_type)
+            print(f'added {filepath} to the tracking queue: {job}')
+        elif setup.track_recorded_videos == True:
             print('starting to track tags from the saved video!')
-            df, df2, frame_num = trackTagsFromVid_MJPEG(filepath, todays_folder_path, filename, args.dictionary, args.box_type, now)
+            df, df2, frame_num = trackTagsFromVid_MJPEG(filepath, todays_folder_path, filename, args.dictionary, args.box_type, now, stats=stats)
         
             if setup.interpolate_data == True and df.empty == False:
-                df = interpolate(df, setup.max_seconds_gap, setup.actual_frames_per_second)
+                with stats.stage('interpolate'):
+                    df = interpolate_tracks(df, setup.max_seconds_gap, setup.actual_frames_per_second, setup.interpolation_method)
 
             if df.empty == False and setup.calculate_behavior_metrics == True:
-                behavioral_metrics.calculate_behavior_metrics(df, setup.actual_frames_per_second, setup.moving_threshold, todays_folder_path, filename)
                 print("Calculating behavior metrics")
+                with stats.stage('behavior metrics'):
+                    behavioral_metrics.calculate_behavior_metrics(df, setup.actual_frames_per_second, setup.moving_threshold, todays_folder_path, filename)
+    
+    logger.info(stats.to_json())
         
 if __name__ == '__main__':
     
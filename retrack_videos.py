@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+'''
+Re-track an archive of recorded BumbleBox videos (.mjpeg and .mp4) with the current tracking settings, writing
+_raw.csv/_noID.csv files next to each video. Videos are tracked in parallel with a process pool, and every finished
+video is added to a manifest file so an interrupted run can be restarted without re-tracking finished videos.
+'''
+
+import argparse
+import csv
+import os
+import sys
+import time
+import logging
+from multiprocessing import Pool
+
+import cv2
+import setup
+from tag_tracking import create_detector, parse_video_filename, resolve_preset_path, track_mjpeg, track_video, write_tracking_csvs
+
+VIDEO_EXTENSIONS = ('.mjpeg', '.mp4')
+MANIFEST_COLUMNS = ['video', 'tag_dictionary', 'box_type', 'preset', 'frames', 'tags', 'seconds']
+
+logger = logging.getLogger(__name__)
+
+
+def find_videos(source):
+    '''walk the source directory tree and return the paths of all videos in it, sorted'''
+    videos = []
+    for dirpath, _, files in os.walk(source):
+        for f in files:
+            if f.endswith(VIDEO_EXTENSIONS):
+                videos.append(os.path.join(dirpath, f))
+    return sorted(videos)
+
+
+def read_manifest(manifest_path, tag_dictionary, box_type, preset_file):
+    '''return the set of videos that were already tracked with the same dictionary, box_type and preset file'''
+    finished = set()
+    if not os.path.exists(manifest_path):
+        return finished
+    with open(manifest_path, newline='') as f:
+        for row in csv.DictReader(f):
+            if row['tag_dictionary'] == str(tag_dictionary) and row['box_type'] == str(box_type) and row.get('preset', '') == str(preset_file):
+                finished.add(row['video'])
+    return finished
+
+
+def init_worker():
+    '''each worker tracks a whole video on its own, so keep OpenCV from starting its own threads in every process'''
+    cv2.setNumThreads(1)
+
+
+def retrack_video(job):
+    '''track one video and write its csvs next to it. Returns a manifest row, or the error message if tracking failed'''
+    video, tag_dictionary, box_type, colony_number, reduction, preset_file = job
+    folder, name = os.path.split(video)
+    filename, ext = os.path.splitext(name)
+    parsed_colony_number, now = parse_video_filename(filename)
+    if colony_number is None:
+        colony_number = parsed_colony_number
+    codec = ext.lstrip('.')
+
+    start = time.time()
+    try:
+        detector = create_detector(tag_dictionary, box_type, codec, preset_file)
+        if codec == 'mjpeg':
+            raw, noID, frame_num = track_mjpeg(video, filename, colony_number, now, detector, reduction, verbose=False)
+        else:
+            raw, noID, frame_num = track_video(video, filename, colony_number, now, detector, verbose=False)
+        write_tracking_csvs(raw.to_dataframe(), noID.to_dataframe(), folder, filename)
+    except Exception as e:
+        return video, str(e)
+
+    return video, {'video': video, 'tag_dictionary': tag_dictionary, 'box_type': box_type, 'preset': str(preset_file), 'frames': frame_num, 'tags': len(raw), 'seconds': round(time.time() - start, 3)}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(prog='Re-track a folder of recorded videos with the current tracking settings')
+    parser.add_argument('-s', '--source', type=str, required=True, help='folder to search (including subfolders) for .mjpeg and .mp4 videos')
+    parser.add_argument('-d', '--dictionary', type=str, default=setup.tag_dictionary, help='the aruco tag dictionary, for example 4X4_50')
+    parser.add_argument('-b', '--box_type', type=str, default=setup.box_type, choices=['custom','koppert'], help='which set of preset tracking parameters to use')
+    parser.add_argument('-p', '--preset', type=str, default=setup.detector_preset_file, help='tracking settings file made by tune_detector.py, used instead of the box_type presets')
+    parser.add_argument('-c', '--colony_number', type=str, default=None, help='colony number to write in the csvs. By default it is read from the bumblebox-XX hostname in each filename')
+    parser.add_argument('-r', '--reduction', type=int, default=setup.mjpeg_decode_reduction, choices=[1, 2, 4, 8], help='decode mjpeg frames at 1/2, 1/4 or 1/8 size for faster tracking (mp4 videos are always tracked at full size)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='number of videos to track at the same time')
+    parser.add_argument('-m', '--manifest', type=str, default=None, help='file that records finished videos so the run can be resumed. Defaults to retrack_manifest.csv inside the source folder')
+    parser.add_argument('-f', '--force', action='store_true', help='re-track videos even if the manifest says they are finished')
+    args = parser.parse_args()
+    if args.preset is not None and not os.path.exists(resolve_preset_path(args.preset)):
+        parser.error(f"preset file {args.preset} not found")
+
+    source = os.path.expanduser(args.source)
+    manifest_path = args.manifest or os.path.join(source, 'retrack_manifest.csv')
+
+    videos = find_videos(source)
+    finished = set() if args.force else read_manifest(manifest_path, args.dictionary, args.box_type, args.preset)
+    todo = [v for v in videos if v not in finished]
+    print(f"Found {len(videos)} videos in {source}, {len(videos) - len(todo)} already tracked, {len(todo)} to go")
+    if not todo:
+        return 0
+
+    write_header = not os.path.exists(manifest_path)
+    jobs = [(v, args.dictionary, args.box_type, args.colony_number, args.reduction, args.preset) for v in todo]
+    total_frames = 0
+    failed = 0
+    start = time.time()
+
+    with open(manifest_path, 'a', newline='') as manifest, Pool(args.workers, initializer=init_worker) as pool:
+        writer = csv.DictWriter(manifest, fieldnames=MANIFEST_COLUMNS)
+        if write_header:
+            writer.writeheader()
+
+        for done, (video, result) in enumerate(pool.imap_unordered(retrack_video, jobs), start=1):
+            if isinstance(result, str):
+                failed += 1
+                print(f"Error tracking {video}: {result}")
+                logger.error(f"Error tracking {video}: {result}")
+                continue
+
+            writer.writerow(result)
+            manifest.flush()
+            total_frames += result['frames']
+            elapsed = time.time() - start
+            print(f"[{done}/{len(jobs)}] {video}: {result['frames']} frames in {result['seconds']}s ({round(total_frames / elapsed, 2)} frames/sec overall)")
+
+    elapsed = time.time() - start
+    print(f"Tracked {len(jobs) - failed} videos ({total_frames} frames) in {round(elapsed, 2)} seconds, {round(total_frames / elapsed, 2)} frames/sec with {args.workers} workers")
+    if failed:
+        print(f"{failed} videos could not be tracked, run again to retry them")
+    return 0
+
+
+if __name__ == '__main__':
+    status = main()
+    logging.shutdown()
+    sys.exit(status)
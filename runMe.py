@@ -21,6 +21,8 @@ import broodFunctions
 import warnings
 import shapely
 import copy
+from tracklet_linking import link_unidentified
+from gap_filling import fill_gaps
 
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 warnings.filterwarnings("ignore", category=FutureWarning)
@@ -34,6 +36,8 @@ def parse_opt():
     parser.add_argument('--whole', '-w', action='store_true', help='Do not split frame into two when analyzing.')
     parser.add_argument('--bombus', '-z', action='store_true', help='Data is from rig, run alternative search for data files.')
     parser.add_argument('--outFile', '-o', type=str, default='Analysis.csv', help='Path to output file. Defaults to "Analysis.csv".')
+    parser.add_argument('--link', '-l', action='store_true', help='Link unidentified detections in the matching _noID.csv file to known tags before analyzing (only for _raw.csv files).')
+    parser.add_argument('--linkDistance', '-d', type=float, default=50, help='Largest distance in pixels between an unidentified detection and where a tag should be for it to be linked. Defaults to 50.')
 
     return parser.parse_args()
 
@@ -42,7 +46,8 @@ def restructure_tracking_data(rawOneLR):
     # Drop any duplicate rows
     rawOneLR = rawOneLR.drop_duplicates(subset=['ID', 'frame'])
     xs = rawOneLR.pivot(index="frame", columns='ID', values=['centroidX', 'centroidY'])
-    return xs.interpolate(method='linear', limit=2, axis='index', limit_direction='both')
+    # Fill up to 2 frames next to every known position, the same as interpolate(limit=2, limit_direction='both')
+    return pd.DataFrame(fill_gaps(xs.to_numpy(), max_gap=2, fill_edges=True, partial=True), index=xs.index, columns=xs.columns)
 
 def minDistance(A, B, P) : 
     # vector AB 
@@ -306,6 +311,10 @@ def main():
                 print('Error reading file ' + f + ', skipping...')
                 continue
 
+            if opt['link'] and v.endswith('_raw.csv') and os.path.exists(v[:-len('_raw.csv')] + '_noID.csv'):
+                trackingResults = link_unidentified(trackingResults, pd.read_csv(v[:-len('_raw.csv')] + '_noID.csv'), max_distance=opt['linkDistance'])
+                print('Linked ' + str(int(trackingResults['linked'].sum())) + ' unidentified detections to known tags')
+
             if opt['whole']:
                 trackingResults['LR'] = "Whole"
             else:
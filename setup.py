@@ -36,6 +36,9 @@ recording_frequency = 30
 
 track_recorded_videos = True
 
+'''where tracked tag positions are saved: 'csv' saves a _raw.csv and a _noID.csv file per recording, 'log' adds every recording to one compact .detections file per day (see detection_log.py, which can also turn it back into csv files), and 'both' does both. The analysis scripts read csv files, so keep 'csv' or 'both' unless you export the log before analysing'''
+detection_output = 'csv'
+
 
 '''in microseconds'''
 shutter_speed = 2500
@@ -49,6 +52,18 @@ actual_frames_per_second = 4.4
 ''' the options are 'mp4' or 'mjpeg' '''
 codec = 'mp4'
 
+'''mjpeg videos are decoded straight to grayscale for tag tracking. Setting this to 2, 4 or 8 decodes frames at 1/2, 1/4 or 1/8 size, which is much faster but only works if tags are still large enough to be found at that size. Leave at 1 for full resolution'''
+mjpeg_decode_reduction = 1
+
+'''after each mjpeg recording, save a .idx file with the position and timestamp of every frame in the video. This lets later scripts jump straight to any frame (for example to sample frames for nest images) or decode a video in parallel'''
+index_mjpeg_videos = True
+
+'''mp4 recording only: if True, only the grayscale (luma) part of each frame is kept during capture, in a buffer that is set aside before recording starts. This uses a third less memory and the mp4 video is saved in grayscale. Tag tracking only uses grayscale either way'''
+capture_luma_only = False
+
+'''only used if capture_luma_only is True: set this to a file path (for example '/mnt/bumblebox/luma_buffer.dat') to keep the captured frames in a file on disk instead of in memory, for recordings too long to fit in RAM. None keeps them in memory'''
+luma_buffer_path = None
+
 '''this takes values 0-100, but is only relevant for mjpeg video recording'''
 quality = 95
 
@@ -62,6 +77,13 @@ elif infrared_recording == False:
 
 data_folder_path = '/mnt/bumblebox/data'
 
+'''if True (and track_recorded_videos is True), videos are not tracked right after recording but added to a queue, and tracking_queue.py (which has to be left running, for example started from crontab with @reboot) tracks them in the time between recordings. This keeps long tracking runs from delaying the next recording. mp4 videos are then tracked from the saved video file instead of the frames in memory'''
+defer_tracking = False
+tracking_queue_path = data_folder_path + '/tracking_queue'
+tracking_queue_margin = 30 #seconds, tracking stops this long before each recording starts and waits this long after it ends
+tracking_queue_max_attempts = 3 #a video that fails to track this many times is moved to the failed folder of the queue
+tracking_queue_max_interruptions = 3 #a video interrupted by recordings this many times is tracked through the next recording, so it isn't put off forever
+
 '''This takes options 'Auto', 'HighQuality', 'Fast', or 'Off'. Would recommend using 'Auto' to start off - using HighQuality will impact the max framerate possible'''
 noise_reduction_mode = 'Auto' 
 
@@ -75,6 +97,15 @@ tag_dictionary = '4X4_50'
 '''the options are None, 'custom', or 'koppert' - set this to either custom or koppert to access preset tracking settings for'''
 box_type = 'custom'
 
+'''path to a tracking settings file made by tune_detector.py, for example '/home/pi/Desktop/BumbleBox/detector_preset.json' (a relative path is looked up in the BumbleBox folder). Its settings replace the box_type presets. None uses the box_type presets only'''
+detector_preset_file = None
+
+'''if True, each frame is compared with the last one and tags are only searched for in the parts of the frame that changed (plus motion_padding pixels around them). Tags in parts that did not change keep their position from the frame before. Much faster when bees sit still, but a tag that moves very slightly may keep its old position until the next full search'''
+motion_gated_detection = False
+full_detection_every = 10 #search the whole frame at least every this many frames
+motion_threshold = 12 #change in gray level (0-255) that counts as motion
+motion_padding = 100 #pixels, should be at least the width of a tag
+
 ''' Interpolates data between missing frames if set to True. For example, if a bee is tracked in frames 2,3, and 6, this would draw a line
 between the bee's position at frames 3 and 6, and fill in its position along that line for frames 4 and 5.
 max_seconds_gap sets the seconds threshold after which the data will not be interpolated between two positions. 
@@ -82,6 +113,7 @@ This is useful because if a bee is tracked in frame 1 and frame 50, you wouldnt
 
 interpolate_data = True
 max_seconds_gap = 3
+interpolation_method = 'linear' #'linear' draws a line between the positions on each side of a gap, 'nearest' repeats the closer of the two
 
 
 calculate_behavior_metrics = True
@@ -125,3 +157,9 @@ number_of_images = 60 #the number of images that will be used from today's data
 
 composite_images_per_day = 1 #Needs to be 1 for now
 
+'''add each recording's snapshot png to a running composite of the day as soon as it is saved (nest_histogram.npy in the day folder), so today's nest image can be saved at any time with nest_composite.py -d <day folder> -o <png>, without reading the day's images again'''
+incremental_nest_composite = False
+
+'''bits per pixel value the running composite's histogram keeps: 4 (16 counters per pixel) is within 8 gray levels of the exact median, each extra bit doubles the file size, 8 is exact'''
+incremental_composite_bits = 4
+
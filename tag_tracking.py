@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+'''helpers shared by the tag tracking functions in record_video.py'''
+
+import json
+import logging
+import os
+import cv2
+from cv2 import aruco
+import numpy as np
+import pandas as pd
+from mjpeg_reader import iter_gray_frames
+from pipeline_stats import PipelineStats
+
+logger = logging.getLogger(__name__)
+
+
+'''tracking settings for each box_type, set on the DetectorParameters before the detector is created. mp4 videos are tracked from the raw luma plane and mjpeg videos from decoded jpegs, so each has its own presets'''
+DETECTOR_PRESETS = {
+    'mp4': {
+        'custom': {'minMarkerPerimeterRate': 0.02, 'adaptiveThreshWinSizeMin': 5, 'adaptiveThreshWinSizeMax': 29, 'adaptiveThreshWinSizeStep': 3, 'polygonalApproxAccuracyRate': 0.06}, #change these!
+        'koppert': {'minMarkerPerimeterRate': 0.03, 'adaptiveThreshWinSizeMin': 5, 'adaptiveThreshWinSizeStep': 6, 'polygonalApproxAccuracyRate': 0.06}, #change these!
+        None: {'minMarkerPerimeterRate': 0.03, 'adaptiveThreshWinSizeMin': 5, 'adaptiveThreshWinSizeStep': 6, 'polygonalApproxAccuracyRate': 0.06}, #change these!
+    },
+    'mjpeg': {
+        'custom': {'minMarkerPerimeterRate': 0.03, 'adaptiveThreshWinSizeMin': 5, 'adaptiveThreshWinSizeStep': 6, 'polygonalApproxAccuracyRate': 0.06}, #change these!
+        'koppert': {'minMarkerPerimeterRate': 0.03, 'adaptiveThreshWinSizeMin': 5, 'adaptiveThreshWinSizeStep': 6, 'polygonalApproxAccuracyRate': 0.06}, #change these!
+        None: {'minMarkerPerimeterRate': 0.03, 'adaptiveThreshWinSizeMin': 5, 'adaptiveThreshWinSizeStep': 6, 'polygonalApproxAccuracyRate': 0.06}, #change these!
+    },
+}
+
+TRACKING_COLUMNS = ['filename', 'colony number', 'datetime', 'frame', 'ID', 'centroidX', 'centroidY', 'frontX', 'frontY']
+
+
+class DetectionRecords:
+    '''
+    Column buffers for the tag detections of one video.
+
+    Detections are stored in growable NumPy arrays (one per column) instead of a list of
+    row lists, and the per-video metadata (filename, colony number, datetime) is stored once
+    and only broadcast to every row when the DataFrame is built. If identified is False the
+    records are rejected candidates and their ID column is filled with "X", like the _noID.csv files.
+    '''
+
+    def __init__(self, filename, colony_number, now, identified=True, capacity=1024):
+        self.filename = filename
+        self.colony_number = colony_number
+        self.now = now
+        self.identified = identified
+        self.size = 0
+        self.frame = np.empty(capacity, dtype=np.int32)
+        self.ids = np.empty(capacity, dtype=np.int32)
+        self.coords = np.empty((capacity, 4), dtype=np.float32) #centroidX, centroidY, frontX, frontY
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, n):
+        if self.size + n <= len(self.frame):
+            return
+        capacity = max(2 * len(self.frame), self.size + n)
+        self.frame = np.resize(self.frame, capacity)
+        self.ids = np.resize(self.ids, capacity)
+        self.coords = np.resize(self.coords, (capacity, 4))
+
+    def add_frame(self, frame_num, corners, ids=None, scale=1):
+        '''
+        Add all detections of one frame. corners is the list of (1,4,2) corner arrays returned by
+        detectMarkers (or its rejectedImgPoints), ids the matching (n,1) id array for identified records.
+        If the frame was decoded at reduced size, scale is the reduction factor and the corners are
+        mapped back to full resolution pixel coordinates.
+        '''
+        n = len(corners)
+        if n == 0:
+            return
+        self._reserve(n)
+        c = np.asarray(corners, dtype=np.float32).reshape(n, 4, 2)
+        if scale != 1:
+            c = c * scale + (scale - 1) / 2
+        end = self.size + n
+        self.frame[self.size:end] = frame_num
+        if ids is not None:
+            self.ids[self.size:end] = np.asarray(ids).reshape(n)
+        self.coords[self.size:end, 0:2] = c.mean(axis=1) #centroid of the four corners
+        self.coords[self.size:end, 2:4] = (c[:, 0] + c[:, 1]) / 2 #midpoint of the top edge of the tag
+        self.size = end
+
+    def to_dataframe(self):
+        '''Build the DataFrame with the same columns as the _raw.csv and _noID.csv files'''
+        n = self.size
+        coords = self.coords[:n].astype(np.float64)
+        return pd.DataFrame({
+            'filename': np.full(n, self.filename, dtype=object),
+            'colony number': np.full(n, self.colony_number, dtype=object),
+            'datetime': np.full(n, self.now, dtype=object),
+            'frame': self.frame[:n].copy(),
+            'ID': self.ids[:n].copy() if self.identified else np.full(n, 'X', dtype=object),
+            'centroidX': coords[:, 0],
+            'centroidY': coords[:, 1],
+            'frontX': coords[:, 2],
+            'frontY': coords[:, 3],
+        }, columns=TRACKING_COLUMNS)
+
+
+def get_tag_dictionary(tag_dictionary):
+    '''turn a dictionary name like '4X4_50' or 'DICT_4X4_50' (None defaults to 4X4_50) into an aruco dictionary'''
+    if tag_dictionary is None:
+        tag_dictionary = '4X4_50'
+    if 'DICT' not in tag_dictionary:
+        tag_dictionary = "DICT_%s" % tag_dictionary
+    tag_dictionary = tag_dictionary.upper()
+    if not hasattr(cv2.aruco, tag_dictionary):
+        raise ValueError("Unknown tag dictionary: %s" % tag_dictionary)
+    return aruco.getPredefinedDictionary(getattr(cv2.aruco, tag_dictionary))
+
+
+def resolve_preset_path(preset_file):
+    '''
+    absolute path of a preset file. A relative path is looked up from the working directory and then from the folder
+    this file is in (the BumbleBox folder with setup.py), since record_video.py runs from cron in another directory
+    '''
+    if os.path.isabs(preset_file) or os.path.exists(preset_file):
+        return os.path.abspath(preset_file)
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), preset_file)
+
+
+def load_detector_preset(preset_file):
+    '''read a preset json file saved by tune_detector.py: the DetectorParameters values and the codec and box_type they were tuned for'''
+    with open(preset_file) as f:
+        return json.load(f)
+
+
+def create_detector(tag_dictionary, box_type, codec='mjpeg', preset_file=None, parameters_override=None):
+    '''
+    create an ArucoDetector using the DETECTOR_PRESETS of the given codec and box_type. Values from a tuned preset
+    file (see tune_detector.py) and then from the parameters_override dict replace the preset values. A preset file
+    that can't be found, or that was tuned for another codec or box_type, is reported and left out, so a wrong path
+    in setup.py doesn't stop every video being tracked
+    '''
+    settings = dict(DETECTOR_PRESETS[codec].get(box_type, {}))
+    if preset_file is not None:
+        path = resolve_preset_path(preset_file)
+        if os.path.exists(path):
+            preset = load_detector_preset(path)
+            tuned_for = (preset.get('codec', codec), preset.get('box_type', box_type))
+            if tuned_for == (codec, box_type):
+                settings.update(preset['parameters'])
+            else:
+                print(f"detector preset file {preset_file} was tuned for {tuned_for[0]} {tuned_for[1]} videos, using the {codec} {box_type} presets")
+                logger.warning(f"detector preset file {preset_file} was tuned for {tuned_for[0]} {tuned_for[1]}, not {codec} {box_type}, using the built-in presets")
+        else:
+            print(f"detector preset file {preset_file} not found (looked for {path}), using the {box_type} presets")
+            logger.warning(f"detector preset file {preset_file} not found, using the {box_type} presets")
+    if parameters_override is not None:
+        settings.update(parameters_override)
+
+    parameters = aruco.DetectorParameters()
+    for name, value in settings.items():
+        setattr(parameters, name, value)
+    return aruco.ArucoDetector(get_tag_dictionary(tag_dictionary), parameters)
+
+
+def parse_video_filename(filename):
+    '''
+    split a recording name like bumblebox-01_2024-06-20_18_25_30 into its colony number ('01') and the
+    datetime string ('_2024-06-20_18_25_30') that record_video.main writes in the datetime column
+    '''
+    hostname, _, timestamp = filename.partition('_')
+    colony_number = hostname.rsplit('-', 1)[-1]
+    if not colony_number.isdigit():
+        colony_number = None
+    return colony_number, '_' + timestamp
+
+
+def frame_to_gray(frame):
+    '''grayscale image of a captured frame, which is either a [yuv420] list from picam2_record_mp4 or a luma plane from a LumaRingBuffer'''
+    if isinstance(frame, list):
+        return cv2.cvtColor(frame[0], cv2.COLOR_YUV2GRAY_I420)
+    return frame
+
+
+def track_frames(frames_list, filename, colony_number, now, detector, snapshot_path=None, verbose=True, stats=None):
+    '''
+    track tags in the frames captured by picam2_record_mp4 (see frame_to_gray). If snapshot_path is given, the middle
+    frame is also saved there as a grayscale png. Time spent in each step is added to stats (a PipelineStats), and a
+    progress line is printed every few seconds if verbose. Returns the same values as track_video.
+    '''
+    if stats is None:
+        stats = PipelineStats(filename, progress_interval=10.0 if verbose else None)
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+
+    frame_num = 0
+    noID = DetectionRecords(filename, colony_number, now, identified=False)
+    raw = DetectionRecords(filename, colony_number, now)
+
+    for index, frame in enumerate(frames_list):
+
+        try:
+            with stats.stage('color conversion'):
+                gray = frame_to_gray(frame)
+
+        except:
+            print('converting to grayscale didnt work...')
+            continue
+
+        if snapshot_path is not None and index == int(len(frames_list) / 2 ):
+            print(snapshot_path)
+            with stats.stage('snapshot'):
+                cv2.imwrite(snapshot_path, gray)
+
+        with stats.stage('clahe'):
+            gray = clahe.apply(gray)
+
+        with stats.stage('detection'):
+            corners, ids, rejectedImgPoints = detector.detectMarkers(gray)
+
+        #for troubleshooting
+        #frame_markers = aruco.drawDetectedMarkers(gray.copy(), corners, ids)
+        #resized = cv2.resize(frame_markers, (1352,1013), interpolation = cv2.INTER_AREA)
+        #cv2.imshow("frame",resized)
+        #cv2.waitKey(5000)
+
+        with stats.stage('record building'):
+            noID.add_frame(frame_num, rejectedImgPoints)
+            if ids is not None:
+                raw.add_frame(frame_num, corners, ids)
+        frame_num += 1
+        stats.frame_done()
+
+    return raw, noID, frame_num
+
+
+def track_video(filepath, filename, colony_number, now, detector, verbose=True, stats=None):
+    '''
+    track tags in every frame of a saved video file (mjpeg or mp4) read with cv2.VideoCapture. Returns the
+    identified and rejected DetectionRecords and the number of frames that were tracked. stats and verbose
+    work like in track_frames.
+    '''
+    if stats is None:
+        stats = PipelineStats(filename, progress_interval=10.0 if verbose else None)
+    vid = cv2.VideoCapture(filepath)
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+
+    frame_num = 0
+    noID = DetectionRecords(filename, colony_number, now, identified=False)
+    raw = DetectionRecords(filename, colony_number, now)
+
+    while(vid.isOpened()):
+
+        with stats.stage('decode'):
+            ret,frame = vid.read()
+        if ret == False:
+            break
+        try:
+            with stats.stage('color conversion'):
+                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            with stats.stage('clahe'):
+                gray = clahe.apply(gray) #detectMarkers works on single channel images, no need to convert back to RGB
+
+        except:
+            print('converting to grayscale didnt work...')
+            continue
+
+        with stats.stage('detection'):
+            corners, ids, rejectedImgPoints = detector.detectMarkers(gray)
+
+        with stats.stage('record building'):
+            noID.add_frame(frame_num, rejectedImgPoints)
+            if ids is not None:
+                raw.add_frame(frame_num, corners, ids)
+
+        frame_num += 1
+        stats.frame_done()
+
+    vid.release()
+    return raw, noID, frame_num
+
+
+def track_mjpeg(filepath, filename, colony_number, now, detector, reduction=1, verbose=True, stats=None):
+    '''
+    track tags in every frame of an mjpeg file, decoding each jpeg straight to grayscale (at 1/reduction size if
+    reduction is 2, 4 or 8) instead of going through cv2.VideoCapture. Returns the same values as track_video,
+    with coordinates in full resolution pixels. stats and verbose work like in track_frames.
+    '''
+    if stats is None:
+        stats = PipelineStats(filename, progress_interval=10.0 if verbose else None)
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+
+    frame_num = 0
+    noID = DetectionRecords(filename, colony_number, now, identified=False)
+    raw = DetectionRecords(filename, colony_number, now)
+    frames = iter_gray_frames(filepath, reduction)
+
+    while True:
+
+        with stats.stage('decode'):
+            gray = next(frames, None)
+        if gray is None:
+            break
+
+        with stats.stage('clahe'):
+            gray = clahe.apply(gray)
+        with stats.stage('detection'):
+            corners, ids, rejectedImgPoints = detector.detectMarkers(gray)
+
+        with stats.stage('record building'):
+            noID.add_frame(frame_num, rejectedImgPoints, scale=reduction)
+            if ids is not None:
+                raw.add_frame(frame_num, corners, ids, scale=reduction)
+
+        frame_num += 1
+        stats.frame_done()
+
+    return raw, noID, frame_num
+
+
+def write_tracking_csvs(df, df2, folder, filename):
+    '''write the _raw.csv and _noID.csv files for a tracked video, returns their paths'''
+    raw_path = os.path.join(folder, filename + '_raw.csv')
+    noID_path = os.path.join(folder, filename + '_noID.csv')
+    df.to_csv(raw_path, index=False)
+    df2.to_csv(noID_path, index=False)
+    return raw_path, noID_path
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+'''
+Deferred tag tracking. With defer_tracking = True in setup.py, record_video.py does not track a video right after
+recording it but adds it to a queue folder, and this script (left running, for example started from crontab with
+@reboot) tracks the queued videos between recordings:
+
+    python3 tracking_queue.py
+
+The queue is a folder (setup.tracking_queue_path) with one small json job file per video in pending/, running/,
+done/ or failed/. A job is moved to running/ while it is tracked and to done/ once its outputs are saved, so after a
+reboot or crash the jobs left in running/ are put back in pending/ and tracked again; nothing is lost, and because the
+outputs are only written at the end (and a clip already in the detection log is not added again), nothing is saved
+twice. Before each recording starts the worker stops tracking (putting the current job back in the queue) and waits
+until the recording is done, so tracking never slows down the camera.
+'''
+
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import pwd
+import sys
+import time
+from datetime import datetime, timedelta
+
+import setup
+from detection_log import has_clip, log_path, write_detections
+from gap_filling import interpolate_tracks
+from motion_gate import MotionGatedDetector
+from tag_tracking import create_detector, track_mjpeg, track_video, write_tracking_csvs
+
+QUEUE_STATES = ('pending', 'running', 'done', 'failed')
+
+logger = logging.getLogger(__name__)
+
+
+def queue_folders(queue_path):
+    '''create the queue folders if needed and return {state: folder}'''
+    folders = {state: os.path.join(queue_path, state) for state in QUEUE_STATES}
+    for folder in folders.values():
+        os.makedirs(folder, exist_ok=True)
+    return folders
+
+
+def write_job(path, job):
+    '''write a job file atomically, so a power cut leaves either the old or the new file, never half of one'''
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(job, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def enqueue(queue_path, video, todays_folder_path, filename, now, codec, tag_dictionary, box_type):
+    '''add a recorded video to the queue, called by record_video.py when defer_tracking is True'''
+    folders = queue_folders(queue_path)
+    job = {
+        'video': video,
+        'folder': todays_folder_path,
+        'filename': filename,
+        'now': now,
+        'codec': codec,
+        'tag_dictionary': tag_dictionary,
+        'box_type': box_type,
+        'colony_number': setup.colony_number,
+        'enqueued': datetime.now().isoformat(timespec='seconds'),
+        'attempts': 0,
+        'interruptions': 0,
+    }
+    path = os.path.join(folders['pending'], filename + '.json')
+    write_job(path, job)
+    return path
+
+
+def recover(folders):
+    '''put jobs that were being tracked when the worker stopped (crash, reboot) back in the queue'''
+    for name in os.listdir(folders['running']):
+        if name.endswith('.json'):
+            os.replace(os.path.join(folders['running'], name), os.path.join(folders['pending'], name))
+            print(f"{name} was being tracked when the worker stopped, putting it back in the queue")
+            logger.info(f"tracking queue: recovered {name}")
+
+
+def next_job(folders):
+    '''path of the oldest pending job (job files are named after the recording, so they sort by time), or None'''
+    jobs = sorted(name for name in os.listdir(folders['pending']) if name.endswith('.json'))
+    if not jobs:
+        return None
+    return os.path.join(folders['pending'], jobs[0])
+
+
+def recording_interval():
+    '''minutes between recordings, the same setting that schedules record_video.py'''
+    return setup.tag_tracking_frequency if setup.tag_tracking == True else setup.recording_frequency
+
+
+def recording_window(when):
+    '''
+    (start, end) of the recording slot at or after when. Recordings start every recording_interval() minutes from
+    midnight and last recording_time seconds, plus tracking_queue_margin seconds on each side for the camera to start
+    and the files to be saved
+    '''
+    interval = recording_interval() * 60
+    midnight = when.replace(hour=0, minute=0, second=0, microsecond=0)
+    seconds = (when - midnight).total_seconds()
+    margin = setup.tracking_queue_margin
+    slot = math.floor(seconds / interval) * interval
+    if seconds > slot + setup.recording_time + margin:
+        slot += interval
+    start = midnight + timedelta(seconds=slot - margin)
+    end = midnight + timedelta(seconds=slot + setup.recording_time + margin)
+    return start, end
+
+
+def track_job(job):
+    '''track one queued video and save its outputs like record_video.py would. Runs in a child process'''
+    detector = create_detector(job['tag_dictionary'], job['box_type'], job['codec'], setup.detector_preset_file)
+    if setup.motion_gated_detection == True:
+        padding = setup.motion_padding // setup.mjpeg_decode_reduction if job['video'].endswith('.mjpeg') else setup.motion_padding
+        detector = MotionGatedDetector(detector, setup.full_detection_every, setup.motion_threshold, padding)
+    if job['video'].endswith('.mjpeg'):
+        raw, noID, frame_num = track_mjpeg(job['video'], job['filename'], job['colony_number'], job['now'], detector, setup.mjpeg_decode_reduction)
+    else:
+        raw, noID, frame_num = track_video(job['video'], job['filename'], job['colony_number'], job['now'], detector)
+
+    df = raw.to_dataframe()
+    df2 = noID.to_dataframe()
+    if setup.detection_output in ('log', 'both'):
+        if has_clip(log_path(job['folder'], job['filename']), job['filename']):
+            print(f"{job['filename']} is already in the detection log, not adding it again")
+        else:
+            write_detections(job['folder'], job['filename'], job['colony_number'], job['now'], raw, noID, frame_num)
+    if setup.detection_output in ('csv', 'both'):
+        write_tracking_csvs(df, df2, job['folder'], job['filename'])
+    print(f"tracked {job['filename']}: {frame_num} frames, {len(df)} tags found")
+
+    if setup.interpolate_data == True and df.empty == False:
+        df = interpolate_tracks(df, setup.max_seconds_gap, setup.actual_frames_per_second, setup.interpolation_method)
+    if df.empty == False and setup.calculate_behavior_metrics == True:
+        import behavioral_metrics
+        behavioral_metrics.calculate_behavior_metrics(df, setup.actual_frames_per_second, setup.moving_threshold, job['folder'], job['filename'])
+
+
+def run_job(folders, path, deadline):
+    '''
+    track the job at path in a child process, stopping it at deadline (a datetime, None for no limit). Returns True if
+    it finished, False if it was stopped or failed and was put back in the queue (or in failed/)
+    '''
+    name = os.path.basename(path)
+    running = os.path.join(folders['running'], name)
+    os.replace(path, running)
+    with open(running) as f:
+        job = json.load(f)
+
+    process = multiprocessing.Process(target=track_job, args=(job,))
+    start = time.time()
+    process.start()
+    timeout = None if deadline is None else max((deadline - datetime.now()).total_seconds(), 0)
+    process.join(timeout)
+
+    if process.is_alive():
+        process.terminate()
+        process.join()
+        job['interruptions'] += 1
+        write_job(os.path.join(folders['pending'], name), job)
+        os.remove(running)
+        print(f"stopped tracking {job['filename']} for the next recording after {round(time.time() - start)} seconds, it will be tracked again later")
+        logger.info(f"tracking queue: interrupted {job['filename']} ({job['interruptions']} times)")
+        return False
+
+    if process.exitcode != 0:
+        job['attempts'] += 1
+        state = 'failed' if job['attempts'] >= setup.tracking_queue_max_attempts else 'pending'
+        write_job(os.path.join(folders[state], name), job)
+        os.remove(running)
+        print(f"tracking {job['filename']} failed (attempt {job['attempts']}), moved it to {state}")
+        logger.warning(f"tracking queue: {job['filename']} failed with exit code {process.exitcode}, moved to {state}")
+        return False
+
+    job['tracked'] = datetime.now().isoformat(timespec='seconds')
+    job['seconds'] = round(time.time() - start, 2)
+    write_job(os.path.join(folders['done'], name), job)
+    os.remove(running)
+    logger.info(f"tracking queue: tracked {job['filename']} in {job['seconds']} seconds")
+    return True
+
+
+def run_worker(queue_path, once=False, poll=10):
+    '''track queued videos between recordings until stopped. With once=True, return when the queue is empty'''
+    folders = queue_folders(queue_path)
+    recover(folders)
+
+    while True:
+        now = datetime.now()
+        start, end = recording_window(now)
+        if start <= now < end:
+            wait = (end - now).total_seconds()
+            print(f"recording in progress, waiting {round(wait)} seconds")
+            time.sleep(wait)
+            continue
+
+        path = next_job(folders)
+        if path is None:
+            if once:
+                return
+            time.sleep(min(poll, max((start - now).total_seconds(), 0.1)))
+            continue
+
+        with open(path) as f:
+            interruptions = json.load(f)['interruptions']
+        '''a video that keeps being interrupted is longer to track than the time between recordings, so let it finish'''
+        deadline = None if interruptions >= setup.tracking_queue_max_interruptions else start
+        if deadline is None:
+            logger.warning(f"tracking queue: {os.path.basename(path)} was interrupted {interruptions} times, tracking it through the next recording")
+        run_job(folders, path, deadline)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Track videos queued by record_video.py between recordings')
+    parser.add_argument('-q', '--queue', type=str, default=setup.tracking_queue_path, help='queue folder, defaults to tracking_queue_path in setup.py')
+    parser.add_argument('-o', '--once', action='store_true', help='stop when the queue is empty instead of waiting for new videos')
+    args = parser.parse_args()
+
+    username = pwd.getpwuid(os.getuid())[0]
+    logging.basicConfig(filename=f'/home/{username}/Desktop/BumbleBox/logs/log.log',encoding='utf-8',format='%(filename)s %(asctime)s: %(message)s', filemode='a', level=logging.DEBUG)
+    run_worker(args.queue, args.once)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
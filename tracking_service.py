@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+'''
+Central tracking service: a server runs this and the BumbleBoxes copy their recorded .mjpeg and .mp4 videos into its
+spool folder, instead of each box tracking its own videos on a slow Pi.
+
+    python3 tracking_service.py -s /srv/bumblebox_spool -w 16 --port 8765
+
+Spool folder layout:
+    incoming/     boxes copy videos here, optionally in a subfolder per box. A video is only picked up once it has
+                  not been modified for --settle seconds, so one that is still being copied is left alone (make it
+                  longer than the slowest copy can stall). Files not ending in .mjpeg or .mp4 are ignored
+    processing/   videos being tracked, in a subfolder per service (named after the computer), so several services
+                  can share a spool folder. Videos left here by a crash are put back in incoming/ on restart
+    results/      the _raw.csv and _noID.csv files, in the same subfolders as in incoming/
+    done/         tracked videos (unless --delete is used)
+    failed/       videos that could not be tracked, each with a .error.txt file saying why
+    status.json   queue depth and throughput counters, rewritten every few seconds (also served over http with --port)
+
+Videos are claimed by renaming them, which is atomic, so no video is tracked twice, and csv files are written to a
+temporary name and renamed, so a csv in results/ is always complete. Tracking uses the same detector settings as
+trackTagsFromVid_MJPEG in record_video.py for every video, since saved mp4 videos are compressed like mjpeg ones.
+'''
+
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool
+
+import cv2
+import setup
+from tag_tracking import create_detector, parse_video_filename, resolve_preset_path, track_mjpeg, track_video
+
+VIDEO_EXTENSIONS = ('.mjpeg', '.mp4')
+SPOOL_FOLDERS = ('incoming', 'processing', 'results', 'done', 'failed')
+
+logger = logging.getLogger(__name__)
+
+
+def spool_folders(spool):
+    folders = {name: os.path.join(spool, name) for name in SPOOL_FOLDERS}
+    for folder in folders.values():
+        os.makedirs(folder, exist_ok=True)
+    return folders
+
+
+def move(path, destination):
+    '''rename path to destination, creating its folder. Returns False if path is gone (another service claimed it)'''
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    try:
+        os.rename(path, destination)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def ready_videos(incoming, settle):
+    '''videos in incoming (and its subfolders) that are not still being copied, oldest first, as paths relative to incoming'''
+    now = time.time()
+    videos = []
+    for dirpath, _, files in os.walk(incoming):
+        for f in files:
+            if not f.endswith(VIDEO_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, f)
+            try:
+                modified = os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+            if now - modified >= settle:
+                videos.append((modified, os.path.relpath(path, incoming)))
+    return [relative for _, relative in sorted(videos)]
+
+
+def recover(folders, processing):
+    '''put videos left in this service's processing folder by a crash back in incoming'''
+    for dirpath, _, files in os.walk(processing):
+        for f in files:
+            path = os.path.join(dirpath, f)
+            relative = os.path.relpath(path, processing)
+            if move(path, os.path.join(folders['incoming'], relative)):
+                print(f"putting {relative} back in the queue, it was being tracked when the service stopped")
+
+
+def write_csv_atomic(df, path):
+    tmp = path + '.tmp'
+    df.to_csv(tmp, index=False)
+    os.replace(tmp, path)
+
+
+def init_worker():
+    cv2.setNumThreads(1)
+
+
+def track_clip(job):
+    '''track one claimed video and write its csvs to its results folder. Runs in a pool worker'''
+    video, results_folder, tag_dictionary, box_type, preset_file, reduction = job
+    filename = os.path.splitext(os.path.basename(video))[0]
+    colony_number, now = parse_video_filename(filename)
+
+    start = time.time()
+    detector = create_detector(tag_dictionary, box_type, 'mjpeg', preset_file)
+    if video.endswith('.mjpeg'):
+        raw, noID, frame_num = track_mjpeg(video, filename, colony_number, now, detector, reduction, verbose=False)
+    else:
+        raw, noID, frame_num = track_video(video, filename, colony_number, now, detector, verbose=False)
+    if frame_num == 0:
+        raise ValueError("no frames could be read from the video")
+
+    os.makedirs(results_folder, exist_ok=True)
+    write_csv_atomic(raw.to_dataframe(), os.path.join(results_folder, filename + '_raw.csv'))
+    write_csv_atomic(noID.to_dataframe(), os.path.join(results_folder, filename + '_noID.csv'))
+    return {'frames': frame_num, 'tags': len(raw), 'seconds': time.time() - start}
+
+
+class ServiceStatus:
+    '''counters shared by the main loop, the pool callbacks and the http server'''
+
+    def __init__(self, name, workers, window=300):
+        self.lock = threading.Lock()
+        self.name = name
+        self.workers = workers
+        self.window = window
+        self.started = time.time()
+        self.queued = 0
+        self.in_progress = 0
+        self.completed = 0
+        self.failed = 0
+        self.frames = 0
+        self.recent = deque() #(finish time, frames) of videos finished in the last window seconds
+
+    def finished(self, frames):
+        with self.lock:
+            self.in_progress -= 1
+            self.completed += 1
+            self.frames += frames
+            self.recent.append((time.time(), frames))
+
+    def failure(self):
+        with self.lock:
+            self.in_progress -= 1
+            self.failed += 1
+
+    def summary(self):
+        with self.lock:
+            now = time.time()
+            while self.recent and now - self.recent[0][0] > self.window:
+                self.recent.popleft()
+            uptime = now - self.started
+            window = min(self.window, uptime)
+            return {
+                'service': self.name,
+                'workers': self.workers,
+                'uptime_seconds': round(uptime, 1),
+                'queue_depth': self.queued,
+                'in_progress': self.in_progress,
+                'completed': self.completed,
+                'failed': self.failed,
+                'frames_tracked': self.frames,
+                'frames_per_sec': round(self.frames / uptime, 2) if uptime > 0 else 0.0,
+                'recent_frames_per_sec': round(sum(f for _, f in self.recent) / window, 2) if window > 0 else 0.0,
+                'recent_videos_per_min': round(len(self.recent) * 60 / window, 2) if window > 0 else 0.0,
+                'updated': time.strftime('%Y-%m-%d %H:%M:%S'),
+            }
+
+    def write(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.summary(), f, indent=4)
+        os.replace(tmp, path)
+
+
+def serve_status(status, port):
+    '''serve the status counters as json at http://<server>:port/ in a background thread'''
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(status.summary(), indent=4).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('', port), StatusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_service(args):
+    folders = spool_folders(args.spool)
+    processing = os.path.join(folders['processing'], args.name)
+    recover(folders, processing)
+    status = ServiceStatus(args.name, args.workers)
+    status_path = os.path.join(args.spool, 'status.json')
+    if args.port:
+        serve_status(status, args.port)
+        print(f"serving status on port {args.port}")
+
+    def on_done(relative, claimed):
+        def callback(result):
+            if args.delete:
+                os.remove(claimed)
+            else:
+                move(claimed, os.path.join(folders['done'], relative))
+            status.finished(result['frames'])
+            print(f"{relative}: {result['frames']} frames, {result['tags']} tags in {round(result['seconds'], 1)} seconds ({status.summary()['recent_frames_per_sec']} frames/sec recently)")
+        return callback
+
+    def on_error(relative, claimed):
+        def callback(error):
+            move(claimed, os.path.join(folders['failed'], relative))
+            with open(os.path.join(folders['failed'], relative) + '.error.txt', 'w') as f:
+                f.write(f"{type(error).__name__}: {error}\n")
+            status.failure()
+            print(f"{relative} could not be tracked: {error}")
+            logger.error(f"tracking service: {relative} failed: {error}")
+        return callback
+
+    last_status = 0
+    with Pool(args.workers, initializer=init_worker) as pool:
+        while True:
+            ready = ready_videos(folders['incoming'], args.settle)
+            status.queued = len(ready)
+            '''only claim a couple of videos per worker at a time, so other services sharing the spool get some'''
+            for relative in ready[:max(2 * args.workers - status.in_progress, 0)]:
+                claimed = os.path.join(processing, relative)
+                if not move(os.path.join(folders['incoming'], relative), claimed):
+                    continue
+                with status.lock:
+                    status.in_progress += 1
+                    status.queued -= 1
+                job = (claimed, os.path.join(folders['results'], os.path.dirname(relative)), args.dictionary, args.box_type, args.preset, args.reduction)
+                pool.apply_async(track_clip, (job,), callback=on_done(relative, claimed), error_callback=on_error(relative, claimed))
+
+            if time.time() - last_status >= args.status_interval:
+                status.write(status_path)
+                last_status = time.time()
+
+            if args.once and not ready and status.in_progress == 0:
+                status.write(status_path)
+                return status.summary()
+            time.sleep(args.poll)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Track videos that BumbleBoxes copy into a spool folder')
+    parser.add_argument('-s', '--spool', type=str, required=True, help='spool folder (see the top of this file for its layout)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='number of videos to track at the same time')
+    parser.add_argument('-d', '--dictionary', type=str, default=setup.tag_dictionary, help='the aruco tag dictionary, for example 4X4_50')
+    parser.add_argument('-b', '--box_type', type=str, default=setup.box_type, choices=['custom','koppert'], help='which set of preset tracking parameters to use')
+    parser.add_argument('-p', '--preset', type=str, default=setup.detector_preset_file, help='tracking settings file made by tune_detector.py, used instead of the box_type presets')
+    parser.add_argument('-r', '--reduction', type=int, default=setup.mjpeg_decode_reduction, choices=[1, 2, 4, 8], help='decode mjpeg frames at 1/2, 1/4 or 1/8 size for faster tracking')
+    parser.add_argument('-t', '--settle', type=float, default=30, help='seconds a video must be unchanged before it is tracked, so videos still being copied are left alone')
+    parser.add_argument('-n', '--name', type=str, default=socket.gethostname(), help='name of this service, used for its processing folder. Defaults to the computer name')
+    parser.add_argument('--port', type=int, default=None, help='also serve the status counters as json over http on this port')
+    parser.add_argument('--poll', type=float, default=2, help='seconds between checks of the incoming folder')
+    parser.add_argument('--status_interval', type=float, default=10, help='seconds between updates of status.json')
+    parser.add_argument('--delete', action='store_true', help='delete videos once they are tracked instead of moving them to done/')
+    parser.add_argument('--once', action='store_true', help='stop once the incoming folder is empty, for testing')
+    args = parser.parse_args()
+    if args.preset is not None and not os.path.exists(resolve_preset_path(args.preset)):
+        parser.error(f"preset file {args.preset} not found")
+
+    summary = run_service(args)
+    print(json.dumps(summary, indent=4))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
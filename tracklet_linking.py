@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+'''
+Link unidentified tag detections (the rejected candidates in _noID.csv files) to known tags. A tag that is found in
+frames 10 and 14 but not in 11-13 was often still seen in those frames, just not read: a rejected candidate sits right
+where the tag should be. For every frame a known tag is missing from, its position is predicted by interpolating its
+track (up to max_gap frames from where it was last or next seen), nearby candidates are found with a KD-tree, and the
+candidates are matched to the missing tags with a global assignment per frame. A match is only kept if it is
+unambiguous: no other candidate (or other missing tag) is nearly as close.
+
+    python3 tracklet_linking.py -r video_raw.csv -n video_noID.csv -o video_linked.csv
+'''
+
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
+
+
+def predict_missing(raw, max_gap):
+    '''
+    (frame, ID, x, y) arrays of the predicted positions of known tags in the frames they are missing from, within
+    max_gap frames of a frame they were found in
+    '''
+    raw = raw.drop_duplicates(subset=['ID', 'frame'])
+    frames = np.arange(raw['frame'].min(), raw['frame'].max() + 1)
+    xs = raw.pivot(index='frame', columns='ID', values='centroidX').reindex(frames)
+    ys = raw.pivot(index='frame', columns='ID', values='centroidY').reindex(frames)
+    px = xs.interpolate(method='linear', limit=max_gap, axis='index', limit_direction='both')
+    py = ys.interpolate(method='linear', limit=max_gap, axis='index', limit_direction='both')
+
+    missing = (xs.isna() & px.notna()).to_numpy()
+    row, col = np.nonzero(missing)
+    return frames[row], xs.columns.to_numpy()[col], px.to_numpy()[row, col], py.to_numpy()[row, col]
+
+
+def link_unidentified(raw, noID, max_distance=50, max_gap=10, ambiguity_ratio=2.0):
+    '''
+    return raw with the noID detections that could be linked to a known tag added as rows of that tag, and a
+    "linked" column that is True for the added rows. max_distance is in pixels, and a match is only kept if the next
+    closest alternative is at least ambiguity_ratio times as far away
+    '''
+    raw = raw[raw['ID'].astype(str) != 'X'].copy()
+    raw['ID'] = raw['ID'].astype(int)
+    raw['linked'] = False
+    noID = noID.reset_index(drop=True)
+    if raw.empty or noID.empty:
+        return raw
+
+    frame, tag, px, py = predict_missing(raw, max_gap)
+    if len(frame) == 0:
+        return raw
+
+    '''one tree for all frames: the frame number is a third coordinate, spaced so candidates in other frames are always too far away'''
+    spacing = 4 * max_distance * ambiguity_ratio + 1
+    tree = cKDTree(np.column_stack([noID['centroidX'], noID['centroidY'], noID['frame'] * spacing]))
+    predictions = np.column_stack([px, py, frame * spacing])
+    distance, candidate = tree.query(predictions, k=2, distance_upper_bound=max_distance * ambiguity_ratio)
+
+    '''a missing tag with two candidates about as close is ambiguous'''
+    best, second = distance[:, 0], distance[:, 1]
+    keep = (best <= max_distance) & (second >= ambiguity_ratio * best)
+    pairs = pd.DataFrame({'prediction': np.nonzero(keep)[0], 'candidate': candidate[keep, 0], 'distance': best[keep]})
+
+    '''a candidate near two missing tags is ambiguous too, unless one is much closer than the other'''
+    nearby = tree.query_ball_point(predictions, max_distance * ambiguity_ratio)
+    claims = pd.DataFrame({'prediction': np.repeat(np.arange(len(nearby)), [len(n) for n in nearby]), 'candidate': np.concatenate([np.asarray(n, dtype=int) for n in nearby]) if len(nearby) else []})
+    claims['distance'] = np.hypot(px[claims['prediction']] - noID['centroidX'].to_numpy()[claims['candidate']], py[claims['prediction']] - noID['centroidY'].to_numpy()[claims['candidate']])
+    pairs = pairs.merge(claims.rename(columns={'prediction': 'other', 'distance': 'other_distance'}), on='candidate')
+    pairs['conflict'] = (pairs['other'] != pairs['prediction']) & (pairs['other_distance'] < ambiguity_ratio * pairs['distance'])
+    pairs = pairs.groupby(['prediction', 'candidate'], as_index=False).agg(distance=('distance', 'first'), conflict=('conflict', 'any'))
+    pairs = pairs[~pairs['conflict']]
+
+    '''global assignment per frame, so no candidate is given to two tags and no tag gets two candidates'''
+    pairs['frame'] = frame[pairs['prediction']]
+    matched = []
+    for _, group in pairs.groupby('frame'):
+        if len(group) == 1:
+            matched.append(group)
+            continue
+        rows = np.unique(group['prediction'])
+        cols = np.unique(group['candidate'])
+        cost = np.full((len(rows), len(cols)), max_distance * 1e3)
+        cost[np.searchsorted(rows, group['prediction']), np.searchsorted(cols, group['candidate'])] = group['distance']
+        r, c = linear_sum_assignment(cost)
+        chosen = cost[r, c] <= max_distance
+        matched.append(pd.DataFrame({'prediction': rows[r[chosen]], 'candidate': cols[c[chosen]]}))
+    if not matched:
+        return raw
+    matched = pd.concat(matched)
+
+    linked = noID.loc[matched['candidate'].to_numpy()].copy()
+    linked['ID'] = tag[matched['prediction'].to_numpy()].astype(int)
+    linked['linked'] = True
+    return pd.concat([raw, linked.reindex(columns=raw.columns)], ignore_index=True).sort_values(['frame', 'ID'], kind='stable', ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Link unidentified tag detections to known tags')
+    parser.add_argument('-r', '--raw', type=str, required=True, help='_raw.csv file with the identified tags')
+    parser.add_argument('-n', '--noID', type=str, required=True, help='_noID.csv file with the rejected candidates of the same video')
+    parser.add_argument('-o', '--output', type=str, required=True, help='csv file to write the identified and linked detections to')
+    parser.add_argument('-d', '--max_distance', type=float, default=50, help='largest distance in pixels between a candidate and where the tag should be')
+    parser.add_argument('-g', '--max_gap', type=int, default=10, help='only link in frames this close to a frame the tag was found in')
+    parser.add_argument('-a', '--ambiguity_ratio', type=float, default=2.0, help='the next closest alternative must be this many times further away')
+    args = parser.parse_args()
+
+    raw = pd.read_csv(args.raw)
+    linked = link_unidentified(raw, pd.read_csv(args.noID), args.max_distance, args.max_gap, args.ambiguity_ratio)
+    linked.to_csv(args.output, index=False)
+    print(f"linked {int(linked['linked'].sum())} unidentified detections to known tags, {len(raw)} -> {len(linked)} detections")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+'''
+Find fast ArUco detector settings that still find the tags. A grid of DetectorParameters values is tried (in parallel)
+on a set of frames where the tags are known, measuring detection speed and recall for each setting. The results are
+saved as a csv report with the Pareto front (settings that no other setting beats on both speed and recall) marked,
+and the fastest setting whose recall is within a tolerance of the best recall is saved as a preset json file, which
+record_video.py uses if detector_preset_file in setup.py points to it.
+
+The known tags come either from a video and a csv with the true tag positions in each frame (for example a _raw.csv
+made with slow, thorough settings and checked by hand), or from synthetic frames rendered like benchmark_tracking.py.
+'''
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+import pandas as pd
+
+import benchmark_tracking
+from mjpeg_reader import iter_gray_frames
+from tag_tracking import create_detector
+
+'''values tried for each parameter when no grid file is given'''
+DEFAULT_GRID = {
+    'minMarkerPerimeterRate': [0.01, 0.02, 0.03, 0.04],
+    'adaptiveThreshWinSizeMin': [3, 5, 7],
+    'adaptiveThreshWinSizeMax': [15, 23, 29],
+    'adaptiveThreshWinSizeStep': [3, 6, 10],
+    'polygonalApproxAccuracyRate': [0.03, 0.06, 0.09],
+}
+
+'''set by init_worker in each worker process, so the frames are only sent to each worker once'''
+worker_frames = None
+worker_labels = None
+worker_settings = None
+
+
+def load_video_frames(video, max_frames):
+    '''read up to max_frames grayscale frames from a video, mjpeg files are decoded straight to grayscale'''
+    frames = []
+    if video.endswith('.mjpeg'):
+        for gray in iter_gray_frames(video):
+            frames.append(gray)
+            if len(frames) == max_frames:
+                break
+        return frames
+
+    vid = cv2.VideoCapture(video)
+    while len(frames) < max_frames:
+        ret, frame = vid.read()
+        if ret == False:
+            break
+        frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+    vid.release()
+    return frames
+
+
+def load_sample(args):
+    '''return the sample frames (with CLAHE applied, as in tracking) and a DataFrame of the tags known to be in them'''
+    if args.video:
+        frames = load_video_frames(args.video, args.max_frames)
+        labels = pd.read_csv(args.labels)
+        labels = labels[(labels['frame'] < len(frames)) & (labels['ID'].astype(str) != 'X')]
+        labels = labels.astype({'ID': int})[['frame', 'ID', 'centroidX', 'centroidY']]
+    else:
+        render_args = argparse.Namespace(dictionary=args.dictionary, marker_size=args.marker_size, width=args.width, height=args.height, blur=args.blur, noise=args.noise, seed=0)
+        labels = benchmark_tracking.make_trajectories(args.max_frames, args.markers, args.width, args.height, args.marker_size)
+        frames = list(benchmark_tracking.render_frames(labels, render_args))
+
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+    return [clahe.apply(gray) for gray in frames], labels
+
+
+def expand_grid(grid):
+    '''every combination of the grid values as a list of dicts, skipping ones with a minimum window larger than the maximum'''
+    names = list(grid)
+    settings = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        setting = dict(zip(names, values))
+        if setting.get('adaptiveThreshWinSizeMin', 3) > setting.get('adaptiveThreshWinSizeMax', 23):
+            continue
+        settings.append(setting)
+    return settings
+
+
+def init_worker(frames, labels, settings):
+    global worker_frames, worker_labels, worker_settings
+    cv2.setNumThreads(1)
+    worker_frames = frames
+    worker_labels = labels
+    worker_settings = settings
+
+
+def evaluate(setting):
+    '''time detectMarkers with one parameter setting over the sample frames and score it against the known tags'''
+    dictionary, box_type, codec, max_error = worker_settings
+    detector = create_detector(dictionary, box_type, codec, parameters_override=setting)
+
+    rows = []
+    start = time.time()
+    for frame_num, gray in enumerate(worker_frames):
+        corners, ids, _ = detector.detectMarkers(gray)
+        if ids is None:
+            continue
+        c = np.asarray(corners, dtype=np.float32).reshape(len(ids), 4, 2).mean(axis=1)
+        rows.append(pd.DataFrame({'frame': frame_num, 'ID': ids.reshape(-1), 'centroidX_found': c[:, 0], 'centroidY_found': c[:, 1]}))
+    seconds = time.time() - start
+
+    found = pd.concat(rows) if rows else pd.DataFrame(columns=['frame', 'ID', 'centroidX_found', 'centroidY_found'])
+    matched = worker_labels.merge(found, on=['frame', 'ID'], how='left')
+    error = np.hypot(matched['centroidX'] - matched['centroidX_found'], matched['centroidY'] - matched['centroidY_found'])
+    recall = float((error <= max_error).sum() / len(worker_labels)) if len(worker_labels) else 0.0
+
+    return dict(setting, frames_per_sec=len(worker_frames) / seconds, detections_per_sec=len(found) / seconds, recall=recall)
+
+
+def pareto_front(results):
+    '''True for every setting that no other setting beats on both recall and speed'''
+    speed = results['frames_per_sec'].to_numpy()
+    recall = results['recall'].to_numpy()
+    dominated = ((speed[None, :] >= speed[:, None]) & (recall[None, :] >= recall[:, None]) & ((speed[None, :] > speed[:, None]) | (recall[None, :] > recall[:, None]))).any(axis=1)
+    return ~dominated
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Tune ArUco detector settings for speed while keeping recall')
+    parser.add_argument('-v', '--video', type=str, default=None, help='video to tune on (.mjpeg or .mp4). If not given, synthetic frames are used')
+    parser.add_argument('-l', '--labels', type=str, default=None, help='csv with the frame, ID, centroidX and centroidY of the tags in the video')
+    parser.add_argument('-f', '--max_frames', type=int, default=20, help='number of frames to tune on')
+    parser.add_argument('-g', '--grid', type=str, default=None, help='json file mapping DetectorParameters names to lists of values to try. Defaults to a built in grid')
+    parser.add_argument('-d', '--dictionary', type=str, default='4X4_50', help='aruco tag dictionary')
+    parser.add_argument('-b', '--box_type', type=str, default='custom', choices=['custom', 'koppert'], help='box_type presets to start from, for parameters not in the grid')
+    parser.add_argument('-cd', '--codec', type=str, default='mjpeg', choices=['mp4', 'mjpeg'], help='which codec presets to start from')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.01, help='the chosen setting may have recall this much below the best recall')
+    parser.add_argument('-e', '--max_error', type=float, default=5.0, help='a detection more than this many pixels from the known centroid does not count as found')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='number of settings to try at the same time')
+    parser.add_argument('-o', '--output', type=str, default='detector_tuning.csv', help='csv report of every setting tried')
+    parser.add_argument('-p', '--preset', type=str, default='detector_preset.json', help='where to save the chosen setting')
+    parser.add_argument('--markers', type=int, default=30, help='synthetic frames only: number of tags')
+    parser.add_argument('--marker_size', type=int, default=60, help='synthetic frames only: tag size in pixels')
+    parser.add_argument('--width', type=int, default=4056, help='synthetic frames only: frame width')
+    parser.add_argument('--height', type=int, default=3040, help='synthetic frames only: frame height')
+    parser.add_argument('--blur', type=float, default=1.0, help='synthetic frames only: gaussian blur sigma')
+    parser.add_argument('--noise', type=float, default=4.0, help='synthetic frames only: gaussian noise standard deviation')
+    args = parser.parse_args()
+
+    if args.video and not args.labels:
+        parser.error('--labels is needed with --video')
+
+    grid = DEFAULT_GRID
+    if args.grid:
+        with open(args.grid) as f:
+            grid = json.load(f)
+    settings = expand_grid(grid)
+
+    frames, labels = load_sample(args)
+    print(f"trying {len(settings)} detector settings on {len(frames)} frames with {len(labels)} known tags, using {args.workers} workers")
+
+    start = time.time()
+    with Pool(args.workers, initializer=init_worker, initargs=(frames, labels, (args.dictionary, args.box_type, args.codec, args.max_error))) as pool:
+        results = []
+        for done, result in enumerate(pool.imap_unordered(evaluate, settings), start=1):
+            results.append(result)
+            if done % 10 == 0 or done == len(settings):
+                print(f"{done}/{len(settings)} settings tried, {round(time.time() - start, 1)} seconds")
+
+    results = pd.DataFrame(results)
+    results['pareto'] = pareto_front(results)
+    results = results.sort_values(['pareto', 'frames_per_sec'], ascending=False)
+    results.to_csv(args.output, index=False)
+    print(f"saved report to {args.output}")
+
+    good_enough = results[results['recall'] >= results['recall'].max() - args.tolerance]
+    best = good_enough.sort_values('frames_per_sec', ascending=False).iloc[0]
+    preset = {
+        'parameters': {name: best[name].item() for name in grid},
+        'frames_per_sec': round(float(best['frames_per_sec']), 3),
+        'recall': round(float(best['recall']), 4),
+        'codec': args.codec,
+        'box_type': args.box_type,
+        'sample': args.video or 'synthetic',
+    }
+    with open(args.preset, 'w') as f:
+        json.dump(preset, f, indent=4)
+
+    print(results[results['pareto']].to_string(index=False))
+    print(f"\nchose {preset['parameters']}: {preset['frames_per_sec']} frames/sec, recall {preset['recall']} (best recall {round(results['recall'].max(), 4)})")
+    print(f"saved preset to {args.preset}, set detector_preset_file = '{os.path.abspath(args.preset)}' in setup.py to use it")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())